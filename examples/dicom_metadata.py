@@ -71,6 +71,51 @@ def subj_data_from_dicoms(ctx, crumb_path, arg_name, verbose=False):
     return subj_nuks
 
 
+@task(autoprint=True)
+def index_dicoms(ctx, crumb_path, index_file, n_jobs=4, tags='', rescan=False, verbose=False):
+    """ Index the DICOM series in `crumb_path` in the sqlite file `index_file`.
+    Only the headers of the new or modified files are read, in `n_jobs` threads.
+    See `pypes.dicom_index.DicomIndex`.
+
+    Parameters
+    ----------
+    crumb_path: str
+        Path with Crumbs to the DICOM files, e.g.,
+        /home/hansel/data/{subj_id}/{session}/{acq}/{dcm_file}
+
+    index_file: str
+
+    n_jobs: int
+
+    tags: str
+        Comma-separated DICOM keywords to store for each series.
+        If empty, `pypes.dicom_index.DEFAULT_TAGS`.
+
+    rescan: bool
+        Read again all the files.
+
+    Returns
+    -------
+    n_series: int
+        Number of indexed series.
+    """
+    from pypes.dicom_index import DicomIndex, DEFAULT_TAGS
+
+    if verbose:
+        verbose_switch(verbose)
+
+    crumb = Crumb(op.expanduser(op.abspath(crumb_path)), ignore_list=['.*'])
+    if not crumb.has_crumbs():
+        raise ValueError('Expected a path with crumb arguments, e.g., '
+                         '"/home/hansel/data/{group}/{sid}/{session}/{dcm_file}"')
+
+    tags = [tag.strip() for tag in tags.split(',') if tag.strip()] or DEFAULT_TAGS
+    index = DicomIndex(index_file, tags=tags)
+    index.scan(crumb, n_jobs=int(n_jobs), rescan=rescan)
+
+    return len(index.series())
+
+
 def _read_dcm_until_valid(subj_path):
     """ Look for all DCM files within subj_path until read a valid
     data using _read_subjdata_from_dcm."""
@@ -14,7 +14,6 @@ import os
 import os.path as op
 import logging
 
-import pandas as pd
 from hansel import Crumb
 from invoke import task
 from boyle.files.search  import recursive_glob
@@ -43,9 +42,10 @@ def verbose_switch(verbose=False):
 
 
 @task
-def decompress_dicoms(ctx, input_dir):
-    """ Decompress all *.dcm files recursively found in DICOM_DIR.
-    This uses 'gdcmconv --raw'.
+def decompress_dicoms(ctx, input_dir, n_jobs=0):
+    """ Decompress the *.dcm files recursively found in DICOM_DIR that have a
+    compressed transfer syntax. They are decoded with the pydicom pixel handlers,
+    or with 'gdcmconv --raw' if pydicom can not decode them.
     It works when 'dcm2nii' shows the `Unsupported Transfer Syntax` error. This error is
     usually caused by lack of JPEG2000 support in dcm2nii compilation.
 
@@ -57,20 +57,21 @@ def decompress_dicoms(ctx, input_dir):
     input_dir: str
         Folder path
 
+    n_jobs: int
+        Number of processes. If 0, the number of CPUs.
+
     Notes
     -----
-    The *.dcm files in `input_folder` will be overwritten.
+    The compressed *.dcm files in `input_folder` will be overwritten.
     """
-    import subprocess
+    from pypes.convert import decompress_dicoms as decompress
 
     dcmfiles = sorted(recursive_glob(input_dir, '*.dcm'))
-    for dcm in dcmfiles:
-        cmd = 'gdcmconv --raw -i "{0}" -o "{0}"'.format(dcm)
-        log.debug('Calling {}.'.format(cmd))
-        try:
-            subprocess.check_call(cmd, shell=True)
-        except:
-            pass
+    decompressed, failed = decompress(dcmfiles, n_jobs=int(n_jobs) or None)
+
+    log.info('Decompressed {} of {} DICOM files.'.format(len(decompressed), len(dcmfiles)))
+    for dcm, error in failed:
+        log.error('Failed {}: {}'.format(dcm, error))
 
 
 @task
@@ -150,6 +151,50 @@ def dcm2nii(ctx, input_crumb_path, output_dir, regex='fnmatch', ncpus=3):
          _ = [convert_dcm2nii(path, sess, dst) for path, sess, dst in src_dst]
 
 
+@task
+def convert_dicoms(ctx, input_crumb_path, output_dir, index_file='', n_jobs=0):
+    """ Convert the DICOM series within `input_crumb_path` into NifTI in `output_dir`
+    with dcm2niix. The converted series are recorded in `output_dir/.conversions.sqlite`
+    and skipped in the next runs, as well as the copies of a series in other folders.
+    See `pypes.convert.convert_dicom_series`.
+
+    Parameters
+    ----------
+    input_crumb_path: str
+        A crumb path str indicating the whole path until the DICOM files.
+        Example: '/home/hansel/data/{group}/{subj_id}/{session_id}/{acquisition}/{dcm_file}
+
+    output_dir: str
+        The root folder path where to save the tree of nifti files, as in `dcm2nii`.
+
+    index_file: str
+        Path to the `pypes.dicom_index.DicomIndex` of the DICOM files.
+        If empty, `output_dir/.dicom_index.sqlite`. It is updated before the conversion.
+
+    n_jobs: int
+        Number of dcm2niix processes in parallel. If 0, the number of CPUs.
+    """
+    from pypes.convert import convert_dicom_series
+    from pypes.dicom_index import DicomIndex
+
+    output_dir = op.abspath(op.expanduser(output_dir))
+    input_crumb = Crumb(op.abspath(op.expanduser(input_crumb_path)), ignore_list=['.*'])
+    if not index_file:
+        index_file = op.join(output_dir, '.dicom_index.sqlite')
+
+    index = DicomIndex(index_file)
+    index.scan(input_crumb, n_jobs=max(4, int(n_jobs)))
+
+    converted, failed = convert_dicom_series(index,
+                                             input_dir=input_crumb.split()[0],
+                                             output_dir=output_dir,
+                                             n_jobs=int(n_jobs) or None)
+
+    log.info('Converted {} DICOM folders.'.format(len(converted)))
+    for folder, error in failed:
+        log.error('Failed {}: {}'.format(folder, error))
+
+
 @task
 def clinical_pype(ctx, wf_name="spm_anat_preproc", base_dir="",
                   cache_dir="", output_dir="", settings_file='',
@@ -467,10 +512,13 @@ def plot_ica_results(ctx, ica_result, application, mask_file='', mode='+-', zsco
 
 
 @task
-def motion_stats_sheet(ctx, motion_file_cr, crumb_fields, out_path):
+def motion_stats_sheet(ctx, motion_file_cr, crumb_fields, out_path, n_jobs=4):
     """ Create in `out_path` an Excel spreadsheet with some of the motion statistics obtained from the
     `statistics_files` output of the nipype.RapidArt found in the hansel.Crumb `motion_file_cr`.
 
+    If the extension of `out_path` is '.parquet', '.feather' or '.pkl', a typed table is
+    written instead, and the following runs will only read the statistics files that changed.
+
     Parameters
     ----------
     motion_file_cr: str
@@ -479,6 +527,9 @@ def motion_stats_sheet(ctx, motion_file_cr, crumb_fields, out_path):
 
     out_path: str
 
+    n_jobs: int
+        Number of threads to read the statistics files.
+
     Examples
     --------
     >>> inv motion_stats_sheet \
@@ -486,42 +537,13 @@ def motion_stats_sheet(ctx, motion_file_cr, crumb_fields, out_path):
     >>> --crumb-fields "['group', 'patient_id', 'session']" \
     >>> --out-path "/home/hansel/data/motion_stats.xls"
     """
-    import json
-    from collections import OrderedDict
-
-    from hansel import Crumb
-
-    def get_motion_record(mtn_file_cr, crumb_fields):
-        """ Return an OrderedDict of the information found in the `mtn_file_cr` and also
-        `crumb_fields` Crumb argument values."""
-        stats = json.load(open(str(mtn_file_cr)))
-
-        outliers = stats[1]
-        motion_norm = stats[3]['motion_norm']
-
-        #outliers_hdr = list(outliers.keys())
-        motion_hdr   = ['{}_motion_norm'.format(k) for k in motion_norm.keys()]
-
-        mtn_record = OrderedDict()
-        for fn in crumb_fields:
-            mtn_record[fn] = mtn_file_cr[fn][0]
-
-        mtn_record.update(outliers)
-
-        for hdr, fn in zip(motion_hdr, motion_norm):
-            mtn_record[hdr] = motion_norm[fn]
-
-        return mtn_record
-
-    # process the input
-    motion_file_cr = Crumb(motion_file_cr)
-    crumb_fields   = [crf.strip() for crf in crumb_fields[1:-1].replace("'", "").split(',')]
+    from pypes.fmri.utils import motion_stats_sheet, motion_stats_table
 
-    # create the motion records
-    motionstats = [get_motion_record(stats_file, crumb_fields) for stats_file in motion_file_cr.ls()]
+    if op.splitext(out_path)[1].lower() in ('.parquet', '.feather', '.pkl'):
+        motion_stats_table(motion_file_cr, crumb_fields, out_path, n_jobs=int(n_jobs))
+        return
 
-    # create a pandas Dataframe out of it
-    df = pd.DataFrame.from_records(motionstats, columns=motionstats[0].keys())
+    df = motion_stats_sheet(motion_file_cr, crumb_fields, n_jobs=int(n_jobs))
 
     # save it into an excel file
     df.to_excel(out_path)
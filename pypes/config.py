@@ -5,12 +5,18 @@ This works over Kaptan:https://github.com/emre/kaptan
 
 The global configuration registry is declared in the bottom of this file.
 """
+import os
 import os.path as op
+import pickle
+import logging as log
+from   collections.abc import Mapping
 
 from   nipype.pipeline.engine import Node, MapNode, JoinNode
 from   nipype.interfaces.base import isdefined
 from   kaptan import Kaptan
 
+from   .resources import node_resources, RESOURCE_PARAMS
+
 
 def _load_config(file_path):
     cpt = Kaptan()
@@ -29,6 +35,17 @@ def _update_kaptan(kptn, new_values):
         kptn.upsert(k, v)
 
 
+def _split_node_key(key):
+    """ Return the node name and the parameter name of a configuration `key`.
+    For example: 'anat_warp.bias_regularization' -> ('anat_warp', 'bias_regularization').
+    Keys without '.' are returned as (key, key).
+    """
+    if '.' in key:
+        node_name, param = key.split('.', 1)
+        return node_name, param
+    return key, key
+
+
 class Borg:
     __shared_state = {}
 
@@ -55,6 +72,32 @@ class Config(object):
     def __init__(self, handler=None):
         self.__dict__ = self.__shared_state
         self._cpt = Kaptan(handler)
+        self._update_node_index()
+
+    def _update_node_index(self, keys=None):
+        """ Update the node name to parameters index for `keys`.
+        If `keys` is None will rebuild the whole index."""
+        if keys is None:
+            self._node_index = {}
+            keys = self.keys()
+
+        for k in keys:
+            node_name, param = _split_node_key(k)
+            self._node_index.setdefault(node_name, {})[param] = self._cpt.configuration_data[k]
+
+    def node_params(self, node_name):
+        """ Return a dict with the parameters for the node with name `node_name`,
+        i.e., the values of the keys '<node_name>.<parameter>'.
+
+        Parameters
+        ----------
+        node_name: str
+
+        Returns
+        -------
+        params: dict
+        """
+        return dict(self._node_index.get(node_name, {}))
 
     @classmethod
     def from_file(cls, file_path):
@@ -80,6 +123,7 @@ class Config(object):
         _check_file(file_path)
         cfg = Config()
         cfg._cpt = _load_config(file_path)
+        cfg._update_node_index()
         return cfg
 
     def update_from_file(self, file_path):
@@ -107,6 +151,7 @@ class Config(object):
 
         params = cpt.configuration_data
         _update_kaptan(self._cpt, params)
+        self._update_node_index(params.keys())
 
     def check_file(self, item):
         """ This is a __getitem__ operator for file path values, if the file does not exist an IOError is raised."""
@@ -122,6 +167,7 @@ class Config(object):
     def update(self, adict):
         for k, v in adict.items():
             self._cpt.upsert(k, v)
+        self._update_node_index(adict.keys())
 
     def keys(self):
         return self._cpt.configuration_data.keys()
@@ -138,21 +184,133 @@ class Config(object):
         return self._cpt.configuration_data[item]
 
     def __setitem__(self, key, value):
-        return self._cpt.upsert(key, value)
+        self._cpt.upsert(key, value)
+        self._update_node_index([key])
 
     def __repr__(self):
         return '<config.Config> ({})'.format('\n'.join([str(i) for i in self.items()]))
 
+    def freeze(self):
+        """ Return an immutable and picklable snapshot of the current settings.
+
+        Returns
+        -------
+        snapshot: FrozenConfig
+        """
+        return FrozenConfig(dict(self.items()))
+
+
+class FrozenConfig(Mapping):
+    """ An immutable snapshot of the configuration settings.
+    It has the same reading interface as Config and it is cheap to pickle,
+    so it can be sent to the worker processes.
+
+    Parameters
+    ----------
+    data: dict
+        The configuration settings.
+    """
+    def __init__(self, data):
+        self._data = dict(data)
+        self._node_index = {}
+        for k, v in self._data.items():
+            node_name, param = _split_node_key(k)
+            self._node_index.setdefault(node_name, {})[param] = v
+
+    def __getitem__(self, item):
+        if item not in self._data:
+            raise KeyError('Could not find key {} in configuration content.'.format(item))
+        return self._data[item]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, item, default=None):
+        return self._data.get(item, default)
+
+    def __getstate__(self):
+        return self._data
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def node_params(self, node_name):
+        """ Return a dict with the parameters for the node with name `node_name`."""
+        return dict(self._node_index.get(node_name, {}))
+
+    def __repr__(self):
+        return '<config.FrozenConfig> ({})'.format('\n'.join([str(i) for i in self.items()]))
+
 
 # the global configuration registry
 PYPES_CFG = Config()
 
+# environment variable with the path to the configuration snapshot for the worker processes
+SNAPSHOT_ENVVAR = 'PYPES_CONFIG_SNAPSHOT'
+
+
+def save_config_snapshot(file_path):
+    """ Pickle a frozen snapshot of the global configuration in `file_path`.
+
+    Parameters
+    ----------
+    file_path: str
+
+    Returns
+    -------
+    snapshot: FrozenConfig
+    """
+    snapshot = PYPES_CFG.freeze()
+    with open(file_path, 'wb') as f:
+        pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+    return snapshot
+
+
+def load_config_snapshot(file_path):
+    """ Return the FrozenConfig pickled in `file_path`."""
+    with open(file_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _env_snapshot():
+    """ Return the configuration snapshot given by the `SNAPSHOT_ENVVAR`
+    environment variable, None if it is not set."""
+    file_path = os.environ.get(SNAPSHOT_ENVVAR, '')
+    if not file_path or not op.isfile(file_path):
+        return None
+    return load_config_snapshot(file_path)
+
+
+# the configuration snapshot, set by `run_wf` while it runs a workflow, and inherited by
+# its forked worker processes. The workers started afresh load it from `SNAPSHOT_ENVVAR`.
+_SNAPSHOT = _env_snapshot()
+
+
+def use_config_snapshot(snapshot):
+    """ Make `get_config_setting` and `setup_node` read from the FrozenConfig `snapshot`
+    instead of the global configuration. Set it to None to go back to the global configuration.
+    Return the previous snapshot."""
+    global _SNAPSHOT
+    prev, _SNAPSHOT = _SNAPSHOT, snapshot
+    return prev
+
+
+# the node names whose settings have been read, see `unmatched_node_settings`
+_READ_NODE_NAMES = set()
+
+
+def _active_config():
+    return PYPES_CFG if _SNAPSHOT is None else _SNAPSHOT
+
 
 def node_settings(node_name):
-    global PYPES_CFG
-    for k, v in PYPES_CFG.items():
-        if k.startswith(node_name):
-            yield k, v
+    """ Yield the configuration keys and values for the node with name `node_name`."""
+    _READ_NODE_NAMES.add(node_name)
+    for param, v in _active_config().node_params(node_name).items():
+        yield (param if param == node_name else '{}.{}'.format(node_name, param)), v
 
 
 def update_config(value):
@@ -181,12 +339,48 @@ def _set_node_inputs(node, params, overwrite=False):
 
 
 def _get_params_for(node_name):
-    pars = {}
-    for k, v in node_settings(node_name):
-        nuk = '.'.join(k.split('.')[1:]) if '.' in k else k
-        pars[nuk] = v
+    """ Return a dict with the configuration parameters for the node with name `node_name`."""
+    _READ_NODE_NAMES.add(node_name)
+    return _active_config().node_params(node_name)
+
+
+def unmatched_node_settings(node_names):
+    """ Return the configuration keys '<name>.<parameter>' whose name starts with one of
+    `node_names` but is none of them, and that have not been read by name.
+    Before version 0.3.5 the node settings were matched by prefix, so these keys
+    were applied to the nodes whose name they start with. Now they match no node.
 
-    return pars
+    Parameters
+    ----------
+    node_names: iterable of str
+
+    Returns
+    -------
+    keys: list of str
+    """
+    node_names = set(node_names)
+
+    keys = []
+    for k in _active_config().keys():
+        if '.' not in k:
+            continue
+        name, _ = _split_node_key(k)
+        if name in node_names or name in _READ_NODE_NAMES:
+            continue
+        if any(name.startswith(node_name) for node_name in node_names):
+            keys.append(k)
+    return sorted(keys)
+
+
+def warn_unmatched_node_settings(wf):
+    """ Log a warning with the node settings that match no node of the workflow `wf`.
+    See `unmatched_node_settings`."""
+    keys = unmatched_node_settings(node.name for node in wf._get_all_nodes())
+    if keys:
+        log.warning('The configuration settings {} do not match the name of any node in the '
+                    'workflow {}. The node settings are matched with the exact node name, '
+                    'the part of the key before the first dot.'.format(keys, wf.name))
+    return keys
 
 
 def check_mandatory_inputs(node_names):
@@ -199,8 +393,11 @@ def check_mandatory_inputs(node_names):
 
 
 def get_config_setting(param_name, default=''):
-    """ Return the value for the entry with name `param_name` in the global configuration."""
-    return PYPES_CFG.get(param_name, default=default)
+    """ Return the value for the entry with name `param_name` in the global configuration,
+    or in the configuration snapshot if this is a worker process launched by `run_wf`."""
+    if '.' in param_name:
+        _READ_NODE_NAMES.add(_split_node_key(param_name)[0])
+    return _active_config().get(param_name, default)
 
 
 def setup_node(interface, name, settings=None, overwrite=True, **kwargs):
@@ -230,10 +427,16 @@ def setup_node(interface, name, settings=None, overwrite=True, **kwargs):
 
         Extra arguments to pass to nipype.Node __init__ function.
 
-
     Returns
     -------
     node: nipype.Node
+
+    Notes
+    -----
+    The 'mem_gb' and 'n_procs' node settings are not node inputs, they are the
+    resource estimates for the MultiProc scheduler. If they are not set, they are
+    taken from the runtime database in the `profile_db_file` setting or from the size
+    of the input images. See `pypes.resources`.
     """
     typ = kwargs.pop('type', None)
     if typ == 'map':
@@ -242,12 +445,20 @@ def setup_node(interface, name, settings=None, overwrite=True, **kwargs):
         node_class = JoinNode
     else:
         node_class = Node
-    node = node_class(interface=interface, name=name, **kwargs)
 
     params = _get_params_for(name)
     if settings is not None:
         params.update(settings)
 
+    resources = node_resources(interface, name, params, is_join=(typ == 'join'),
+                               db_file=get_config_setting('profile_db_file', default=''))
+    for k, v in resources.items():
+        kwargs.setdefault(k, v)
+
+    node = node_class(interface=interface, name=name, **kwargs)
+
+    params = {k: v for k, v in params.items() if k not in RESOURCE_PARAMS}
+
     _set_node_inputs(node, params, overwrite=overwrite)
 
     return node
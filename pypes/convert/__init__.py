@@ -1,2 +1,4 @@
 
-from .dicom_to_nifti import attach_dcm2niix
\ No newline at end of file
+from .dicom_to_nifti import attach_dcm2niix
+from .batch import ConversionManifest, convert_dicom_series
+from .decompress import decompress_dicoms
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Resumable conversion of the DICOM series of a `pypes.dicom_index.DicomIndex` with dcm2niix.
+
+Each DICOM folder is converted once: the series already converted, with the same
+SeriesInstanceUID and number of files, are recorded in a manifest and skipped in the
+next runs, and the folders with only copies of a series in other folders are left out.
+dcm2niix converts all the files of a folder, so the copies of a series in a folder
+that also has other series are converted with them.
+The largest folders are converted first, in a pool of threads that take the next
+folder as soon as they finish one, so the last conversions are the shortest.
+"""
+import os
+import os.path as op
+import json
+import shutil
+import sqlite3
+import datetime
+import subprocess
+import logging as log
+from   collections import defaultdict
+from   contextlib import closing
+from   concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversions (
+    series_uid  TEXT NOT NULL,
+    n_files     INTEGER NOT NULL,
+    folder      TEXT NOT NULL,
+    out_files   TEXT NOT NULL,
+    finish_time TEXT NOT NULL,
+    PRIMARY KEY (series_uid, n_files)
+);
+"""
+
+
+class ConversionManifest(object):
+    """ Record of the converted DICOM series, keyed by SeriesInstanceUID and number of files.
+
+    Parameters
+    ----------
+    manifest_file: str
+        Path to the sqlite database file. It will be created if it does not exist.
+
+    timeout: float
+        Seconds to wait for the database lock.
+    """
+    def __init__(self, manifest_file, timeout=60.0):
+        self.manifest_file = op.abspath(op.expanduser(manifest_file))
+        self.timeout = timeout
+
+        manifest_dir = op.dirname(self.manifest_file)
+        if not op.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+
+        with closing(self._connect()) as conn:
+            with conn:
+                conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.manifest_file, timeout=self.timeout)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def converted(self):
+        """ Return a dict from (series_uid, n_files) to the list of output files
+        of the converted series whose output files still exist."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT series_uid, n_files, out_files FROM conversions').fetchall()
+
+        done = {}
+        for row in rows:
+            out_files = json.loads(row['out_files'])
+            if out_files and all(op.exists(f) for f in out_files):
+                done[(row['series_uid'], row['n_files'])] = out_files
+        return done
+
+    def add(self, series, folder, out_files):
+        """ Record the list of (series_uid, n_files) `series` converted from `folder` into `out_files`."""
+        finish_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        with closing(self._connect()) as conn:
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO conversions '
+                                 '(series_uid, n_files, folder, out_files, finish_time) '
+                                 'VALUES (?, ?, ?, ?, ?)',
+                                 [(uid, n_files, folder, json.dumps(out_files), finish_time)
+                                  for uid, n_files in series])
+
+    def __repr__(self):
+        return '<convert.ConversionManifest> ({})'.format(self.manifest_file)
+
+
+def plan_conversions(index, input_dir, output_dir, converted=None):
+    """ Return the list of DICOM folders of `index` under `input_dir` to convert, largest first.
+
+    The output of a folder `input_dir/<subj>/<session>/<acq>` is
+    `output_dir/<subj>/<session>/<acq>*.nii.gz`, as in the `dcm2nii` task of the examples.
+
+    Parameters
+    ----------
+    index: pypes.dicom_index.DicomIndex
+
+    input_dir: str
+        The base folder of the indexed DICOM files.
+
+    output_dir: str
+
+    converted: dict
+        The converted series, see `ConversionManifest.converted`.
+        Their folders and the folders with only copies of them are left out.
+        Each series is keyed with the number of files in the folder it is converted from.
+        The folders with other series are converted whole, copies included.
+
+    Returns
+    -------
+    tasks: list of dict
+        With the 'folder', 'n_files', 'series' as a list of (series_uid, n_files),
+        'out_dir' and 'out_name' of each conversion.
+    """
+    converted = converted or {}
+    # the index can also have the files of other trees
+    input_dir = op.abspath(input_dir)
+    prefix = op.join(input_dir, '')
+
+    folders = defaultdict(dict)
+    for rec in index.series():
+        for path in index.series_files(rec['series_uid']):
+            if not op.dirname(path).startswith(prefix):
+                continue
+            folder_series = folders[op.dirname(path)]
+            folder_series[rec['series_uid']] = folder_series.get(rec['series_uid'], 0) + 1
+
+    # a series is converted from the folder where it has the most files
+    series_folder = {}
+    for folder, series in sorted(folders.items()):
+        for uid, n_files in series.items():
+            if uid not in series_folder or n_files > folders[series_folder[uid]][uid]:
+                series_folder[uid] = folder
+
+    tasks = []
+    for folder, series in sorted(folders.items(), key=lambda item: -sum(item[1].values())):
+        keys = [(uid, n_files) for uid, n_files in sorted(series.items())
+                if series_folder[uid] == folder and (uid, n_files) not in converted]
+        if not keys:
+            continue
+
+        rel_dir = op.relpath(op.dirname(folder), input_dir)
+        tasks.append({'folder':   folder,
+                      'n_files':  sum(series.values()),
+                      'series':   keys,
+                      'out_dir':  op.normpath(op.join(output_dir, rel_dir)),
+                      'out_name': op.basename(folder)})
+    return tasks
+
+
+def dcm2niix_folder(folder, out_dir, out_name, args=('-b', 'y', '-z', 'y')):
+    """ Convert the DICOM files in `folder` with dcm2niix into `out_dir`.
+
+    The files are written in a temporary folder and moved to `out_dir` once
+    dcm2niix has finished, so an interrupted conversion leaves no partial output.
+
+    Parameters
+    ----------
+    folder: str
+
+    out_dir: str
+
+    out_name: str
+        The dcm2niix output file name, argument '-f'.
+
+    args: tuple of str
+        Other dcm2niix arguments.
+
+    Returns
+    -------
+    out_files: list of str
+    """
+    tmp_dir = op.join(out_dir, '.{}.tmp'.format(out_name))
+    if op.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    try:
+        cmd = ['dcm2niix'] + list(args) + ['-f', out_name, '-o', tmp_dir, folder]
+        log.debug('Calling {}.'.format(' '.join(cmd)))
+        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        out_files = []
+        for filename in sorted(os.listdir(tmp_dir)):
+            out_file = op.join(out_dir, filename)
+            os.replace(op.join(tmp_dir, filename), out_file)
+            out_files.append(out_file)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return out_files
+
+
+def convert_dicom_series(index, input_dir, output_dir, manifest_file='', n_jobs=None,
+                         converter=dcm2niix_folder):
+    """ Convert the DICOM series of `index` that have not been converted yet.
+
+    Parameters
+    ----------
+    index: pypes.dicom_index.DicomIndex
+
+    input_dir: str
+        The base folder of the indexed DICOM files.
+
+    output_dir: str
+
+    manifest_file: str
+        Path to the `ConversionManifest`.
+        If empty, `output_dir/.conversions.sqlite`.
+
+    n_jobs: int
+        Number of conversions at the same time. If None, the number of CPUs.
+
+    converter: function
+        Function with the signature of `dcm2niix_folder`.
+
+    Returns
+    -------
+    converted: list of str
+        The converted folders.
+
+    failed: list of 2-tuples
+        The folders that could not be converted and the error.
+    """
+    if not manifest_file:
+        manifest_file = op.join(output_dir, '.conversions.sqlite')
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+
+    manifest = ConversionManifest(manifest_file)
+    tasks = plan_conversions(index, input_dir, output_dir, converted=manifest.converted())
+    log.info('Converting {} DICOM folders with {} jobs.'.format(len(tasks), n_jobs))
+
+    def _convert(task):
+        os.makedirs(task['out_dir'], exist_ok=True)
+        return converter(task['folder'], task['out_dir'], task['out_name'])
+
+    converted, failed = [], []
+    with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+        futures = {pool.submit(_convert, task): task for task in tasks}
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                out_files = future.result()
+            except Exception as exc:
+                log.error('Could not convert {}: {}.'.format(task['folder'], exc))
+                failed.append((task['folder'], str(exc)))
+                continue
+
+            if not out_files:
+                log.error('dcm2niix did not write any file from {}.'.format(task['folder']))
+                failed.append((task['folder'], 'no output files'))
+                continue
+
+            manifest.add(task['series'], task['folder'], out_files)
+            converted.append(task['folder'])
+
+    return converted, failed
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Decompression of DICOM files with compressed transfer syntaxes, e.g. JPEG2000,
+which some converters do not support.
+
+Only the files whose transfer syntax is compressed are decoded, in a process pool.
+They are decoded with the pydicom pixel data handlers, or with 'gdcmconv --raw'
+if pydicom can not decode them.
+"""
+import os
+import os.path as op
+import subprocess
+import logging as log
+from   concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+def is_compressed(dcm_file):
+    """ Return True if the transfer syntax of `dcm_file` is compressed.
+    Only the file meta information is read."""
+    import pydicom
+
+    dcm = pydicom.dcmread(dcm_file, stop_before_pixels=True, specific_tags=[])
+    syntax = getattr(getattr(dcm, 'file_meta', None), 'TransferSyntaxUID', None)
+    return syntax is not None and syntax.is_compressed
+
+
+def _gdcmconv_raw(dcm_file, out_file):
+    """ Decompress `dcm_file` into `out_file` with 'gdcmconv --raw'."""
+    subprocess.run(['gdcmconv', '--raw', '-i', dcm_file, '-o', out_file],
+                   check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+def decompress_dicom(dcm_file):
+    """ Decompress the pixel data of `dcm_file` in place.
+
+    The decompressed file is written next to `dcm_file` and then replaces it,
+    so `dcm_file` is left as it was if the decompression fails.
+
+    Parameters
+    ----------
+    dcm_file: str
+
+    Returns
+    -------
+    dcm_file: str
+    """
+    import pydicom
+
+    tmp_file = op.join(op.dirname(dcm_file), '.{}.tmp'.format(op.basename(dcm_file)))
+    try:
+        try:
+            dcm = pydicom.dcmread(dcm_file)
+            dcm.decompress()
+            dcm.save_as(tmp_file)
+        except Exception as exc:
+            log.debug('pydicom could not decompress {}, using gdcmconv: {}.'.format(dcm_file, exc))
+            _gdcmconv_raw(dcm_file, tmp_file)
+        os.replace(tmp_file, dcm_file)
+    finally:
+        if op.exists(tmp_file):
+            os.remove(tmp_file)
+
+    return dcm_file
+
+
+def _try(func, path):
+    """ Return (path, result, None) or (path, None, error message) if `func(path)` fails."""
+    try:
+        return path, func(path), None
+    except Exception as exc:
+        return path, None, '{}: {}'.format(type(exc).__name__, exc)
+
+
+def _try_is_compressed(path):
+    return _try(is_compressed, path)
+
+
+def _try_decompress_dicom(path):
+    return _try(decompress_dicom, path)
+
+
+def decompress_dicoms(dcm_files, n_jobs=None):
+    """ Decompress in place the files of `dcm_files` with a compressed transfer syntax.
+
+    Parameters
+    ----------
+    dcm_files: list of str
+
+    n_jobs: int
+        Number of processes to decompress the files. If None, the number of CPUs.
+        The headers are read in twice as many threads.
+
+    Returns
+    -------
+    decompressed: list of str
+        The decompressed files.
+
+    failed: list of 2-tuples
+        The files that could not be read or decompressed and the error.
+    """
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, n_jobs)
+
+    compressed, failed = [], []
+    with ThreadPoolExecutor(max_workers=2 * n_jobs) as pool:
+        for path, is_comp, error in pool.map(_try_is_compressed, dcm_files):
+            if error is not None:
+                failed.append((path, error))
+            elif is_comp:
+                compressed.append(path)
+
+    log.info('Decompressing {} of {} DICOM files.'.format(len(compressed), len(dcm_files)))
+
+    decompressed = []
+    if compressed:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            for path, _, error in pool.map(_try_decompress_dicom, compressed, chunksize=16):
+                if error is not None:
+                    log.error('Could not decompress {}: {}.'.format(path, error))
+                    failed.append((path, error))
+                else:
+                    decompressed.append(path)
+
+    return decompressed, failed
@@ -8,6 +8,7 @@ from warnings import warn
 from hansel import Crumb
 
 from nipype.interfaces.base import (traits,
+                                    isdefined,
                                     DynamicTraitedSpec,
                                     Undefined, BaseInterfaceInputSpec)
 from nipype.interfaces.io import IOBase, add_traits
@@ -15,6 +16,7 @@ from nipype.utils.filemanip import list_to_filename
 from nipype.utils.misc import human_order_sorted
 
 from ._utils import get_values_map_keys
+from .crumb_index import CrumbIndex
 
 
 class DataCrumbInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
@@ -28,6 +30,8 @@ class DataCrumbInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
                                       "matches the template. Either a boolean that applies to all "
                                       "output fields or a list of output field names to coerce to "
                                       " a list"))
+    index_file = traits.Str(desc=('Path to a CrumbIndex sqlite file. If set, the file system listings '
+                                  'will be queried from this index instead of globbing.'))
 
 
 class DataCrumb(IOBase):
@@ -122,7 +126,13 @@ class DataCrumb(IOBase):
         if not ocrumb.isabs():
             raise ValueError('Expected a Crumb with an absolute path, got {}.'.format(ocrumb))
 
-        if not ocrumb.exists():
+        # use the persistent index, if given, to avoid walking the file system
+        index = None
+        if isdefined(self.inputs.index_file) and self.inputs.index_file:
+            index = CrumbIndex(self.inputs.index_file)
+
+        exists = index.exists(ocrumb) if index is not None else ocrumb.exists()
+        if not exists:
             raise IOError('Expected an existing Crumb path, got {}.'.format(ocrumb))
 
         # loop over all the ouput items and fill them with the info in templates
@@ -134,7 +144,8 @@ class DataCrumb(IOBase):
             if list(focrumb.open_args()):
                 raise ValueError('Expected a full specification of the Crumb path by now, got {}.'.format(focrumb))
 
-            filelist = [cr.path for cr in focrumb.unfold()]
+            unfolded = index.unfold(focrumb) if index is not None else focrumb.unfold()
+            filelist = [cr.path for cr in unfolded]
             # Handle the case where nothing matched
             if not filelist:
                 msg = "No files were found unfolding %s crumb path: %s" % (
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent index of hansel.Crumb argument values backed by sqlite.
+
+Each directory listing done to unfold a Crumb is stored together with the
+modification time of the listed directory. Following queries only list again
+the directories whose mtime changed, so the index builds once and then it is
+updated incrementally.
+"""
+import os
+import os.path as op
+import json
+import sqlite3
+from   contextlib import closing
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    crumb_path TEXT NOT NULL,
+    arg_name   TEXT NOT NULL,
+    dir_path   TEXT NOT NULL,
+    mtime_ns   INTEGER NOT NULL,
+    arg_values TEXT NOT NULL,
+    PRIMARY KEY (crumb_path, arg_name)
+);
+"""
+
+
+def _dir_mtime(dirpath):
+    """ Return the modification time of `dirpath` in nanoseconds or None if it does not exist."""
+    try:
+        return os.stat(dirpath).st_mtime_ns
+    except OSError:
+        return None
+
+
+class CrumbIndex(object):
+    """ Persistent index of the values of the crumb arguments found in the file system.
+
+    This class only keeps the path to the database, so it can be pickled
+    and used from within nipype nodes. A new connection is opened for each query.
+
+    Parameters
+    ----------
+    index_file: str
+        Path to the sqlite database file. It will be created if it does not exist.
+
+    timeout: float
+        Seconds to wait for the database lock when many processes use the same index.
+    """
+    def __init__(self, index_file, timeout=60.0):
+        self.index_file = op.abspath(op.expanduser(index_file))
+        self.timeout = timeout
+
+        index_dir = op.dirname(self.index_file)
+        if not op.exists(index_dir):
+            os.makedirs(index_dir)
+
+        with closing(self._connect()) as conn:
+            with conn:
+                conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.index_file, timeout=self.timeout)
+
+    def _arg_values(self, conn, crumb, arg_name):
+        """ Return the list of values for `arg_name`, which must be the first open argument
+        of `crumb`. Use the stored listing if the directory has not been modified since."""
+        dirpath = crumb.split()[0]
+        mtime = _dir_mtime(dirpath)
+        if mtime is None:
+            return []
+
+        row = conn.execute('SELECT mtime_ns, arg_values FROM listings '
+                           'WHERE crumb_path = ? AND arg_name = ?',
+                           (crumb.path, arg_name)).fetchone()
+        if row is not None and row[0] == mtime:
+            return json.loads(row[1])
+
+        values = list(crumb.ls(arg_name, fullpath=False, make_crumbs=False, check_exists=False))
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO listings '
+                         '(crumb_path, arg_name, dir_path, mtime_ns, arg_values) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (crumb.path, arg_name, dirpath, mtime, json.dumps(values)))
+        return values
+
+    def values_map(self, crumb, arg_name=''):
+        """ Return a list of lists of 2-tuples with the values of the open arguments
+        of `crumb`, from the first one until `arg_name`.
+        This is the indexed version of `hansel.Crumb.values_map`.
+
+        Parameters
+        ----------
+        crumb: hansel.Crumb
+            An absolute crumb path.
+
+        arg_name: str
+            If empty will pick the last open argument of the Crumb.
+
+        Returns
+        -------
+        values_map: list of lists of 2-tuples
+        """
+        if not crumb.isabs():
+            raise ValueError('Expected a Crumb with an absolute path, got {}.'.format(crumb))
+
+        open_args = list(crumb.open_args())
+        if not open_args:
+            return [list(crumb.arg_values.items())]
+
+        if not arg_name:
+            arg_name = open_args[-1]
+
+        if arg_name not in open_args:
+            raise KeyError('Could not find open argument {} in {}.'.format(arg_name, crumb))
+
+        records = [[]]
+        with closing(self._connect()) as conn:
+            for arg in open_args[:open_args.index(arg_name) + 1]:
+                nurecords = []
+                for rec in records:
+                    partial = crumb.replace(**dict(rec)) if rec else crumb
+                    nurecords.extend([rec + [(arg, val)]
+                                      for val in self._arg_values(conn, partial, arg)])
+                records = nurecords
+
+        return sorted(records)
+
+    def joint_value_map(self, crumb, arg_names):
+        """ Return a sorted list of tuples of 2-tuples with the values of `arg_names`
+        that lead to existing paths of `crumb`.
+        This is the indexed version of `hansel.utils.joint_value_map`.
+
+        Unlike hansel, the values are taken from the full paths of `crumb`, listed down to
+        its last open argument, so a combination of values is returned only if at least one
+        complete path exists with it. For example, with '{subj}/{session}/anat.nii', a subject
+        folder without any 'anat.nii' is left out, even if `arg_names` is only ['subj'].
+
+        Parameters
+        ----------
+        crumb: hansel.Crumb
+
+        arg_names: list of str
+
+        Returns
+        -------
+        values_map: list of tuples of 2-tuples
+        """
+        records = [dict(rec) for rec in self.values_map(crumb)]
+        return sorted(set(tuple((name, rec[name]) for name in arg_names)
+                          for rec in records))
+
+    def unfold(self, crumb):
+        """ Return a list of the existing paths of `crumb` as Crumbs with all
+        its arguments replaced. This is the indexed version of `hansel.Crumb.unfold`.
+        As in hansel, if `crumb` has no open arguments it is returned as it is."""
+        if not list(crumb.open_args()):
+            return [crumb]
+
+        crumbs = [crumb.replace(**dict(rec)) for rec in self.values_map(crumb)]
+        return sorted([cr for cr in crumbs if op.exists(cr.path) or op.islink(cr.path)])
+
+    def exists(self, crumb):
+        """ Return True if `crumb` has any existing path, False otherwise."""
+        if not list(crumb.open_args()):
+            return op.exists(crumb.path) or op.islink(crumb.path)
+
+        if not op.exists(crumb.split()[0]):
+            return False
+
+        return len(self.values_map(crumb)) > 0
+
+    def clear(self, crumb=None):
+        """ Remove the stored listings under the base directory of `crumb`.
+        If `crumb` is None will remove all the listings in the index."""
+        with closing(self._connect()) as conn:
+            with conn:
+                if crumb is None:
+                    conn.execute('DELETE FROM listings')
+                else:
+                    # LIKE would take '_' and '%' in the paths for wildcards
+                    basedir = crumb.split()[0]
+                    prefix = op.join(basedir, '')
+                    conn.execute('DELETE FROM listings WHERE dir_path = ? OR substr(dir_path, 1, ?) = ?',
+                                 (basedir, len(prefix), prefix))
+
+    def __repr__(self):
+        return '<crumb_index.CrumbIndex> ({})'.format(self.index_file)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+A nipype.DataSink that can hardlink, reflink or move the outputs instead of copying them.
+"""
+import os
+import os.path as op
+import errno
+import shutil
+import logging as log
+
+from nipype.interfaces.base import traits, isdefined
+from nipype.interfaces.io import DataSink, DataSinkInputSpec, copytree
+from nipype.utils.filemanip import copyfile
+
+from .config import get_config_setting
+
+# Linux ioctl request code to clone a file, as in `cp --reflink`
+_FICLONE = 0x40049409
+
+LINK_MODES = ('copy', 'hardlink', 'reflink', 'move')
+
+
+def _same_device(src, dst_dir):
+    """ Return True if `src` and the folder `dst_dir` are in the same file system."""
+    return os.stat(src).st_dev == os.stat(dst_dir).st_dev
+
+
+def _is_same_file(src, dst):
+    """ Return True if `dst` exists and is the same file as `src`."""
+    return op.exists(dst) and op.samefile(src, dst)
+
+
+def _remove_if_exists(path):
+    if op.lexists(path):
+        os.remove(path)
+
+
+def _reflink(src, dst):
+    """ Clone `src` into `dst` sharing the data blocks. Raise an OSError if the
+    file system does not support it."""
+    import fcntl
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def link_or_copy(src, dst, link_mode='copy'):
+    """ Put the file `src` in `dst` using `link_mode` if `src` and `dst` share
+    the file system, otherwise copy it.
+
+    Parameters
+    ----------
+    src: str
+        Path to the source file.
+
+    dst: str
+        Path to the destination file. Its folder must exist.
+
+    link_mode: str
+        Choices: 'copy', 'hardlink', 'reflink', or 'move'.
+        With 'move', a symbolic link to `dst` is left in `src`, so the nipype
+        working directory is still valid for caching.
+
+    Returns
+    -------
+    link_mode: str
+        The method that has been finally used.
+    """
+    if link_mode not in LINK_MODES:
+        raise ValueError('Expected one of {} for `link_mode`, got {}.'.format(LINK_MODES, link_mode))
+
+    if _is_same_file(src, dst):
+        return link_mode
+
+    if link_mode != 'copy' and _same_device(src, op.dirname(dst)):
+        try:
+            if link_mode == 'hardlink':
+                _remove_if_exists(dst)
+                os.link(src, dst)
+            elif link_mode == 'reflink':
+                _remove_if_exists(dst)
+                _reflink(src, dst)
+            elif link_mode == 'move':
+                _remove_if_exists(dst)
+                os.rename(src, dst)
+                os.symlink(dst, src)
+            return link_mode
+        except OSError as exc:
+            if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP,
+                                 errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY):
+                raise
+            log.debug('Could not {} {} to {}, copying it instead: {}.'.format(link_mode, src, dst, exc))
+
+    copyfile(src, dst, copy=True, hashmethod='content')
+    return 'copy'
+
+
+class LinkDataSinkInputSpec(DataSinkInputSpec):
+    link_mode = traits.Enum(*LINK_MODES, usedefault=True,
+                            desc=('How to put the files in the output folder: "copy", "hardlink", '
+                                  '"reflink" or "move". If the source and destination are not in '
+                                  'the same file system, the files will be copied.'))
+
+
+class LinkDataSink(DataSink):
+    """ A nipype DataSink that can hardlink, reflink or move the output files
+    instead of copying them. The `substitutions` and `regexp_substitutions`
+    work the same way as in DataSink.
+
+    The default value for `link_mode` is taken from the `datasink_link_mode`
+    configuration setting. If it is 'copy', this works exactly as DataSink.
+    """
+    input_spec = LinkDataSinkInputSpec
+
+    def __init__(self, infields=None, force_run=True, **kwargs):
+        link_mode = kwargs.pop('link_mode', get_config_setting('datasink_link_mode', default='copy'))
+        super(LinkDataSink, self).__init__(infields=infields, force_run=force_run, **kwargs)
+        self.inputs.link_mode = link_mode
+
+    def _list_outputs(self):
+        base_dir = self.inputs.base_directory
+        is_s3 = isdefined(base_dir) and str(base_dir).lower().startswith('s3://')
+        if self.inputs.link_mode == 'copy' or is_s3 or isdefined(self.inputs.local_copy):
+            return super(LinkDataSink, self)._list_outputs()
+
+        outputs = self.output_spec().get()
+        out_files = []
+
+        outdir = base_dir if isdefined(base_dir) else '.'
+        if isdefined(self.inputs.container):
+            outdir = op.join(outdir, self.inputs.container)
+        outdir = op.abspath(outdir)
+        os.makedirs(outdir, exist_ok=True)
+
+        for key, files in list(self.inputs._outputs.items()):
+            if not isdefined(files):
+                continue
+
+            tempoutdir = outdir
+            for d in key.split('.'):
+                if d[0] == '@':
+                    continue
+                tempoutdir = op.join(tempoutdir, d)
+
+            # flattening list
+            if not isinstance(files, list):
+                files = [files]
+            if files and isinstance(files[0], list):
+                files = [item for sublist in files for item in sublist]
+
+            for src in files:
+                src = op.abspath(src)
+                if not op.isfile(src):
+                    src = op.join(src, '')
+
+                dst = self._substitute(op.join(tempoutdir, self._get_dst(src)))
+                os.makedirs(op.dirname(dst), exist_ok=True)
+
+                if op.isfile(src):
+                    link_or_copy(src, dst, link_mode=self.inputs.link_mode)
+                    out_files.append(dst)
+                elif op.isdir(src):
+                    if op.exists(dst) and self.inputs.remove_dest_dir:
+                        shutil.rmtree(dst)
+                    copytree(src, dst)
+                    out_files.append(dst)
+
+        outputs['out_file'] = out_files
+        return outputs
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent index of the DICOM series of a crumb tree backed by sqlite.
+
+The DICOM files are the paths of a Crumb whose last argument is the file name.
+Their headers are read in a thread pool without the pixel data, and only a
+selected set of tags is kept for each series. Each file is stored with its size
+and modification time, so a new scan only reads the new or modified files.
+The files also keep the crumb pattern of the scan that found them, so a scan
+only removes the missing files of its own crumb pattern.
+"""
+import os
+import os.path as op
+import json
+import sqlite3
+import logging as log
+from   contextlib import closing
+from   concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_TAGS = ('PatientID',
+                'PatientName',
+                'StudyInstanceUID',
+                'StudyDate',
+                'SeriesNumber',
+                'SeriesDescription',
+                'ProtocolName',
+                'Modality',
+                'Manufacturer',
+                'AcquisitionDate',
+                'RepetitionTime',
+                'EchoTime',
+                'SliceThickness',
+                'Rows',
+                'Columns',
+                'TransferSyntaxUID',
+                )
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path       TEXT PRIMARY KEY,
+    mtime_ns   INTEGER NOT NULL,
+    size       INTEGER NOT NULL,
+    series_uid TEXT,
+    crumb      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_series ON files (series_uid);
+CREATE TABLE IF NOT EXISTS series (
+    series_uid   TEXT PRIMARY KEY,
+    folder       TEXT NOT NULL,
+    crumb_values TEXT NOT NULL,
+    tags         TEXT NOT NULL
+);
+"""
+
+
+def _tag_value(value):
+    """ Return the pydicom element `value` as a JSON serializable value."""
+    if isinstance(value, bytes):
+        return None
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, str):
+        return str(value)
+    try:
+        return [_tag_value(val) for val in value]
+    except TypeError:
+        return str(value)
+
+
+def read_dicom_tags(dcm_file, tags=DEFAULT_TAGS):
+    """ Return the SeriesInstanceUID and the values of `tags` of `dcm_file`,
+    reading only its header.
+
+    Parameters
+    ----------
+    dcm_file: str
+
+    tags: list of str
+        DICOM keywords. The ones of the file meta information, such as
+        'TransferSyntaxUID', can also be used.
+
+    Returns
+    -------
+    series_uid: str
+        None if `dcm_file` is not a DICOM file.
+
+    values: dict
+        The values of the `tags` found in `dcm_file`.
+    """
+    import pydicom
+
+    try:
+        dcm = pydicom.dcmread(dcm_file, stop_before_pixels=True,
+                              specific_tags=['SeriesInstanceUID'] + list(tags))
+    except Exception as exc:
+        log.debug('Could not read the DICOM file {}: {}.'.format(dcm_file, exc))
+        return None, {}
+
+    series_uid = getattr(dcm, 'SeriesInstanceUID', None)
+    if series_uid is None:
+        return None, {}
+
+    values = {}
+    file_meta = getattr(dcm, 'file_meta', None)
+    for tag in tags:
+        value = getattr(dcm, tag, None)
+        if value is None and file_meta is not None:
+            value = getattr(file_meta, tag, None)
+        if value is not None:
+            values[tag] = _tag_value(value)
+
+    return str(series_uid), values
+
+
+class DicomIndex(object):
+    """ Persistent index of the DICOM series found in a crumb tree.
+
+    This class only keeps the path to the database, so it can be pickled
+    and used from within nipype nodes. A new connection is opened for each query.
+
+    Parameters
+    ----------
+    index_file: str
+        Path to the sqlite database file. It will be created if it does not exist.
+
+    tags: list of str
+        The DICOM keywords to store for each series.
+
+    timeout: float
+        Seconds to wait for the database lock.
+
+    Example
+    -------
+    from hansel import Crumb
+    index = DicomIndex('~/data/dicom_index.sqlite')
+    index.scan(Crumb('/home/hansel/data/{subj_id}/{session}/{acq}/{dcm_file}'), n_jobs=8)
+    pd.DataFrame(index.series(Modality='MR'))
+    """
+    def __init__(self, index_file, tags=DEFAULT_TAGS, timeout=60.0):
+        self.index_file = op.abspath(op.expanduser(index_file))
+        self.tags = list(tags)
+        self.timeout = timeout
+
+        index_dir = op.dirname(self.index_file)
+        if not op.exists(index_dir):
+            os.makedirs(index_dir)
+
+        with closing(self._connect()) as conn:
+            with conn:
+                conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.index_file, timeout=self.timeout)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _read_file(self, path, known):
+        """ Return the record of `path` or None if it is unchanged since it was indexed."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        if known.get(path) == (stat.st_mtime_ns, stat.st_size):
+            return None
+
+        series_uid, values = read_dicom_tags(path, self.tags)
+        return path, stat.st_mtime_ns, stat.st_size, series_uid, values
+
+    def _store(self, conn, records, crumb_values, crumb_path):
+        """ Insert the file `records` found with the crumb pattern `crumb_path`
+        and add their tags to the ones of their series."""
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO files (path, mtime_ns, size, series_uid, crumb) '
+                             'VALUES (?, ?, ?, ?, ?)', [rec[:4] + (crumb_path,) for rec in records])
+
+            for path, _, _, series_uid, values in records:
+                if series_uid is None:
+                    continue
+                row = conn.execute('SELECT tags FROM series WHERE series_uid = ?', (series_uid,)).fetchone()
+                if row is not None:
+                    tags = json.loads(row['tags'])
+                    if all(tags.get(tag) == value for tag, value in values.items()):
+                        continue
+                    tags.update(values)
+                    conn.execute('UPDATE series SET tags = ? WHERE series_uid = ?',
+                                 (json.dumps(tags), series_uid))
+                else:
+                    conn.execute('INSERT INTO series (series_uid, folder, crumb_values, tags) '
+                                 'VALUES (?, ?, ?, ?)',
+                                 (series_uid, op.dirname(path),
+                                  json.dumps(crumb_values[path]), json.dumps(values)))
+
+    def scan(self, crumb, n_jobs=4, batch_size=1000, crumb_index_file='', rescan=False):
+        """ Index the DICOM files of `crumb`, reading only the files that are not indexed
+        or have been modified since. The files indexed with the same crumb pattern that
+        do not exist anymore are removed.
+
+        Parameters
+        ----------
+        crumb: hansel.Crumb
+            An absolute crumb path whose last argument is the DICOM file name, e.g.,
+            /home/hansel/data/{subj_id}/{session}/{acq}/{dcm_file}
+
+        n_jobs: int
+            Number of threads to read the files.
+
+        batch_size: int
+            Number of files stored in the database at once. An interrupted scan
+            keeps the batches already stored.
+
+        crumb_index_file: str
+            Path to a `pypes.crumb_index.CrumbIndex` to list the crumb tree.
+            If empty, will use the `crumb_index_file` configuration setting.
+            If that is also empty, the file system will be walked.
+
+        rescan: bool
+            If True, will read again all the files, e.g., to store new `tags`.
+
+        Returns
+        -------
+        n_read: int
+            Number of files read.
+        """
+        from .config import get_config_setting
+        from .crumb_index import CrumbIndex
+
+        if not crumb.isabs():
+            raise ValueError('Expected a Crumb with an absolute path, got {}.'.format(crumb))
+
+        if not crumb_index_file:
+            crumb_index_file = get_config_setting('crumb_index_file', default='')
+
+        open_args = list(crumb.open_args())
+        crumbs = CrumbIndex(crumb_index_file).unfold(crumb) if crumb_index_file else crumb.unfold()
+
+        crumb_values = {cr.path: {arg: cr.arg_values[arg] for arg in open_args[:-1]}
+                        for cr in crumbs}
+
+        # the files under the base directory, a plain prefix comparison as LIKE
+        # would take '_' and '%' in the paths for wildcards and ignore the case
+        prefix = op.join(crumb.split()[0], '')
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT path, mtime_ns, size, crumb FROM files '
+                                'WHERE substr(path, 1, ?) = ?', (len(prefix), prefix)).fetchall()
+            known = {row['path']: (row['mtime_ns'], row['size']) for row in rows}
+
+            removed = [(row['path'],) for row in rows
+                       if row['crumb'] == crumb.path and row['path'] not in crumb_values]
+            if rescan:
+                known = {}
+            with conn:
+                conn.executemany('DELETE FROM files WHERE path = ?', removed)
+
+            paths = sorted(crumb_values)
+            n_read = 0
+            with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+                for start in range(0, len(paths), batch_size):
+                    batch = paths[start:start + batch_size]
+                    records = [rec for rec in pool.map(lambda path: self._read_file(path, known), batch)
+                               if rec is not None]
+                    self._store(conn, records, crumb_values, crumb.path)
+                    n_read += len(records)
+
+            with conn:
+                conn.execute('DELETE FROM series WHERE series_uid NOT IN '
+                             '(SELECT DISTINCT series_uid FROM files WHERE series_uid IS NOT NULL)')
+
+        log.info('Indexed {} DICOM files of {}, {} read and {} removed.'.format(len(paths), crumb,
+                                                                               n_read, len(removed)))
+        return n_read
+
+    def series(self, **tag_values):
+        """ Return a list of dicts with the indexed series, their crumb argument values,
+        number of files and stored tags. They can be filtered by crumb argument
+        or tag values, e.g., `index.series(subj_id='subj01', Modality='MR')`."""
+        query = ('SELECT series.*, COUNT(files.path) AS n_files FROM series '
+                 'JOIN files ON files.series_uid = series.series_uid '
+                 'GROUP BY series.series_uid ORDER BY series.folder')
+
+        records = []
+        with closing(self._connect()) as conn:
+            for row in conn.execute(query):
+                rec = {'series_uid': row['series_uid'],
+                       'folder':     row['folder'],
+                       'n_files':    row['n_files']}
+                rec.update(json.loads(row['crumb_values']))
+                rec.update(json.loads(row['tags']))
+                if all(rec.get(name) == value for name, value in tag_values.items()):
+                    records.append(rec)
+        return records
+
+    def series_files(self, series_uid):
+        """ Return the sorted list of the indexed files of the series `series_uid`."""
+        with closing(self._connect()) as conn:
+            return [row['path'] for row in conn.execute('SELECT path FROM files WHERE series_uid = ? '
+                                                        'ORDER BY path', (series_uid,))]
+
+    def __repr__(self):
+        return '<dicom_index.DicomIndex> ({})'.format(self.index_file)
@@ -6,6 +6,7 @@ import os.path as op
 
 import nipype.pipeline.engine as pe
 from   nipype.interfaces.fsl import BET, ExtractROI
+from   nipype.interfaces.base import isdefined
 from   nipype.interfaces.utility import Function, IdentityInterface
 from   nipype.workflows.dmri.fsl.utils import eddy_rotate_bvecs, b0_average, b0_indices
 from   nipype.workflows.dmri.fsl import hmc_pipeline
@@ -123,9 +124,11 @@ def dti_artifact_correction(wf_name="dti_artifact_correction"):
 
     # resample
     resample = setup_node(Function(function=reslice,
-                                   input_names=['in_file', 'new_zooms', 'order', 'out_file'],
+                                   input_names=['in_file', 'new_zooms', 'order', 'out_file', 'n_jobs'],
                                    output_names=['out_file']),
                           name='dti_reslice')
+    if isdefined(resample.inputs.n_jobs):
+        resample.n_procs = max(resample.n_procs, resample.inputs.n_jobs)
 
     ## extract first b0 for Eddy and HMC brain mask
     list_b0 = pe.Node(Function(function=b0_indices,
@@ -179,9 +182,11 @@ def dti_artifact_correction(wf_name="dti_artifact_correction"):
     apply_nlmeans = get_config_setting("dmri.apply_nlmeans", True)
     if apply_nlmeans:
         nlmeans = setup_node(Function(function=nlmeans_denoise,
-                                      input_names=['in_file', 'mask_file', 'out_file', 'N'],
+                                      input_names=['in_file', 'mask_file', 'out_file', 'N', 'n_jobs'],
                                       output_names=['out_file']),
                              name='nlmeans_denoise')
+        if isdefined(nlmeans.inputs.n_jobs):
+            nlmeans.n_procs = max(nlmeans.n_procs, nlmeans.inputs.n_jobs)
 
     # output interface
     dti_output = setup_node(IdentityInterface(fields=out_fields),
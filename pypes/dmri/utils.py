@@ -16,15 +16,16 @@ def rapidart_dti_artifact_detection():
     return art
 
 
-def nlmeans_denoise(in_file, mask_file, out_file='', N=12):
-    """ Filepath interface to the nlmeans_denoise_img in pypes.preproc."""
+def nlmeans_denoise(in_file, mask_file, out_file='', N=12, n_jobs=1):
+    """ Filepath interface to the nlmeans_denoise_img in pypes.preproc.
+    With `n_jobs` > 1 the volumes are denoised in a pool of processes."""
     import os.path as op
     import nibabel as nib
 
     from pypes.preproc import nlmeans_denoise_img
     from pypes.utils import rename
 
-    den = nlmeans_denoise_img(nib.load(in_file), mask=nib.load(mask_file), N=N)
+    den = nlmeans_denoise_img(nib.load(in_file), mask=nib.load(mask_file), N=N, n_jobs=n_jobs)
 
     if not out_file:
         out_file = rename(in_file, '_denoised')
@@ -34,23 +35,20 @@ def nlmeans_denoise(in_file, mask_file, out_file='', N=12):
     return op.abspath(out_file)
 
 
-def reslice(in_file, new_zooms=None, order=3, out_file=''):
+def reslice(in_file, new_zooms=None, order=3, out_file='', n_jobs=1):
     """
     Performs regridding of an image to set isotropic voxel sizes using dipy.
+    With `n_jobs` > 1 the volumes are resliced in a pool of processes.
     """
     import os.path as op
 
-    import nibabel as nib
-
-    from pypes.preproc import reslice_img
+    from pypes.preproc import reslice_file
     from pypes.utils import rename
 
-    img = reslice_img(nib.load(in_file), new_zooms=new_zooms, order=order)
-
     if not out_file:
         out_file = rename(in_file, '_resliced')
 
-    img.to_filename(out_file)
+    reslice_file(in_file, out_file, new_zooms=new_zooms, order=order, n_jobs=n_jobs)
 
     return op.abspath(out_file)
 
@@ -10,11 +10,11 @@ from   nipype.interfaces.nipy.preprocess import Trim, ComputeMask
 from   nipype.interfaces.utility import Function, Select, IdentityInterface
 from   pypes.interfaces.nilearn import mean_img, smooth_img
 
-from   .filter import bandpass_filter
 from   .nuisance import rest_noise_filter_wf
 from   .._utils import format_pair_list, flatten_list
 from   ..config import setup_node, get_config_setting
 from   ..preproc import (auto_spm_slicetime,
+                         auto_slicetime,
                          nipy_motion_correction,
                          spm_coregister,
                          )
@@ -33,9 +33,8 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
     Tasks:
     - Trim first 6 volumes of the rs-fMRI file.
     - Slice Timing correction.
-    - Motion and nuisance correction.
+    - Motion and nuisance correction and bandpass frequency filtering in one step.
     - Calculate brain mask in fMRI space.
-    - Bandpass frequency filtering for resting-state fMRI.
     - Smoothing.
     - Tissue maps co-registration to fMRI space.
 
@@ -68,6 +67,7 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
 
     rest_output.nuis_corrected: traits.File
         The nuisance corrected fMRI file.
+        Only if 'signal_clean.save_stages' is True.
 
     rest_output.motion_params: traits.File
         The affine transformation file.
@@ -160,7 +160,10 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
     # rs-fMRI preprocessing nodes
     trim    = setup_node(Trim(), name="trim")
 
-    stc_wf  = auto_spm_slicetime()
+    if get_config_setting('stc_engine', default='spm') == 'numpy':
+        stc_wf = auto_slicetime()
+    else:
+        stc_wf = auto_spm_slicetime()
     realign = setup_node(nipy_motion_correction(), name='realign')
 
     # average
@@ -191,15 +194,6 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
     wm_select  = setup_node(Select(index=[1]), name="wm_sel")
     csf_select = setup_node(Select(index=[2]), name="csf_sel")
 
-    # bandpass filtering
-    bandpass = setup_node(Function(input_names=['files',
-                                                'lowpass_freq',
-                                                'highpass_freq',
-                                                'tr'],
-                                   output_names=['out_files'],
-                                   function=bandpass_filter),
-                          name='bandpass')
-
     # smooth
     smooth = setup_node(Function(function=smooth_img,
                                  input_names=["in_file", "fwhm"],
@@ -254,13 +248,11 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
                 (realign,       noise_wf,   [("par_file",             "rest_noise_input.motion_params",)]),
 
                 # temporal filtering
-                (noise_wf,    bandpass,    [("rest_noise_output.nuis_corrected", "files")]),
-                #(realign,     bandpass,    [("out_file", "files")]),
-                (stc_wf,      bandpass,    [("stc_output.time_repetition", "tr")]),
-                (rest_input,  bandpass,    [("lowpass_freq",               "lowpass_freq"),
-                                            ("highpass_freq",              "highpass_freq"),
+                (stc_wf,      noise_wf,    [("stc_output.time_repetition", "rest_noise_input.tr")]),
+                (rest_input,  noise_wf,    [("lowpass_freq",               "rest_noise_input.lowpass_freq"),
+                                            ("highpass_freq",              "rest_noise_input.highpass_freq"),
                                            ]),
-                (bandpass,     smooth,     [("out_files", "in_file")]),
+                (noise_wf,    smooth,      [("rest_noise_output.time_filtered", "in_file")]),
 
                 # output
                 (epi_mask,    rest_output, [("brain_mask", "epi_brain_mask")]),
@@ -275,6 +267,7 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
                                             ("rest_noise_output.compcor_regressors",     "compcor_regressors"),
                                             ("rest_noise_output.gsr_regressors",         "gsr_regressors"),
                                             ("rest_noise_output.nuis_corrected",         "nuis_corrected"),
+                                            ("rest_noise_output.time_filtered",          "time_filtered"),
                                             ("rest_noise_output.tsnr_file",              "tsnr_file"),
                                             ("rest_noise_output.art_displacement_files", "art_displacement_files"),
                                             ("rest_noise_output.art_intensity_files",    "art_intensity_files"),
@@ -284,7 +277,6 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
                                             ("rest_noise_output.art_statistic_files",    "art_statistic_files"),
                                            ]),
                 (average,     rest_output, [("out_file",  "avg_epi")]),
-                (bandpass,    rest_output, [("out_files", "time_filtered")]),
                 (smooth,      rest_output, [("out_file",  "smooth")]),
               ])
 
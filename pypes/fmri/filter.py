@@ -2,9 +2,328 @@
 """
 fMRI timeseries filtering helpers.
 """
+import os
+import os.path as op
 
+import numpy as np
+import scipy.fft
+import nibabel as nib
+from   nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                      TraitedSpec, File, InputMultiPath,
+                                      traits, isdefined)
+from   nipype.utils.filemanip import split_filename
 
-def bandpass_filter(files, lowpass_freq=0.1, highpass_freq=0.01, tr=2):
+from   ..preproc.regress import (masked_timeseries,
+                                 write_masked_timeseries,
+                                 read_design,
+                                 read_nuisance_data,
+                                 run_nuisance_stages)
+
+
+def bandpass_bins(n_timepoints, lowpass_freq=0.1, highpass_freq=0.01, tr=2):
+    """ Return the boolean mask of the real FFT frequency bins kept by the bandpass filter.
+
+    Parameters
+    ----------
+    n_timepoints: int
+        Number of volumes.
+
+    lowpass_freq: float
+        Cutoff frequency for the low pass filter (in Hz). If 0, there is no low pass filter.
+
+    highpass_freq: float
+        Cutoff frequency for the high pass filter (in Hz). If 0, there is no high pass filter.
+
+    tr: float
+        The repetition time in seconds.
+
+    Returns
+    -------
+    bins: np.ndarray
+        Boolean array of shape (n_timepoints // 2 + 1,).
+    """
+    fs = 1./tr
+    n_bins = n_timepoints // 2 + 1
+
+    lowidx = n_bins
+    if lowpass_freq > 0:
+        lowidx = int(np.round(float(lowpass_freq) / fs * n_timepoints))
+
+    highidx = 0
+    if highpass_freq > 0:
+        highidx = int(np.round(float(highpass_freq) / fs * n_timepoints))
+
+    bins = np.zeros(n_bins, dtype=bool)
+    bins[highidx:lowidx] = True
+    return bins
+
+
+def bandpass_timeseries(data, bins, columns=None, chunk_size=20000):
+    """ Bandpass filter in place the timeseries in the columns of `data`.
+
+    The real FFT is computed along the time axis only, in chunks of `chunk_size`
+    voxels and in the precision of `data`, i.e., float32 data is transformed in
+    single precision.
+
+    Parameters
+    ----------
+    data: np.ndarray
+        Array of shape (n_timepoints, n_voxels).
+
+    bins: np.ndarray
+        The frequency bins to keep, see `bandpass_bins`.
+
+    columns: np.ndarray
+        Indices of the voxels to filter. All of them by default.
+
+    chunk_size: int
+        Number of voxels to process at once.
+
+    Returns
+    -------
+    data: np.ndarray
+    """
+    if columns is None:
+        columns = np.arange(data.shape[1])
+
+    n_timepoints = data.shape[0]
+    chunk_size = max(1, int(chunk_size))
+    for start in range(0, len(columns), chunk_size):
+        cols = columns[start:start + chunk_size]
+        spectrum = scipy.fft.rfft(data[:, cols], axis=0)
+        spectrum[~bins] = 0
+        data[:, cols] = scipy.fft.irfft(spectrum, n=n_timepoints, axis=0)
+    return data
+
+
+def bandpass_img(in_file, out_file, lowpass_freq=0.1, highpass_freq=0.01, tr=2,
+                 mask_file=None, chunk_size=20000):
+    """ Bandpass filter the timeseries of the 4D image `in_file` and save it in `out_file`
+    with the same data type.
+
+    The voxels outside `mask_file` are 0 in the output. Without a mask, all
+    the voxels are kept and the ones that are always 0 are not filtered.
+
+    Parameters
+    ----------
+    in_file: str
+        Path to the 4D image.
+
+    out_file: str
+        Path to the output file.
+
+    lowpass_freq: float
+        Cutoff frequency for the low pass filter (in Hz).
+
+    highpass_freq: float
+        Cutoff frequency for the high pass filter (in Hz).
+
+    tr: float
+        The repetition time in seconds.
+
+    mask_file: str
+        Path to the brain mask image.
+
+    chunk_size: int
+        Number of voxels to process at once.
+
+    Returns
+    -------
+    out_file: str
+    """
+    img = nib.load(in_file, mmap=True)
+
+    if mask_file:
+        mask = np.asanyarray(nib.load(mask_file).dataobj) > 0
+    else:
+        mask = np.ones(img.shape[:3], dtype=bool)
+
+    data = masked_timeseries(in_file, mask)
+    bins = bandpass_bins(data.shape[0], lowpass_freq=lowpass_freq,
+                         highpass_freq=highpass_freq, tr=tr)
+
+    if not np.all(bins):
+        columns = np.flatnonzero(np.any(data != 0, axis=0))
+        bandpass_timeseries(data, bins, columns=columns, chunk_size=chunk_size)
+
+    return write_masked_timeseries(data, mask, img, out_file, dtype=None)
+
+
+def polynomial_regressors(n_timepoints, order):
+    """ Return the Legendre polynomials from order 1 to `order` sampled in
+    `n_timepoints`, as an array of shape (n_timepoints, order)."""
+    x = np.linspace(-1, 1, n_timepoints)
+    return np.polynomial.legendre.legvander(x, order)[:, 1:]
+
+
+def signal_clean(in_file, brain_mask, confounds='', compcor_masks=None, compcor_components=5,
+                 gsr_components=0, detrend_order=0, lowpass_freq=0., highpass_freq=0., tr=None,
+                 save_stages=False, chunk_size=20000, out_dir=''):
+    """ Detrend, regress out the confounds and bandpass filter `in_file` keeping
+    the data in memory as a (n_volumes, n_voxels) array of the masked voxels.
+
+    The image is read once and written once. The polynomial trends are regressed
+    together with the `confounds`, then the CompCor and GSR components are regressed
+    as in `pypes.preproc.regress.nuisance_stages`, and finally the timeseries are
+    bandpass filtered as in `bandpass_img`.
+
+    Parameters
+    ----------
+    in_file: str
+        Path to the 4D fMRI image.
+
+    brain_mask: str
+        Path to the brain mask image. The output images are 0 outside of it.
+
+    confounds: str
+        Path to the text file with the confound regressors in columns,
+        e.g., the motion and artifact regressors.
+
+    compcor_masks: list of str
+        Paths to the tissue masks for CompCor. If empty, CompCor is not applied.
+
+    compcor_components: int
+        Number of CompCor components for each mask.
+
+    gsr_components: int
+        Number of global signal components. If 0, GSR is not applied.
+
+    detrend_order: int
+        Order of the polynomial trends to regress out. The mean is always removed.
+
+    lowpass_freq: float
+        Cutoff frequency for the low pass filter (in Hz). If 0, there is no low pass filter.
+
+    highpass_freq: float
+        Cutoff frequency for the high pass filter (in Hz). If 0, there is no high pass filter.
+
+    tr: float
+        The repetition time in seconds. Needed for the bandpass filter.
+
+    save_stages: bool
+        If True, also write the residual image of each regression stage.
+
+    chunk_size: int
+        Number of voxels to process at once.
+
+    out_dir: str
+        Output folder. The current working directory by default.
+
+    Returns
+    -------
+    outputs: dict
+        With the paths of 'out_file', 'nuis_corrected', 'motion_res', 'compcor_res',
+        'compcor_regressors' and 'gsr_regressors', if they were written.
+        The name of 'out_file' ends with '_bandpassed' only if it was bandpass filtered,
+        otherwise it is the same file as 'nuis_corrected'.
+    """
+    out_dir = out_dir or os.getcwd()
+    _, name, ext = split_filename(in_file)
+    ref_img = nib.load(in_file, mmap=True)
+
+    data, brain, in_brain, in_tissues = read_nuisance_data(in_file, brain_mask, compcor_masks)
+    n_timepoints = data.shape[0]
+
+    design = read_design(confounds) if confounds else np.zeros((n_timepoints, 0))
+    if detrend_order > 0:
+        design = np.hstack([design, polynomial_regressors(n_timepoints, detrend_order)])
+
+    def _write(suffix):
+        out_file = op.join(out_dir, name + suffix + ext)
+        return write_masked_timeseries(data[:, in_brain], brain, ref_img, out_file)
+
+    outputs, suffix = run_nuisance_stages(data, design, in_brain, in_tissues,
+                                          write_stage=_write,
+                                          compcor_components=compcor_components,
+                                          gsr_components=gsr_components,
+                                          save_stages=save_stages,
+                                          chunk_size=chunk_size,
+                                          out_dir=out_dir)
+    if lowpass_freq > 0 or highpass_freq > 0:
+        if not tr:
+            raise ValueError('The repetition time is needed for the bandpass filter, got {}.'.format(tr))
+
+        if save_stages:
+            outputs['nuis_corrected'] = _write(suffix)
+
+        bins = bandpass_bins(n_timepoints, lowpass_freq=lowpass_freq,
+                             highpass_freq=highpass_freq, tr=tr)
+        bandpass_timeseries(data, bins, columns=np.flatnonzero(in_brain), chunk_size=chunk_size)
+        suffix += '_bandpassed'
+
+    outputs['out_file'] = _write(suffix)
+    if save_stages and 'nuis_corrected' not in outputs:
+        outputs['nuis_corrected'] = outputs['out_file']
+    return outputs
+
+
+class SignalCleanInputSpec(BaseInterfaceInputSpec):
+    in_file            = File(exists=True, mandatory=True, desc='4D fMRI image.')
+    brain_mask         = File(exists=True, mandatory=True, desc='Brain mask image.')
+    confounds          = File(exists=True, desc='Text file with the confound regressors in columns.')
+    compcor_masks      = InputMultiPath(File(exists=True),
+                                        desc='Tissue masks for CompCor. If not set, CompCor is not applied.')
+    compcor_components = traits.Int(5, usedefault=True, desc='Number of CompCor components for each mask.')
+    gsr_components     = traits.Int(0, usedefault=True,
+                                    desc='Number of global signal components. If 0, GSR is not applied.')
+    detrend_order      = traits.Int(0, usedefault=True, desc='Order of the polynomial trends to regress out.')
+    lowpass_freq       = traits.Float(0., usedefault=True, desc='Low pass cutoff frequency in Hz. 0 to disable.')
+    highpass_freq      = traits.Float(0., usedefault=True, desc='High pass cutoff frequency in Hz. 0 to disable.')
+    tr                 = traits.Float(desc='Repetition time in seconds.')
+    save_stages        = traits.Bool(False, usedefault=True,
+                                     desc='Write the residual image of each regression stage.')
+    chunk_size         = traits.Int(20000, usedefault=True, desc='Number of voxels to process at once.')
+
+
+class SignalCleanOutputSpec(TraitedSpec):
+    out_file           = File(exists=True, desc='The cleaned and bandpass filtered image.')
+    nuis_corrected     = File(desc='The nuisance corrected image before the bandpass filter, if `save_stages`.')
+    motion_res         = File(desc='The confounds corrected image, if `save_stages` and there are more stages.')
+    compcor_res        = File(desc='The CompCor corrected image, if `save_stages` and GSR is applied.')
+    compcor_regressors = File(desc='CompCor components and confounds file.')
+    gsr_regressors     = File(desc='Global signal components file.')
+
+
+class SignalClean(BaseInterface):
+    """ Detrend, regress the confounds, CompCor and global signal and bandpass filter
+    an fMRI image in memory, reading and writing it once. See `signal_clean`.
+
+    The output file has the suffixes of the previous filters, e.g.,
+    '_filtermotart_cleaned_bandpassed', or '_filtermotart_cleaned' if the
+    bandpass filter is disabled.
+    """
+    input_spec  = SignalCleanInputSpec
+    output_spec = SignalCleanOutputSpec
+
+    def _run_interface(self, runtime):
+        def _optional(name, default):
+            value = getattr(self.inputs, name)
+            return value if isdefined(value) else default
+
+        self._results = signal_clean(self.inputs.in_file,
+                                     brain_mask=self.inputs.brain_mask,
+                                     confounds=_optional('confounds', ''),
+                                     compcor_masks=_optional('compcor_masks', []),
+                                     compcor_components=self.inputs.compcor_components,
+                                     gsr_components=self.inputs.gsr_components,
+                                     detrend_order=self.inputs.detrend_order,
+                                     lowpass_freq=self.inputs.lowpass_freq,
+                                     highpass_freq=self.inputs.highpass_freq,
+                                     tr=_optional('tr', None),
+                                     save_stages=self.inputs.save_stages,
+                                     chunk_size=self.inputs.chunk_size,
+                                     out_dir=os.getcwd())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for name in outputs:
+            if name in self._results:
+                outputs[name] = self._results[name]
+        return outputs
+
+
+def bandpass_filter(files, lowpass_freq=0.1, highpass_freq=0.01, tr=2, mask_file=None, n_jobs=1):
     """Bandpass filter the input files
 
     Parameters
@@ -20,42 +339,31 @@ def bandpass_filter(files, lowpass_freq=0.1, highpass_freq=0.01, tr=2):
 
     tr: float
         The repetition time in seconds. The inverse of sampling rate (in Hz).
+
+    mask_file: str
+        Path to a brain mask image. The voxels outside of it will be 0.
+
+    n_jobs: int
+        Number of files to filter in parallel threads.
     """
     import os
+    from   concurrent.futures import ThreadPoolExecutor
 
-    import nibabel as nb
-    import numpy as np
     from   nipype.utils.filemanip import (filename_to_list,
                                           list_to_filename,
                                           split_filename)
+    from   pypes.fmri.filter import bandpass_img
 
-    fs = 1./tr
-
-    out_files = []
-    for filename in filename_to_list(files):
+    def _filter(filename):
         path, name, ext = split_filename(filename)
         out_file = os.path.join(os.getcwd(), name + '_bandpassed' + ext)
+        return bandpass_img(filename, out_file,
+                            lowpass_freq=lowpass_freq,
+                            highpass_freq=highpass_freq,
+                            tr=tr,
+                            mask_file=mask_file)
 
-        img = nb.load(filename)
-        timepoints = img.shape[-1]
-        F = np.zeros((timepoints))
-
-        lowidx = int(timepoints / 2) + 1
-        if lowpass_freq > 0:
-            lowidx = np.round(float(lowpass_freq) / fs * timepoints)
-
-        highidx = 0
-        if highpass_freq > 0:
-            highidx = np.round(float(highpass_freq) / fs * timepoints)
-        F[int(highidx):int(lowidx)] = 1
-        F = ((F + F[::-1]) > 0).astype(int)
-        data = img.get_data()
-        if np.all(F == 1):
-            filtered_data = data
-        else:
-            filtered_data = np.real(np.fft.ifftn(np.fft.fftn(data) * F))
-        img_out = nb.Nifti1Image(filtered_data, img.affine, img.header)
-        img_out.to_filename(out_file)
-        out_files.append(out_file)
+    with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+        out_files = list(pool.map(_filter, filename_to_list(files)))
 
     return list_to_filename(out_files)
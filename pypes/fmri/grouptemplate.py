@@ -5,9 +5,9 @@ fMRI group template registration nipype workflow.
 import os.path as op
 
 import nipype.pipeline.engine as pe
-from   nipype.interfaces.io import DataSink
 from   nipype.interfaces import IdentityInterface
 
+from   ..datasink import LinkDataSink
 from   ..preproc import spm_create_group_template_wf, spm_warp_to_mni
 from   ..config  import setup_node
 from   .._utils  import format_pair_list
@@ -72,8 +72,8 @@ def attach_spm_fmri_grouptemplate_wf(main_wf, wf_name='spm_epi_grouptemplate'):
 
     # the group template datasink
     base_outdir  = datasink.inputs.base_directory
-    grp_datasink = pe.Node(DataSink(parameterization=False,
-                                    base_directory=base_outdir,),
+    grp_datasink = pe.Node(LinkDataSink(parameterization=False,
+                                        base_directory=base_outdir,),
                                     name='{}_grouptemplate_datasink'.format(fmri_fbasename))
     grp_datasink.inputs.container = '{}_grouptemplate'.format(fmri_fbasename)
 
@@ -7,11 +7,11 @@ import nipype.pipeline.engine       as pe
 from   nipype.algorithms.rapidart   import ArtifactDetect
 from   nipype.interfaces.utility    import Function, IdentityInterface, Merge
 from   nipype.algorithms.confounds  import TSNR
-from   nipype.interfaces            import fsl
 
 from   ..config  import setup_node, _get_params_for
-from   ..utils   import selectindex, rename
-from   ..preproc import motion_regressors, extract_noise_components, create_regressors
+from   ..utils   import selectindex
+from   ..preproc import motion_regressors, create_regressors
+from   .filter   import SignalClean
 
 
 def rapidart_fmri_artifact_detection():
@@ -28,6 +28,11 @@ def rapidart_fmri_artifact_detection():
 def rest_noise_filter_wf(wf_name='rest_noise_removal'):
     """ Create a resting-state fMRI noise removal node.
 
+    The motion and artifact, CompCor and global signal filters and the bandpass
+    filter are applied in one `SignalClean` node, which reads and writes the
+    fMRI image once. Set 'signal_clean.save_stages: True' to also write the
+    residual image of each regression stage.
+
     Nipype Inputs
     -------------
     rest_noise_input.in_file
@@ -41,18 +46,30 @@ def rest_noise_filter_wf(wf_name='rest_noise_removal'):
     rest_noise_input.motion_params
         Nipy motion parameters.
 
+    rest_noise_input.lowpass_freq
+        Low pass cutoff frequency in Hz. 0 to disable.
+
+    rest_noise_input.highpass_freq
+        High pass cutoff frequency in Hz. 0 to disable.
+
+    rest_noise_input.tr
+        Repetition time in seconds.
+
     Nipype Outputs
     --------------
     rest_noise_output.tsnr_file
         A SNR estimation volume file for QA purposes.
 
     rest_noise_output.motion_corrected
-        The fMRI motion corrected image.
+        The fMRI motion and artifact corrected image.
+        Only if 'signal_clean.save_stages' is True and there are more filters.
 
     rest_noise_output.nuis_corrected
-        The resulting nuisance corrected image.
-        This will be the same as 'motion_corrected' if compcor
-        is disabled.
+        The resulting nuisance corrected image, before the bandpass filter.
+        Only if 'signal_clean.save_stages' is True.
+
+    rest_noise_output.time_filtered
+        The nuisance corrected and bandpass filtered image.
 
     rest_noise_output.motion_regressors
         Motion regressors file.
@@ -60,6 +77,9 @@ def rest_noise_filter_wf(wf_name='rest_noise_removal'):
     rest_noise_output.compcor_regressors
         CompCor regressors file.
 
+    rest_noise_output.gsr_regressors
+        Global signal regressors file.
+
     rest_noise_output.art_displacement_files
         One image file containing the voxel-displacement timeseries.
 
@@ -95,11 +115,15 @@ def rest_noise_filter_wf(wf_name='rest_noise_removal'):
                  "brain_mask",
                  "wm_mask",
                  "csf_mask",
-                 "motion_params",]
+                 "motion_params",
+                 "lowpass_freq",
+                 "highpass_freq",
+                 "tr",]
 
     out_fields = ["tsnr_file",
                   "motion_corrected",
                   "nuis_corrected",
+                  "time_filtered",
                   "motion_regressors",
                   "compcor_regressors",
                   "gsr_regressors",
@@ -131,6 +155,7 @@ def rest_noise_filter_wf(wf_name='rest_noise_removal'):
     motion_regs = setup_node(Function(input_names=['motion_params',
                                                    'order',
                                                    'derivatives',
+                                                   'out_format',
                                                   ],
                                       output_names=['out_files'],
                                       function=motion_regressors,),
@@ -140,49 +165,29 @@ def rest_noise_filter_wf(wf_name='rest_noise_removal'):
     motart_pars = setup_node(Function(input_names=['motion_params',
                                                    'comp_norm',
                                                    'outliers',
-                                                   'detrend_poly'],
+                                                   'detrend_poly',
+                                                   'out_format'],
                                       output_names=['out_files'],
                                       function=create_regressors),
                              name='motart_parameters')
 
-    motion_filter = setup_node(fsl.GLM(out_f_name='F_mcart.nii.gz',
-                                       out_pf_name='pF_mcart.nii.gz',
-                                       demean=True),
-                               name='motion_filter')
-
-    # Noise confound regressors
-    compcor_pars = setup_node(Function(input_names=['realigned_file',
-                                                    'mask_file',
-                                                    'num_components',
-                                                    'extra_regressors'],
-                                         output_names=['out_files'],
-                                         function=extract_noise_components,),
-                              name='compcor_pars')
-    #compcor_pars = setup_node(ACompCor(), name='compcor_pars')
-    #compcor_pars.inputs.components_file = 'noise_components.txt'
-
-    compcor_filter = setup_node(fsl.GLM(out_f_name='F.nii.gz',
-                                        out_pf_name='pF.nii.gz',
-                                        demean=True),
-                                name='compcor_filter')
-
-    # Global signal regression
-    gsr_pars = setup_node(Function(input_names=['realigned_file',
-                                                'mask_file',
-                                                'num_components',
-                                                'extra_regressors'],
-                                    output_names=['out_files'],
-                                    function=extract_noise_components, ),
-                            name='gsr_pars')
-
-    gsr_filter = setup_node(fsl.GLM(out_f_name='F_gsr.nii.gz',
-                                    out_pf_name='pF_gsr.nii.gz',
-                                    demean=True),
-                            name='gsr_filter')
+    # Remove the motion and art, compcor and global signal confounds and bandpass filter.
+    # The number of components can also be set with the former 'compcor_pars.num_components'
+    # and 'gsr_pars.num_components' settings.
+    signal_clean = setup_node(SignalClean(), name='signal_clean')
+    clean_params = _get_params_for('signal_clean')
+    compcor_pars = _get_params_for('compcor_pars')
+    if 'compcor_components' not in clean_params and 'num_components' in compcor_pars:
+        signal_clean.inputs.compcor_components = compcor_pars['num_components']
+
+    if not filters['gsr']:
+        signal_clean.inputs.gsr_components = 0
+    elif 'gsr_components' not in clean_params:
+        signal_clean.inputs.gsr_components = _get_params_for('gsr_pars').get('num_components', 1)
 
     # output identities
     rest_noise_output = setup_node(IdentityInterface(fields=out_fields,
-                                                     mandatory_inputs=True),
+                                                     mandatory_inputs=False),
                                     name="rest_noise_output")
 
     # Connect the nodes
@@ -205,16 +210,22 @@ def rest_noise_filter_wf(wf_name='rest_noise_removal'):
                                              ]),
                 (motion_regs,   motart_pars, [("out_files", "motion_params")]),
 
-                # motion filtering
-                (rest_noise_input, motion_filter, [("in_file", "in_file"),
-                                                   (("in_file", rename, "_filtermotart"), "out_res_name"),
-                                                  ]),
-                (motart_pars,      motion_filter, [(("out_files", selectindex, 0), "design")]),
+                # nuisance filtering
+                (rest_noise_input, signal_clean, [("in_file",       "in_file"),
+                                                  ("brain_mask",    "brain_mask"),
+                                                  ("lowpass_freq",  "lowpass_freq"),
+                                                  ("highpass_freq", "highpass_freq"),
+                                                  ("tr",            "tr"),
+                                                 ]),
+                (motart_pars,      signal_clean, [(("out_files", selectindex, 0), "confounds")]),
 
                 # output
                 (tsnr,             rest_noise_output, [("tsnr_file",          "tsnr_file")]),
                 (motart_pars,      rest_noise_output, [("out_files",          "motion_regressors")]),
-                (motion_filter,    rest_noise_output, [("out_res",            "motion_corrected")]),
+                (signal_clean,     rest_noise_output, [("motion_res",         "motion_corrected"),
+                                                       ("nuis_corrected",     "nuis_corrected"),
+                                                       ("out_file",           "time_filtered"),
+                                                      ]),
                 (art,              rest_noise_output, [("displacement_files", "art_displacement_files"),
                                                        ("intensity_files",    "art_intensity_files"),
                                                        ("norm_files",         "art_norm_files"),
@@ -224,50 +235,11 @@ def rest_noise_filter_wf(wf_name='rest_noise_removal'):
                                                       ]),
                 ])
 
-    last_filter = motion_filter
-
-    # compcor filter
     if filters['compcor_csf'] or filters['compcor_wm']:
-        wf.connect([
-                    # calculate compcor regressor and parameters file
-                    (motart_pars,      compcor_pars,      [(("out_files", selectindex, 0),   "extra_regressors"),]),
-                    (motion_filter,    compcor_pars,      [("out_res",                       "realigned_file"),]),
-
-                    # the compcor filter
-                    (motion_filter,    compcor_filter,    [("out_res",                        "in_file"),
-                                                           (("out_res", rename, "_cleaned"),  "out_res_name"),
-                                                          ]),
-                    (compcor_pars,     compcor_filter,    [(("out_files", selectindex, 0),    "design")]),
-                    #(compcor_pars,     compcor_filter,    [("components_file",  "design")]),
-                    (rest_noise_input, compcor_filter,    [("brain_mask",                     "mask")]),
-
-                    # output
-                    (compcor_pars,     rest_noise_output, [("out_files",   "compcor_regressors")]),
-                    #(compcor_pars,     rest_noise_output, [("components_file",   "compcor_regressors")]),
-                    ])
-        last_filter = compcor_filter
-
-    # global signal regression
-    if filters['gsr']:
-        wf.connect([
-            # calculate gsr regressors parameters file
-            (last_filter,       gsr_pars, [("out_res",      "realigned_file")]),
-            (rest_noise_input,  gsr_pars, [("brain_mask",   "mask_file")]),
+        wf.connect([(signal_clean, rest_noise_output, [("compcor_regressors", "compcor_regressors")]),])
 
-            # the output file name
-            (rest_noise_input, gsr_filter,  [("brain_mask", "mask")]),
-            (last_filter,       gsr_filter, [("out_res", "in_file"),
-                                             (("out_res", rename, "_gsr"), "out_res_name"),
-                                            ]),
-            (gsr_pars,          gsr_filter, [(("out_files", selectindex, 0), "design")]),
-
-            # output
-            (gsr_pars,   rest_noise_output, [("out_files", "gsr_regressors")]),
-        ])
-        last_filter = gsr_filter
-
-    # connect the final nuisance correction output node
-    wf.connect([(last_filter, rest_noise_output, [("out_res", "nuis_corrected")]),])
+    if filters['gsr']:
+        wf.connect([(signal_clean, rest_noise_output, [("gsr_regressors", "gsr_regressors")]),])
 
     if filters['compcor_csf'] and filters['compcor_wm']:
         mask_merge = setup_node(Merge(2), name="mask_merge")
@@ -275,19 +247,19 @@ def rest_noise_filter_wf(wf_name='rest_noise_removal'):
                     ## the mask for the compcor filter
                     (rest_noise_input, mask_merge,   [("wm_mask",    "in1")]),
                     (rest_noise_input, mask_merge,   [("csf_mask",   "in2")]),
-                    (mask_merge,       compcor_pars, [("out",        "mask_file")]),
+                    (mask_merge,       signal_clean, [("out",        "compcor_masks")]),
                   ])
 
     elif filters['compcor_csf']:
         wf.connect([
                     ## the mask for the compcor filter
-                    (rest_noise_input, compcor_pars, [("csf_mask",   "mask_file")]),
+                    (rest_noise_input, signal_clean, [("csf_mask", "compcor_masks")]),
                   ])
 
     elif filters['compcor_wm']:
         wf.connect([
                     ## the mask for the compcor filter
-                    (rest_noise_input, compcor_pars, [("wm_mask",   "mask_file")]),
+                    (rest_noise_input, signal_clean, [("wm_mask",  "compcor_masks")]),
                   ])
 
     return wf
@@ -2,6 +2,8 @@
 """
 Nipype workflows to process anatomical MRI.
 """
+import os
+import os.path as op
 import json
 from collections import OrderedDict
 
@@ -45,7 +47,87 @@ def trim(begin_idx=6):
     return trim
 
 
-def motion_stats_sheet(motion_file_cr, crumb_fields):
+def _parse_crumb_fields(crumb_fields):
+    """ Return a list of str from `crumb_fields`, which can be a list or a str such as
+    "['group', 'patient_id', 'session']"."""
+    if isinstance(crumb_fields, str):
+        return [crf.strip() for crf in crumb_fields.strip('[]').replace("'", "").split(',')
+                if crf.strip()]
+    return list(crumb_fields)
+
+
+def motion_record(stats_file, crumb_values):
+    """ Return an OrderedDict with the `crumb_values` and the information found in
+    the RapidArt statistics file `stats_file`.
+
+    Parameters
+    ----------
+    stats_file: str
+
+    crumb_values: list of 2-tuples
+
+    Returns
+    -------
+    record: OrderedDict
+    """
+    with open(stats_file) as f:
+        stats = json.load(f)
+
+    outliers = stats[1]
+    motion_norm = stats[3]['motion_norm']
+
+    mtn_record = OrderedDict(crumb_values)
+    mtn_record.update(outliers)
+
+    for fn in motion_norm:
+        mtn_record['{}_motion_norm'.format(fn)] = motion_norm[fn]
+
+    return mtn_record
+
+
+def _motion_stats_files(motion_file_cr, crumb_fields):
+    """ Return a list of (stats file path, crumb values) found in the Crumb `motion_file_cr`."""
+    motion_file_cr = Crumb(motion_file_cr)
+    return [(cr.path, [(fn, cr[fn][0]) for fn in crumb_fields]) for cr in motion_file_cr.unfold()]
+
+
+def _motion_records(stats_files, n_jobs=4):
+    """ Return the motion records of the list of (stats file path, crumb values)
+    `stats_files`, read with a pool of `n_jobs` threads."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+        return list(pool.map(lambda item: motion_record(*item), stats_files))
+
+
+def _to_numeric(values):
+    """ Return a numeric pandas.Series from `values` or an object one if they are not numbers."""
+    try:
+        return pd.to_numeric(pd.Series(values))
+    except (ValueError, TypeError):
+        return pd.Series(values)
+
+
+def _records_frame(records, crumb_fields):
+    """ Return a typed DataFrame built column by column from the motion `records`.
+    The crumb fields are strings and the other columns are numeric."""
+    columns = OrderedDict()
+    for rec in records:
+        for k in rec:
+            columns.setdefault(k, None)
+
+    data = OrderedDict()
+    for col in columns:
+        values = [rec.get(col) for rec in records]
+        if col in crumb_fields:
+            data[col] = pd.Series(values, dtype='str')
+        else:
+            data[col] = _to_numeric(values)
+
+    return pd.DataFrame(data)
+
+
+def motion_stats_sheet(motion_file_cr, crumb_fields, n_jobs=4):
     """ Return a pandas.DataFrame with some of the motion statistics obtained from the
     `statistics_files` output of the nipype.RapidArt found in the hansel.Crumb `motion_file_cr`.
 
@@ -54,6 +136,10 @@ def motion_stats_sheet(motion_file_cr, crumb_fields):
     motion_file_cr: str
 
     crumb_fields: list of str
+        It can also be a str such as "['group', 'patient_id', 'session']".
+
+    n_jobs: int
+        Number of threads to read the statistics files.
 
     Returns
     -------
@@ -64,37 +150,85 @@ def motion_stats_sheet(motion_file_cr, crumb_fields):
     >>> motion_stats_sheet(motion_file_cr="/home/hansel/data/thomas/out/{group}/{patient_id}/{session}/rest/artifact_stats/motion_stats.json", \
     >>>                    crumb_fields=['group', 'patient_id', 'session'])
     """
-    def get_motion_record(mtn_file_cr, crumb_fields):
-        """ Return an OrderedDict of the information found in the `mtn_file_cr` and also
-        `crumb_fields` Crumb argument values."""
-        stats = json.load(open(str(mtn_file_cr)))
+    crumb_fields = _parse_crumb_fields(crumb_fields)
 
-        outliers = stats[1]
-        motion_norm = stats[3]['motion_norm']
+    stats_files = _motion_stats_files(motion_file_cr, crumb_fields)
 
-        #outliers_hdr = list(outliers.keys())
-        motion_hdr   = ['{}_motion_norm'.format(k) for k in motion_norm.keys()]
+    return _records_frame(_motion_records(stats_files, n_jobs=n_jobs), crumb_fields)
 
-        mtn_record = OrderedDict()
-        for fn in crumb_fields:
-            mtn_record[fn] = mtn_file_cr[fn][0]
 
-        mtn_record.update(outliers)
+# table file extension -> (reader, writer)
+_TABLE_FORMATS = {'.parquet': (pd.read_parquet, pd.DataFrame.to_parquet),
+                  '.feather': (pd.read_feather, pd.DataFrame.to_feather),
+                  '.pkl':     (pd.read_pickle,  pd.DataFrame.to_pickle),
+                  }
 
-        for hdr, fn in zip(motion_hdr, motion_norm):
-            mtn_record[hdr] = motion_norm[fn]
 
-        return mtn_record
+def _table_format(out_path):
+    ext = op.splitext(out_path)[1].lower()
+    if ext not in _TABLE_FORMATS:
+        raise ValueError('Expected one of {} as extension for the table file, '
+                         'got {}.'.format(list(_TABLE_FORMATS.keys()), out_path))
+    return _TABLE_FORMATS[ext]
 
-    # process the input
-    motion_file_cr = Crumb(motion_file_cr)
-    crumb_fields   = [crf.strip() for crf in crumb_fields[1:-1].replace("'", "").split(',')]
 
-    # create the motion records
-    motionstats = [get_motion_record(stats_file, crumb_fields) for stats_file in motion_file_cr.ls()]
+def motion_stats_table(motion_file_cr, crumb_fields, out_path, n_jobs=4):
+    """ Write in `out_path` a typed table with the motion statistics of all the
+    RapidArt statistics files found in the hansel.Crumb `motion_file_cr`.
+    See `motion_stats_sheet`.
 
-    # create a pandas Dataframe out of it
-    df = pd.DataFrame.from_records(motionstats, columns=motionstats[0].keys())
+    If `out_path` already exists, only the statistics files that are new or whose
+    mtime has changed are read again, and the ones that do not exist anymore are removed.
+    The table has two extra columns: 'stats_file' and 'stats_mtime_ns'.
 
-    # return the dataframe
-    return df
\ No newline at end of file
+    Parameters
+    ----------
+    motion_file_cr: str
+
+    crumb_fields: list of str
+        It can also be a str such as "['group', 'patient_id', 'session']".
+
+    out_path: str
+        Path to the output file. Its extension can be '.parquet' or '.feather',
+        which need `pyarrow`, or '.pkl'.
+
+    n_jobs: int
+        Number of threads to read the statistics files.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        The content of the table.
+    """
+    reader, writer = _table_format(out_path)
+    crumb_fields = _parse_crumb_fields(crumb_fields)
+
+    stats_files = _motion_stats_files(motion_file_cr, crumb_fields)
+    mtimes = {path: os.stat(path).st_mtime_ns for path, _ in stats_files}
+
+    previous = reader(out_path) if op.exists(out_path) else None
+    if previous is not None and 'stats_file' in previous.columns:
+        known = dict(zip(previous['stats_file'], previous['stats_mtime_ns']))
+        keep = previous[[known_mtime == mtimes.get(path)
+                         for path, known_mtime in zip(previous['stats_file'],
+                                                      previous['stats_mtime_ns'])]]
+        to_read = [item for item in stats_files if known.get(item[0]) != mtimes[item[0]]]
+    else:
+        keep = None
+        to_read = stats_files
+
+    records = _motion_records(to_read, n_jobs=n_jobs)
+    for (path, _), rec in zip(to_read, records):
+        rec['stats_file'] = path
+        rec['stats_mtime_ns'] = mtimes[path]
+
+    df = _records_frame(records, crumb_fields + ['stats_file'])
+    if keep is not None and len(keep):
+        df = pd.concat([keep, df], ignore_index=True) if len(df) else keep
+        df = df.sort_values(crumb_fields + ['stats_file']).reset_index(drop=True)
+
+    if not to_read and keep is not None and len(keep) == len(previous):
+        return previous
+
+    writer(df.reset_index(drop=True), out_path)
+    return df
@@ -6,17 +6,23 @@ import os.path as op
 import logging as log
 
 import nipype.pipeline.engine as pe
-from   nipype.interfaces.io import DataSink
 from   nipype.interfaces.utility import IdentityInterface
 from   hansel.utils import joint_value_map, valuesmap_to_dict
 
 from .crumb  import DataCrumb
-from .utils  import extend_trait_list, joinstrings
+from .datasink import LinkDataSink
+from .crumb_index import CrumbIndex
+from .utils  import extend_trait_list, joinstrings, has_join_on, remove_join_dependents
+from ._utils import get_values_map_keys
+from .config import get_config_setting, warn_unmatched_node_settings
+from .manifest import attach_subject_manifest, uptodate_subjects, subject_input_files
+from .resources import set_reference_input
 from .       import configuration
 
 
 def build_crumb_workflow(wfname_attacher, data_crumb, in_out_kwargs, output_dir,
-                         cache_dir='', wf_name="main_workflow"):
+                         cache_dir='', wf_name="main_workflow", index_file='',
+                         values_map=None, skip_uptodate=None):
     """ Returns a workflow for the give `data_crumb` with the attached workflows
     given by `attach_functions`.
 
@@ -52,8 +58,35 @@ def build_crumb_workflow(wfname_attacher, data_crumb, in_out_kwargs, output_dir,
 
     wf_name: str
         Name of the main workflow.
+
+    index_file: str
+        Path to a sqlite file to keep a persistent index of the `data_crumb`
+        file system listings. See `pypes.crumb_index.CrumbIndex`.
+        If empty, will use the `crumb_index_file` configuration setting.
+        If that is also empty, the file system will be walked every time.
+
+    values_map: list of tuples of 2-tuples
+        The crumb argument values of the subjects to be processed.
+        If None, will use all the subjects found in `data_crumb`.
+
+    skip_uptodate: bool
+        If True, will write a manifest in the output folder of each subject and
+        will leave out of the workflow the subjects whose manifest is up to date.
+        The subjects are not left out if the workflow has group steps that join over
+        all of them, as these would be run again only with the remaining subjects.
+        See `pypes.manifest`.
+        If None, will use the `crumb_skip_uptodate` configuration setting.
     """
-    if not data_crumb.exists():
+    if not index_file:
+        index_file = get_config_setting('crumb_index_file', default='')
+
+    if skip_uptodate is None:
+        skip_uptodate = get_config_setting('crumb_skip_uptodate', default=False)
+
+    index = CrumbIndex(index_file) if index_file else None
+
+    data_exists = index.exists(data_crumb) if index is not None else data_crumb.exists()
+    if not data_exists:
         raise IOError("Expected an existing folder for `data_crumb`, got {}.".format(data_crumb))
 
     if not data_crumb.isabs():
@@ -75,15 +108,29 @@ def build_crumb_workflow(wfname_attacher, data_crumb, in_out_kwargs, output_dir,
     log.info('Using the following configuration parameters:')
     log.info(configuration)
 
-    # generate the workflow
-    main_wf = crumb_wf(work_dir=cache_dir,
-                       data_crumb=data_crumb,
-                       output_dir=output_dir,
-                       file_templates=in_out_kwargs,
-                       wf_name=wf_name)
+    if values_map is None:
+        values_map = crumb_values_map(data_crumb, _crumb_undef_args(data_crumb, in_out_kwargs),
+                                      index_file=index_file)
+
+    main_wf = _attach_crumb_workflows(wfname_attacher, data_crumb, in_out_kwargs, output_dir,
+                                      cache_dir, wf_name, index_file, values_map)
+
+    # leave out the subjects that have already been processed
+    if skip_uptodate:
+        uptodate = uptodate_subjects(data_crumb, values_map, in_out_kwargs, output_dir,
+                                     workflows=list(wfname_attacher.keys()))
+        if uptodate and has_join_on(main_wf, joinsource='infosrc'):
+            # the group steps would be run again only with the remaining subjects
+            log.warning('Not skipping the {} up to date subjects, the group steps of the '
+                        'workflow join over all the subjects.'.format(len(uptodate)))
+        elif uptodate:
+            log.info('Skipping {} up to date subjects: {}.'.format(len(uptodate), uptodate))
+            values_map = [values for values in values_map if values not in uptodate]
+            _set_infosrc_values(main_wf.get_node('infosrc'), values_map)
 
-    for wf_name, attach_wf in wfname_attacher.items():
-        main_wf = attach_wf(main_wf=main_wf, wf_name=wf_name)
+        main_wf = attach_subject_manifest(main_wf, workflows=list(wfname_attacher.keys()))
+
+    warn_unmatched_node_settings(main_wf)
 
     # move the crash files folder elsewhere
     main_wf.config["execution"]["crashdump_dir"] = op.join(main_wf.base_dir,
@@ -94,8 +141,195 @@ def build_crumb_workflow(wfname_attacher, data_crumb, in_out_kwargs, output_dir,
     return main_wf
 
 
+def _attach_crumb_workflows(wfname_attacher, data_crumb, in_out_kwargs, output_dir,
+                            cache_dir, wf_name, index_file, values_map):
+    """ Return the `crumb_wf` for the subjects in `values_map` with the workflows
+    of `wfname_attacher` attached. See `build_crumb_workflow`."""
+    # the input images of one subject for the node memory estimates
+    ref_files = subject_input_files(data_crumb, values_map[0], in_out_kwargs) if values_map else []
+    set_reference_input(ref_files, n_subjects=len(values_map))
+
+    # generate the workflow
+    main_wf = crumb_wf(work_dir=cache_dir,
+                       data_crumb=data_crumb,
+                       output_dir=output_dir,
+                       file_templates=in_out_kwargs,
+                       wf_name=wf_name,
+                       index_file=index_file,
+                       values_map=values_map)
+
+    for name, attach_wf in wfname_attacher.items():
+        main_wf = attach_wf(main_wf=main_wf, wf_name=name)
+
+    return main_wf
+
+
+def build_crumb_shard_workflows(wfname_attacher, data_crumb, in_out_kwargs, output_dir,
+                                cache_dir='', wf_name="main_workflow", index_file='',
+                                shard_size=0):
+    """ Returns a list of workflows, each one for a shard of `shard_size` subjects of
+    `data_crumb`, and a workflow for the group steps.
+
+    Each shard workflow has its own working directory inside `cache_dir`, so they
+    can be run independently, even in different machines sharing the file system.
+    The group steps, i.e., the nodes that join over the `infosrc` subjects iterables,
+    and all the nodes that depend on them, are removed from the shard workflows.
+    These are left in the reduce workflow, which is built for all the subjects and
+    must be run after all the shards have finished. See `pypes.run.run_shards`.
+
+    Parameters
+    ----------
+    wfname_attacher: dict[Str] -> function
+        See `build_crumb_workflow`.
+
+    data_crumb: hansel.Crumb
+        See `build_crumb_workflow`.
+
+    in_out_kwargs: dict with keyword arguments
+        See `build_crumb_workflow`.
+
+    output_dir: str
+        The output folder path.
+
+    cache_dir: str
+        The working directory of the workflow.
+        The shards working directories will be created inside this folder.
+
+    wf_name: str
+        Name of the main workflow.
+
+    index_file: str
+        See `build_crumb_workflow`.
+
+    shard_size: int
+        Maximum number of subjects in each shard.
+        If 0, will use the `crumb_shard_size` configuration setting.
+        If that is also 0, will return only one shard with all the subjects.
+
+    Returns
+    -------
+    shard_wfs: list of nipype Workflow
+        The workflows of each shard.
+
+    reduce_wf: nipype Workflow or None
+        The workflow for all the subjects with the group steps.
+        None if there are no group steps.
+    """
+    if not index_file:
+        index_file = get_config_setting('crumb_index_file', default='')
+
+    if not shard_size:
+        shard_size = get_config_setting('crumb_shard_size', default=0)
+
+    if not cache_dir:
+        cache_dir = op.join(op.dirname(output_dir), "wd")
+
+    undef_args = _crumb_undef_args(data_crumb, in_out_kwargs)
+    values_map = crumb_values_map(data_crumb, undef_args, index_file=index_file)
+
+    shard_wfs = []
+    has_group_steps = False
+    for idx, shard in enumerate(shard_values_map(values_map, shard_size)):
+        shard_wf = build_crumb_workflow(wfname_attacher,
+                                        data_crumb=data_crumb,
+                                        in_out_kwargs=in_out_kwargs,
+                                        output_dir=output_dir,
+                                        cache_dir=op.join(cache_dir, 'shard_{:04d}'.format(idx)),
+                                        wf_name=wf_name,
+                                        index_file=index_file,
+                                        values_map=shard)
+
+        # keep the outputs and node hashes of the shards valid for the reduce workflow
+        shard_wf.config["execution"]["remove_unnecessary_outputs"] = "false"
+
+        removed = remove_join_dependents(shard_wf, joinsource='infosrc')
+        if removed:
+            log.info('Removed group steps from shard {}: {}.'.format(idx, removed))
+            has_group_steps = True
+
+        shard_wfs.append(shard_wf)
+
+    reduce_wf = None
+    if has_group_steps:
+        reduce_wf = build_crumb_workflow(wfname_attacher,
+                                         data_crumb=data_crumb,
+                                         in_out_kwargs=in_out_kwargs,
+                                         output_dir=output_dir,
+                                         cache_dir=cache_dir,
+                                         wf_name=wf_name,
+                                         index_file=index_file,
+                                         values_map=values_map)
+        reduce_wf.config["execution"]["remove_unnecessary_outputs"] = "false"
+
+    return shard_wfs, reduce_wf
+
+
+def _crumb_undef_args(data_crumb, file_templates):
+    """ Return the names of the arguments of `data_crumb` that are not
+    specified in `file_templates`, i.e., the ones that identify each subject."""
+    files_args = get_values_map_keys(file_templates)
+    return [name for name in list(data_crumb.all_args()) if name not in files_args]
+
+
+def crumb_values_map(data_crumb, arg_names, index_file=''):
+    """ Return a sorted list of tuples of 2-tuples with the values of `arg_names`
+    that lead to existing paths of `data_crumb`.
+
+    Parameters
+    ----------
+    data_crumb: hansel.Crumb
+
+    arg_names: list of str
+
+    index_file: str
+        Path to a sqlite file with a persistent index of the `data_crumb`
+        file system listings. If empty, the file system will be walked instead.
+
+    Returns
+    -------
+    values_map: list of tuples of 2-tuples
+    """
+    if index_file:
+        return CrumbIndex(index_file).joint_value_map(data_crumb, arg_names)
+    return joint_value_map(data_crumb, arg_names)
+
+
+def shard_values_map(values_map, shard_size):
+    """ Split `values_map` in consecutive chunks of at most `shard_size` items.
+    If `shard_size` is 0 or None, will return a list with `values_map` as only item.
+
+    Parameters
+    ----------
+    values_map: list of tuples of 2-tuples
+
+    shard_size: int
+
+    Returns
+    -------
+    shards: list of lists of tuples of 2-tuples
+    """
+    values_map = list(values_map)
+    if not shard_size or shard_size >= len(values_map):
+        return [values_map]
+
+    if shard_size < 0:
+        raise ValueError('Expected a positive `shard_size`, got {}.'.format(shard_size))
+
+    return [values_map[i:i + shard_size] for i in range(0, len(values_map), shard_size)]
+
+
+def _set_infosrc_values(infosource, values_map):
+    """ Set the iterables of the `infosource` node to the crumb argument values
+    of the subjects in `values_map`."""
+    if values_map:
+        infosource.iterables = list(valuesmap_to_dict(values_map).items())
+    else:
+        infosource.iterables = [(name, []) for name, _ in infosource.iterables]
+    infosource.synchronize = True
+
+
 def crumb_wf(work_dir, data_crumb, output_dir, file_templates,
-             wf_name="main_workflow"):
+             wf_name="main_workflow", index_file='', values_map=None):
     """ Creates a workflow with the `subject_session_file` input nodes and an empty `datasink`.
     The 'datasink' must be connected afterwards in order to work.
 
@@ -120,6 +354,14 @@ def crumb_wf(work_dir, data_crumb, output_dir, file_templates,
     wf_name: str
         Name of the main workflow
 
+    index_file: str
+        Path to a sqlite file with a persistent index of the `data_crumb`
+        file system listings. If empty, the file system will be walked instead.
+
+    values_map: list of tuples of 2-tuples
+        The crumb argument values of the subjects to be processed.
+        If None, will use all the subjects found in `data_crumb`.
+
     Returns
     -------
     wf: Workflow
@@ -128,8 +370,8 @@ def crumb_wf(work_dir, data_crumb, output_dir, file_templates,
     wf = pe.Workflow(name=wf_name, base_dir=work_dir)
 
     # datasink
-    datasink = pe.Node(DataSink(parameterization=False,
-                                base_directory=output_dir,),
+    datasink = pe.Node(LinkDataSink(parameterization=False,
+                                    base_directory=output_dir,),
                        name="datasink")
 
     # input workflow
@@ -138,6 +380,8 @@ def crumb_wf(work_dir, data_crumb, output_dir, file_templates,
                                      templates=file_templates,
                                      raise_on_empty=False),
                            name='selectfiles')
+    if index_file:
+        select_files.inputs.index_file = index_file
 
     # basic file name substitutions for the datasink
     undef_args = select_files.interface._infields
@@ -149,8 +393,13 @@ def crumb_wf(work_dir, data_crumb, output_dir, file_templates,
 
     # Infosource - the information source that iterates over crumb values map from the filesystem
     infosource = pe.Node(interface=IdentityInterface(fields=undef_args), name="infosrc")
-    infosource.iterables = list(valuesmap_to_dict(joint_value_map(data_crumb, undef_args)).items())
-    infosource.synchronize = True
+    if values_map is None:
+        values_map = crumb_values_map(data_crumb, undef_args, index_file=index_file)
+
+    infosource.iterables = [(name, []) for name in undef_args]
+    _set_infosrc_values(infosource, values_map)
+    if not values_map:
+        log.info('No subjects to be processed in {}.'.format(data_crumb))
 
     # connect the input_wf to the datasink
     joinpath = pe.Node(joinstrings(len(undef_args)), name='joinpath')
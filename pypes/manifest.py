@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Subject manifests to know which subjects have already been processed.
+
+A manifest is a JSON file written next to the DataSink output of each subject.
+It records the content hashes of the input files, the pypes version, a digest of
+the configuration settings and the names of the attached workflows.
+"""
+import os
+import os.path as op
+import json
+import hashlib
+
+import nipype.pipeline.engine as pe
+from   nipype.interfaces.utility import Function, Merge
+from   nipype.interfaces.io import DataSink
+
+from   .config  import PYPES_CFG
+from   .version import __version__
+from   .utils   import get_datasink, get_input_node
+
+MANIFEST_NAME = 'pypes_manifest.json'
+
+# configuration settings that do not change the results of the workflows
+EXECUTION_SETTINGS = ('crumb_index_file',
+                      'crumb_shard_size',
+                      'crumb_skip_uptodate',
+                      'datasink_link_mode',
+                      'profile_db_file',
+                      )
+
+
+def file_digest(file_path, block_size=2**20):
+    """ Return the SHA-1 hex digest of the content of `file_path`."""
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def config_digest():
+    """ Return the SHA-1 hex digest of the global configuration settings,
+    excluding the ones in `EXECUTION_SETTINGS`."""
+    items = {k: v for k, v in PYPES_CFG.items() if k not in EXECUTION_SETTINGS}
+    content = json.dumps(items, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def _file_record(file_path, previous=None):
+    """ Return a dict with the size, mtime and content digest of `file_path`.
+    If `previous` has the same size and mtime, its digest is reused."""
+    st = os.stat(file_path)
+    record = {'size': st.st_size, 'mtime': st.st_mtime}
+    if previous is not None and previous.get('size') == record['size'] and \
+       previous.get('mtime') == record['mtime']:
+        record['sha1'] = previous['sha1']
+    else:
+        record['sha1'] = file_digest(file_path)
+    return record
+
+
+def read_manifest(manifest_file):
+    """ Return the content of `manifest_file` or None if it does not exist or is not valid."""
+    if not op.exists(manifest_file):
+        return None
+
+    try:
+        with open(manifest_file) as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def write_manifest(manifest_file, in_files, out_files, workflows, cfg_digest):
+    """ Write the manifest of one subject in `manifest_file`.
+
+    Parameters
+    ----------
+    manifest_file: str
+        Path to the output JSON file.
+
+    in_files: list of str
+        The input files of the subject.
+
+    out_files: list of str
+        The files written by the DataSink.
+
+    workflows: list of str
+        The names of the attached workflows.
+
+    cfg_digest: str
+        The digest of the configuration settings, see `config_digest`.
+
+    Returns
+    -------
+    manifest_file: str
+    """
+    manifest = {'pypes_version': __version__,
+                'config_digest': cfg_digest,
+                'workflows':     sorted(workflows),
+                'inputs':        {op.abspath(f): _file_record(f) for f in in_files},
+                'outputs':       sorted(out_files),
+               }
+
+    os.makedirs(op.dirname(manifest_file), exist_ok=True)
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest_file
+
+
+def is_uptodate(manifest_file, in_files, workflows, cfg_digest):
+    """ Return True if `manifest_file` exists and it was written by the same pypes
+    version, with the same configuration, for the same `workflows` or more, and
+    with the same content in `in_files`.
+    The input files are only hashed again if their size or mtime have changed.
+
+    Parameters
+    ----------
+    manifest_file: str
+
+    in_files: list of str
+
+    workflows: list of str
+
+    cfg_digest: str
+
+    Returns
+    -------
+    uptodate: bool
+    """
+    manifest = read_manifest(manifest_file)
+    if manifest is None:
+        return False
+
+    if manifest.get('pypes_version') != __version__:
+        return False
+
+    if manifest.get('config_digest') != cfg_digest:
+        return False
+
+    if not set(workflows).issubset(set(manifest.get('workflows', []))):
+        return False
+
+    inputs = manifest.get('inputs', {})
+    if set(op.abspath(f) for f in in_files) != set(inputs):
+        return False
+
+    for f in in_files:
+        previous = inputs[op.abspath(f)]
+        if _file_record(f, previous)['sha1'] != previous['sha1']:
+            return False
+
+    return all(op.exists(f) for f in manifest.get('outputs', []))
+
+
+def _write_subject_manifest(output_dir, container, in_files, out_files, workflows, cfg_digest):
+    """ Nipype function to write the manifest of one subject. Return the manifest file path."""
+    import os.path as op
+    from pypes.manifest import MANIFEST_NAME, write_manifest
+
+    def _flatten(items):
+        if isinstance(items, (list, tuple)):
+            return [f for item in items for f in _flatten(item)]
+        return [items] if items else []
+
+    manifest_file = op.join(output_dir, container, MANIFEST_NAME)
+    return write_manifest(manifest_file,
+                          in_files=_flatten(in_files),
+                          out_files=_flatten(out_files),
+                          workflows=workflows,
+                          cfg_digest=cfg_digest)
+
+
+def attach_subject_manifest(main_wf, workflows, wf_name='manifest'):
+    """ Attach to `main_wf` a node that writes a manifest in the output folder of each
+    subject after the `datasink` and the other DataSink nodes of `main_wf` have finished.
+
+    Parameters
+    ----------
+    main_wf: nipype Workflow
+        A workflow created with `pypes.io.crumb_wf`.
+
+    workflows: list of str
+        The names of the attached workflows.
+
+    wf_name: str
+        Name of the manifest node.
+
+    Returns
+    -------
+    main_wf: nipype Workflow
+    """
+    in_files = get_input_node(main_wf)
+    datasink = get_datasink(main_wf, name='datasink')
+    joinpath = main_wf.get_node('joinpath')
+
+    file_fields = list(in_files.interface._templates.keys())
+    merge_files = pe.Node(Merge(len(file_fields)), name='{}_inputs'.format(wf_name))
+
+    # the output files of all the datasinks, so the manifest is written after them
+    datasinks = [datasink] + [main_wf.get_node(name) for name in main_wf.list_node_names()
+                              if '.' not in name and name != datasink.name and
+                              isinstance(main_wf.get_node(name).interface, DataSink)]
+    merge_outputs = pe.Node(Merge(len(datasinks)), name='{}_outputs'.format(wf_name))
+
+    manifest = pe.Node(Function(function=_write_subject_manifest,
+                                input_names=['output_dir', 'container', 'in_files',
+                                             'out_files', 'workflows', 'cfg_digest'],
+                                output_names=['manifest_file']),
+                       name=wf_name)
+    manifest.inputs.output_dir = datasink.inputs.base_directory
+    manifest.inputs.workflows  = list(workflows)
+    manifest.inputs.cfg_digest = config_digest()
+
+    main_wf.connect([(in_files, merge_files, [(field, 'in{}'.format(idx + 1))
+                                              for idx, field in enumerate(file_fields)]),
+                     (merge_files,   manifest, [('out',      'in_files')]),
+                     (joinpath,      manifest, [('out',      'container')]),
+                     (merge_outputs, manifest, [('out',      'out_files')]),
+                    ])
+    for idx, sink in enumerate(datasinks):
+        main_wf.connect([(sink, merge_outputs, [('out_file', 'in{}'.format(idx + 1))])])
+    return main_wf
+
+
+def subject_input_files(data_crumb, values, file_templates):
+    """ Return the list of existing input files of one subject.
+
+    Parameters
+    ----------
+    data_crumb: hansel.Crumb
+
+    values: sequence of 2-tuples
+        The crumb argument values of the subject.
+
+    file_templates: Dict[str -> list of 2-tuple]
+        See `pypes.io.crumb_wf`.
+
+    Returns
+    -------
+    in_files: list of str
+    """
+    subj_crumb = data_crumb.replace(**dict(values))
+    in_files = []
+    for template in file_templates.values():
+        in_files.extend([cr.path for cr in subj_crumb.replace(**dict(template)).unfold()
+                         if op.exists(cr.path)])
+    return in_files
+
+
+def uptodate_subjects(data_crumb, values_map, file_templates, output_dir, workflows):
+    """ Return the items of `values_map` whose manifest in `output_dir` is up to date.
+
+    Parameters
+    ----------
+    data_crumb: hansel.Crumb
+
+    values_map: list of tuples of 2-tuples
+
+    file_templates: Dict[str -> list of 2-tuple]
+
+    output_dir: str
+        The base directory of the DataSink.
+
+    workflows: list of str
+        The names of the attached workflows.
+
+    Returns
+    -------
+    uptodate: list of tuples of 2-tuples
+    """
+    cfg_digest = config_digest()
+
+    uptodate = []
+    for values in values_map:
+        container = op.join(*[val for _, val in values])
+        manifest_file = op.join(output_dir, container, MANIFEST_NAME)
+        if not op.exists(manifest_file):
+            continue
+
+        in_files = subject_input_files(data_crumb, values, file_templates)
+        if is_uptodate(manifest_file, in_files, workflows, cfg_digest):
+            uptodate.append(values)
+
+    return uptodate
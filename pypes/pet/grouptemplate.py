@@ -5,9 +5,9 @@ PET group template registration nipype workflow.
 import os.path as op
 
 import nipype.pipeline.engine as pe
-from   nipype.interfaces.io import DataSink
 from   nipype.interfaces import IdentityInterface
 
+from   ..datasink import LinkDataSink
 from   .mrpet import attach_spm_mrpet_preprocessing
 from   ..preproc import (spm_create_group_template_wf,
                          spm_register_to_template_wf,)
@@ -69,8 +69,8 @@ def attach_spm_pet_grouptemplate(main_wf, wf_name="spm_pet_template"):
 
     # the group template datasink
     base_outdir  = datasink.inputs.base_directory
-    grp_datasink = pe.Node(DataSink(parameterization=False,
-                                    base_directory=base_outdir,),
+    grp_datasink = pe.Node(LinkDataSink(parameterization=False,
+                                        base_directory=base_outdir,),
                                     name='{}_grouptemplate_datasink'.format(pet_fbasename))
     grp_datasink.inputs.container = '{}_grouptemplate'.format(pet_fbasename)
 
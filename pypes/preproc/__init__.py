@@ -6,7 +6,8 @@ from .denoise import (nlmeans_denoise_img,
                       create_regressors,
                       extract_noise_components,
                       motion_regressors,
-                      reslice_img)
+                      reslice_img,
+                      reslice_file)
 from .registration import (spm_apply_deformations,
                            spm_coregister,
                            spm_normalize,
@@ -19,7 +20,10 @@ from .registration import (spm_apply_deformations,
 from .slicetime import (afni_slicetime,
                         spm_slicetime,
                         auto_spm_slicetime,
+                        auto_slicetime,
                         auto_nipy_slicetime)
+from .slicetime_shift import SliceTimeCorrection, slice_time_correct
+from .regress import NuisanceRegression, nuisance_regression
 from .slicetime_params import (STCParameters,
                                STCParametersInterface)
 
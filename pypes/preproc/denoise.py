@@ -2,11 +2,17 @@
 """
 Denoise and motion correction helper functions
 """
+import numpy as np
 from boyle.nifti.utils import nifti_out
 
 
+# default radii of dipy nlmeans, used for the overlap of the slabs
+NLMEANS_PATCH_RADIUS = 1
+NLMEANS_BLOCK_RADIUS = 5
+
+
 @nifti_out
-def nlmeans_denoise_img(img, mask, N=4):
+def nlmeans_denoise_img(img, mask, N=4, n_jobs=1):
     """ Apply dipy nlmeans denoising to the img. Useful for diffusion images.
     Parameters
     ----------
@@ -19,6 +25,9 @@ def nlmeans_denoise_img(img, mask, N=4):
     N: int
         Number of arrays of the head coil used to acquired the image.
 
+    n_jobs: int
+        Number of worker processes. If more than 1, see `parallel_nlmeans`.
+
     Returns
     -------
     den_img: nibabel.Nifti1Image
@@ -32,10 +41,198 @@ def nlmeans_denoise_img(img, mask, N=4):
     msk  = mask.get_data()
 
     sigma = estimate_sigma(data, N=N)
+    if n_jobs > 1:
+        return parallel_nlmeans(data, sigma=sigma, mask=msk, n_jobs=n_jobs)
+
     return nlmeans(data, sigma=sigma, mask=msk)
 
 
-def reslice_img(img, new_zooms=None, order=3):
+def _nlmeans_block(args):
+    """ Process pool task of `parallel_nlmeans`: denoise one 3D block."""
+    from dipy.denoise.nlmeans import nlmeans
+
+    data, sigma, mask, kwargs = args
+    return nlmeans(data, sigma=sigma, mask=mask, **kwargs)
+
+
+def _slab_bounds(size, n_slabs, overlap, step=2):
+    """ Return (start, stop, padded start, padded stop) of `n_slabs` slabs
+    along an axis of `size` voxels, padded with at least `overlap` voxels on each side.
+    The padded starts are multiples of `step`, so the slabs keep the grid of the
+    blocks of the dipy blockwise nlmeans, which are centered every 2 voxels."""
+    import numpy as np
+
+    edges = np.linspace(0, size, min(n_slabs, size) + 1).astype(int)
+    bounds = []
+    for start, stop in zip(edges[:-1], edges[1:]):
+        lo = max(0, start - overlap)
+        bounds.append((start, stop, lo - lo % step, min(size, stop + overlap)))
+    return bounds
+
+
+def parallel_nlmeans(data, sigma, mask, n_jobs=2, patch_radius=None, block_radius=None):
+    """ Apply dipy nlmeans to `data` in a pool of `n_jobs` processes.
+
+    The 4D images are split by volume, which gives the same result as
+    `nlmeans` on the whole image, because dipy denoises each volume
+    separately. The 3D images are split in slabs along the last axis,
+    padded with `2 * (patch_radius + block_radius)` voxels of overlap, so the
+    voxels kept from each slab see the same neighbourhood as in the whole image,
+    also with the blockwise method, which aggregates the estimates of the
+    overlapping blocks. The slabs start at even indices, so these blocks are on
+    the same grid as in the whole image.
+
+    Each process runs dipy with `cpu_count // n_jobs` threads.
+
+    Parameters
+    ----------
+    data: np.ndarray
+        3D or 4D image data.
+
+    sigma: float or np.ndarray
+        Noise standard deviation, one value for each volume of a 4D image.
+
+    mask: np.ndarray
+        3D brain mask.
+
+    n_jobs: int
+        Number of worker processes.
+
+    patch_radius: int
+        The nlmeans patch radius. The dipy default if None.
+
+    block_radius: int
+        The nlmeans block radius. The dipy default if None.
+
+    Returns
+    -------
+    denoised: np.ndarray
+    """
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+
+    import numpy as np
+
+    kwargs = {'num_threads': max(1, (os.cpu_count() or 1) // max(1, n_jobs))}
+    if patch_radius is not None:
+        kwargs['patch_radius'] = patch_radius
+    if block_radius is not None:
+        kwargs['block_radius'] = block_radius
+
+    sigma = np.atleast_1d(np.asarray(sigma, dtype=float))
+    denoised = np.zeros_like(data)
+
+    with ProcessPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+        if data.ndim == 4:
+            tasks = ((data[..., vol], sigma[vol], mask, kwargs) for vol in range(data.shape[-1]))
+            for vol, den in enumerate(pool.map(_nlmeans_block, tasks)):
+                denoised[..., vol] = den
+            return denoised
+
+        overlap = 2 * ((patch_radius if patch_radius is not None else NLMEANS_PATCH_RADIUS) +
+                       (block_radius if block_radius is not None else NLMEANS_BLOCK_RADIUS))
+        slabs = _slab_bounds(data.shape[2], n_jobs, overlap)
+        tasks = ((data[:, :, lo:hi], sigma[0], mask[:, :, lo:hi], kwargs) for _, _, lo, hi in slabs)
+        for (start, stop, lo, _), den in zip(slabs, pool.map(_nlmeans_block, tasks)):
+            denoised[:, :, start:stop] = den[:, :, start - lo:stop - lo]
+
+    return denoised
+
+
+def _reslice_volume(args):
+    """ Process pool task of `iter_resliced_volumes`: reslice one 3D volume."""
+    from dipy.align.reslice import reslice
+
+    data, affine, zooms, new_zooms, order = args
+    return reslice(data=data, affine=affine, zooms=zooms, new_zooms=new_zooms, order=order)
+
+
+def iter_resliced_volumes(img, new_zooms, order=3, n_jobs=1):
+    """ Reslice the volumes of `img` one by one with dipy, in a pool of `n_jobs`
+    processes, and yield them in order.
+
+    Each volume is read from `img`, which can be memory-mapped, and resliced as
+    float32. Only `n_jobs` volumes are being resliced at the same time.
+    A compressed `img` should be loaded with `keep_file_open=True`, so each volume
+    is decompressed from where the previous one ended and not from the start.
+
+    Parameters
+    ----------
+    img: nibabel.Nifti1Image
+        A 3D or 4D image.
+
+    new_zooms : tuple, shape (3,)
+        New voxel size.
+
+    order : int, from 0 to 5
+        Order of interpolation for resampling/reslicing.
+
+    n_jobs: int
+        Number of worker processes. If 1, the volumes are resliced in this process.
+
+    Yields
+    ------
+    volume: np.ndarray
+        The resliced 3D volume, as float32.
+
+    affine: np.ndarray
+        The affine of the resliced volume.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    zooms = img.header.get_zooms()[:3]
+    n_vols = img.shape[3] if len(img.shape) > 3 else 1
+
+    def _tasks():
+        for vol in range(n_vols):
+            data = img.dataobj[..., vol] if len(img.shape) > 3 else img.dataobj
+            yield np.asarray(data, dtype=np.float32), img.affine, zooms, new_zooms, order
+
+    if n_jobs <= 1:
+        for task in _tasks():
+            yield _reslice_volume(task)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        # submit at most n_jobs volumes ahead of the one being yielded
+        tasks, pending = _tasks(), []
+        for task in tasks:
+            pending.append(pool.submit(_reslice_volume, task))
+            if len(pending) > n_jobs:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def _resliced_header(img, new_zooms, shape, dtype):
+    """ Return a copy of the header of `img` for the resliced image."""
+    header = img.header.copy()
+    tmp_zooms = np.array(header.get_zooms())
+    tmp_zooms[:3] = new_zooms[0]
+    header.set_zooms(tuple(tmp_zooms))
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_xyzt_units('mm')
+    return header
+
+
+def _resliced_dtype(img):
+    """ Return float32 if the data type of `img` is floating point, or its data type otherwise."""
+    dtype = img.header.get_data_dtype()
+    return np.float32 if np.issubdtype(dtype, np.floating) else dtype
+
+
+def _isotropic_zooms(img, new_zooms=None):
+    """ Return `new_zooms` or the isotropic voxel size of the smallest zoom of `img`,
+    and whether `img` already has isotropic voxels."""
+    img_zooms = img.header.get_zooms()[:3]
+    all_equal = len(np.unique(img_zooms)) == 1
+    if new_zooms is None:
+        new_zooms = tuple(np.ones((3,)) * np.array(img_zooms).min())
+    return new_zooms, all_equal
+
+
+def reslice_img(img, new_zooms=None, order=3, n_jobs=1):
     """ Performs regridding of an image to set isotropic voxel sizes using dipy.
     If the file has already isotropic voxels, will return a copy of the same image.
 
@@ -51,84 +248,170 @@ def reslice_img(img, new_zooms=None, order=3):
        order of interpolation for resampling/reslicing, 0 nearest interpolation, 1 trilinear etc..
        if you don’t want any smoothing 0 is the option you need.
 
+    n_jobs: int
+        Number of processes to reslice the volumes in parallel.
+
     Returns
     -------
     nu_img: nibabel.Nifti1Image
         A isotropic voxel version from `img`.
+        Float images are resliced to float32, the other keep their data type.
     """
-    import numpy as np
     import nibabel as nib
-    from dipy.align.reslice import reslice
 
-    # read the data
-    data = img.get_data()
-    img_zooms = img.header.get_zooms()[:3]
-
-    # check if already isotropic voxels
-    all_equal = len(np.unique(img_zooms)) == 1
+    new_zooms, all_equal = _isotropic_zooms(img, new_zooms)
     if all_equal:
-        return nib.Nifti1Image(img.get_data(), affine=img.affine, header=img.header)
+        return nib.Nifti1Image(np.asanyarray(img.dataobj), affine=img.affine, header=img.header)
+
+    # reslice it volume by volume in a preallocated array
+    dtype = _resliced_dtype(img)
+    nu_data = None
+    for vol, (data, nu_affine) in enumerate(iter_resliced_volumes(img, new_zooms, order=order, n_jobs=n_jobs)):
+        if nu_data is None:
+            nu_data = np.empty(data.shape + img.shape[3:], dtype=dtype)
+        if not np.issubdtype(dtype, np.floating):
+            # the cubic spline overshoots the range of the data type
+            info = np.iinfo(dtype)
+            data = np.clip(np.rint(data), info.min, info.max)
+        if nu_data.ndim > 3:
+            nu_data[..., vol] = data
+        else:
+            nu_data[:] = data
 
-    # set new_zooms parameter
-    if new_zooms is None:
-        minzoom = np.array(img_zooms).min()
-        new_zooms = tuple(np.ones((3,)) * minzoom)
+    header = _resliced_header(img, new_zooms, nu_data.shape, dtype)
+    return nib.Nifti1Image(nu_data, nu_affine, header)
 
-    # reslice it
-    nu_data, nu_affine = reslice(data=data, affine=img.affine,
-                                 zooms=img_zooms,
-                                 new_zooms=new_zooms,
-                                 order=order)
 
-    # create the new image object
-    header = img.header.copy()
-    tmp_zooms = np.array(header.get_zooms())
-    tmp_zooms[:3] = new_zooms[0]
-    header.set_zooms(tuple(tmp_zooms))
-    header.set_data_shape(nu_data.shape)
-    header.set_xyzt_units('mm')
-    nu_img = nib.Nifti1Image(nu_data.astype(header.get_data_dtype()), nu_affine, header)
+def reslice_file(in_file, out_file, new_zooms=None, order=3, n_jobs=1):
+    """ Reslice `in_file` to isotropic voxels like `reslice_img` and save it in `out_file`.
 
-    return nu_img
+    The input volumes are read from a memory map, or from the open gzip stream of a
+    compressed `in_file`. If the output is an uncompressed float NIfTI file, the
+    resliced volumes are written one by one to a memory-mapped output file, so neither
+    the input nor the output data are fully in memory.
 
+    Parameters
+    ----------
+    in_file: str
+
+    out_file: str
+
+    new_zooms : tuple, shape (3,)
 
-def motion_regressors(motion_params, order=0, derivatives=1):
+    order : int, from 0 to 5
+
+    n_jobs: int
+        Number of processes to reslice the volumes in parallel.
+
+    Returns
+    -------
+    out_file: str
+    """
+    import nibabel as nib
+
+    img = nib.load(in_file, mmap=True, keep_file_open=str(in_file).endswith('.gz'))
+    new_zooms, all_equal = _isotropic_zooms(img, new_zooms)
+    dtype = _resliced_dtype(img)
+
+    if all_equal or not out_file.endswith('.nii') or dtype != np.float32:
+        reslice_img(img, new_zooms=new_zooms, order=order, n_jobs=n_jobs).to_filename(out_file)
+        return out_file
+
+    nu_data = None
+    for vol, (data, nu_affine) in enumerate(iter_resliced_volumes(img, new_zooms, order=order, n_jobs=n_jobs)):
+        if nu_data is None:
+            shape = data.shape + img.shape[3:]
+            header = _resliced_header(img, new_zooms, shape, dtype)
+            header.set_sform(nu_affine)
+            header.set_qform(nu_affine)
+            header.set_slope_inter(1, 0)
+            # the extensions of the input header are kept after the header
+            offset = int(header.single_vox_offset + header.extensions.get_sizeondisk())
+            header.set_data_offset(offset)
+
+            # the header, the extensions and the space for the data
+            out_dtype = header.get_data_dtype()
+            with open(out_file, 'wb') as f:
+                header.write_to(f)
+                f.write(b'\x00' * (offset - f.tell()))
+                f.truncate(offset + int(np.prod(shape)) * out_dtype.itemsize)
+
+            nu_data = np.memmap(out_file, dtype=out_dtype, mode='r+', offset=offset,
+                                shape=shape, order='F')
+
+        if nu_data.ndim > 3:
+            nu_data[..., vol] = data
+        else:
+            nu_data[:] = data
+
+    nu_data.flush()
+    del nu_data
+    return out_file
+
+
+def _save_design(design, filename, out_format='txt'):
+    """ Save the `design` matrix in `filename` with the extension of `out_format`,
+    'txt' or 'npy', and return the file path."""
+    import numpy as np
+
+    if out_format == 'npy':
+        filename += '.npy'
+        np.save(filename, design)
+    elif out_format == 'txt':
+        filename += '.txt'
+        np.savetxt(filename, design, fmt="%.10f")
+    else:
+        raise ValueError("Expected 'txt' or 'npy' as `out_format`, got {}.".format(out_format))
+    return filename
+
+
+def motion_regressors(motion_params, order=0, derivatives=1, out_format='txt'):
     """Compute motion regressors upto given order and derivative
 
     motion + d(motion)/dt + d2(motion)/dt2 (linear + quadratic)
+
+    The regressors are saved as text, or as a binary .npy file if
+    `out_format` is 'npy'.
     """
     import os
     import numpy as np
     from nipype.utils.filemanip import filename_to_list
+    from pypes.preproc.denoise import _save_design
 
     out_files = []
     for idx, filename in enumerate(filename_to_list(motion_params)):
-        params = np.genfromtxt(filename)
-        out_params = params
+        params = np.atleast_2d(np.genfromtxt(filename))
+        n_timepoints, n_params = params.shape
+        n_powers = max(1, order)
+
+        # columns: [params, derivatives] for each power
+        out_params = np.empty((n_timepoints, n_params * (derivatives + 1) * n_powers))
+        out_params[:, :n_params] = params
         for d in range(1, derivatives + 1):
-            cparams = np.vstack((np.repeat(params[0, :][None, :], d, axis=0),
-                                 params))
-            out_params = np.hstack((out_params, np.diff(cparams, d, axis=0)))
-        out_params2 = out_params
+            cparams = np.vstack((np.repeat(params[:1], d, axis=0), params))
+            out_params[:, d * n_params:(d + 1) * n_params] = np.diff(cparams, d, axis=0)
+
+        n_cols = n_params * (derivatives + 1)
         for i in range(2, order + 1):
-            out_params2 = np.hstack((out_params2, np.power(out_params, i)))
-        filename = os.path.join(os.getcwd(), "motion_regressor%02d.txt" % idx)
-        np.savetxt(filename, out_params2, fmt=b"%.10f")
-        out_files.append(filename)
+            np.power(out_params[:, :n_cols], i, out=out_params[:, (i - 1) * n_cols:i * n_cols])
+
+        filename = os.path.join(os.getcwd(), "motion_regressor%02d" % idx)
+        out_files.append(_save_design(out_params, filename, out_format))
     return out_files
 
 
-def create_regressors(motion_params, comp_norm, outliers, detrend_poly=None):
+def create_regressors(motion_params, comp_norm, outliers, detrend_poly=None, out_format='txt'):
     """Builds a regressor set comprising motion parameters, composite norm and
     outliers.
     The outliers are added as a single time point column for each outlier
 
     Parameters
     ----------
-    motion_params: a text file containing motion parameters and its derivatives
+    motion_params: a text or .npy file containing motion parameters and its derivatives
     comp_norm: a text file containing the composite norm
     outliers: a text file containing 0-based outlier indices
     detrend_poly: number of polynomials to add to detrend
+    out_format: 'txt' or 'npy', to save the regressors as text or as a binary .npy file
 
     Returns
     -------
@@ -137,31 +420,36 @@ def create_regressors(motion_params, comp_norm, outliers, detrend_poly=None):
     import os
     import numpy as np
     from nipype.utils.filemanip import filename_to_list
-    from scipy.special import legendre
+    from pypes.preproc.denoise import _save_design
+    from pypes.preproc.regress import read_design
 
     out_files = []
     for idx, filename in enumerate(filename_to_list(motion_params)):
-        params = np.genfromtxt(filename)
+        params = read_design(filename)
         norm_val = np.genfromtxt(filename_to_list(comp_norm)[idx])
-        out_params = np.hstack((params, norm_val[:, None]))
         try:
             outlier_val = np.genfromtxt(filename_to_list(outliers)[idx])
         except IOError:
             outlier_val = np.empty((0))
-        for index in np.atleast_1d(outlier_val):
-            outlier_vector = np.zeros((out_params.shape[0], 1))
-            outlier_vector[index] = 1
-            out_params = np.hstack((out_params, outlier_vector))
-        if detrend_poly:
-            timepoints = out_params.shape[0]
-            X = np.empty((timepoints, 0))
-            for i in range(detrend_poly):
-                X = np.hstack((X, legendre(
-                    i + 1)(np.linspace(-1, 1, timepoints))[:, None]))
-            out_params = np.hstack((out_params, X))
-        filename = os.path.join(os.getcwd(), "filter_regressor%02d.txt" % idx)
-        np.savetxt(filename, out_params, fmt=b"%.10f")
-        out_files.append(filename)
+        outlier_idx = np.atleast_1d(outlier_val).astype(int)
+
+        n_timepoints, n_params = params.shape
+        n_poly = detrend_poly or 0
+
+        # columns: [params, norm, one spike for each outlier, legendre polynomials]
+        out_params = np.zeros((n_timepoints, n_params + 1 + len(outlier_idx) + n_poly))
+        out_params[:, :n_params] = params
+        out_params[:,  n_params] = norm_val
+
+        spikes = n_params + 1 + np.arange(len(outlier_idx))
+        out_params[outlier_idx, spikes] = 1
+
+        if n_poly:
+            x = np.linspace(-1, 1, n_timepoints)
+            out_params[:, -n_poly:] = np.polynomial.legendre.legvander(x, n_poly)[:, 1:]
+
+        filename = os.path.join(os.getcwd(), "filter_regressor%02d" % idx)
+        out_files.append(_save_design(out_params, filename, out_format))
     return out_files
 
 
@@ -173,7 +461,7 @@ def extract_noise_components(realigned_file, mask_file, num_components=5,
     realigned_file: a 4D Nifti file containing realigned volumes
     mask_file: a 3D Nifti file containing white matter + ventricular masks
     num_components: number of components to use for noise decomposition
-    extra_regressors: additional regressors to add
+    extra_regressors: additional regressors to add, a text or .npy file
     Returns
     -------
     components_file: a text file containing the noise components
@@ -181,34 +469,25 @@ def extract_noise_components(realigned_file, mask_file, num_components=5,
     import os
     import nibabel as nb
     import numpy as np
-    import scipy as sp
     from   nipype.utils.filemanip import filename_to_list
+    from   pypes.preproc.regress import masked_timeseries, noise_components, read_design
+
+    masks = [np.asanyarray(nb.load(filename).dataobj) > 0 for filename in filename_to_list(mask_file)]
+    masks = [mask for mask in masks if mask.any()]
+
+    # read once the voxels of all the masks
+    n_vols = nb.load(realigned_file, mmap=True).shape[3]
+    components = np.zeros((n_vols, 0))
+    if masks:
+        union = np.logical_or.reduce(masks)
+        voxel_timecourses = masked_timeseries(realigned_file, union)
+        components = np.hstack([noise_components(voxel_timecourses, num_components, columns=mask[union])
+                                for mask in masks])
 
-    imgseries = nb.load(realigned_file)
-    components = None
-    for filename in filename_to_list(mask_file):
-        mask = nb.load(filename).get_data()
-        if len(np.nonzero(mask > 0)[0]) == 0:
-            continue
-        voxel_timecourses = imgseries.get_data()[mask > 0]
-        voxel_timecourses[np.isnan(np.sum(voxel_timecourses, axis=1)), :] = 0
-        # remove mean and normalize by variance
-        # voxel_timecourses.shape == [nvoxels, time]
-        X = voxel_timecourses.T
-        stdX = np.std(X, axis=0)
-        stdX[stdX == 0] = 1.
-        stdX[np.isnan(stdX)] = 1.
-        stdX[np.isinf(stdX)] = 1.
-        X = (X - np.mean(X, axis=0)) / stdX
-        u, _, _ = sp.linalg.svd(X, full_matrices=False)
-        if components is None:
-            components = u[:, :num_components]
-        else:
-            components = np.hstack((components, u[:, :num_components]))
     if extra_regressors:
-        regressors = np.genfromtxt(extra_regressors)
+        regressors = read_design(extra_regressors)
         components = np.hstack((components, regressors))
     components_file = os.path.join(os.getcwd(), 'noise_components.txt')
 
-    np.savetxt(components_file, components, fmt=b"%.10f")
+    np.savetxt(components_file, components, fmt="%.10f")
     return components_file
@@ -5,6 +5,33 @@
  Helper functions and nipype interface for
  reading DICOM files, specially from Siemens acquisitions
 """
+import os
+import os.path as op
+import json
+
+from ..config import get_config_setting
+
+
+# the ASCCONV parameters of the series already read in this process, by SeriesInstanceUID
+_ASCCONV_CACHE = {}
+
+
+def read_dcm_header(dcm_file, tags=None):
+    """ Return the pydicom dataset of `dcm_file` without reading the pixel data.
+
+    Parameters
+    ----------
+    dcm_file: str
+
+    tags: list of str
+        If given, only these tags are read.
+
+    Returns
+    -------
+    dcm_data: pydicom.Dataset
+    """
+    import pydicom
+    return pydicom.dcmread(dcm_file, stop_before_pixels=True, specific_tags=tags)
 
 
 def dcm_ascii_hdr(dcm_file):
@@ -20,10 +47,8 @@ def dcm_ascii_hdr(dcm_file):
     This only works for Siemens DICOM files.
     """
     def get_csa_header(dcm_file):
-        import pydicom
         from nibabel.nicom import csareader as csar
-        dcm_data = pydicom.read_file(dcm_file)
-        return csar.get_csa_header(dcm_data, 'series')
+        return csar.get_csa_header(read_dcm_header(dcm_file), 'series')
 
     csa = get_csa_header(dcm_file)
     return csa['tags']['MrPhoenixProtocol']['items'][0]
@@ -51,9 +76,89 @@ def split_dcm_ahdr(ahdr):
     ----
     This only works for Siemens DICOM files.
     """
-    parts = ahdr.split('### ASCCONV BEGIN ###')
+    # the newer versions have attributes in the BEGIN line, e.g.:
+    # ### ASCCONV BEGIN object=MrProtDataImpl@MrProtocolData version=51130001 ###
+    parts = ahdr.split('### ASCCONV BEGIN', 1)
 
     meta   = parts[0].split('\n')
-    ascconv = parts[1].split('### ASCCONV END ###')[0].split('\n')
+    ascconv = parts[1].split('###', 1)[1].split('### ASCCONV END ###')[0].split('\n')
+
+    return meta, ascconv
+
+
+def parse_ascconv(ascconv):
+    """ Return the parameters of the ascconv part of the protocol in a dict.
+
+    Parameters
+    ----------
+    ascconv: list of str
+        The ascconv lines returned by `split_dcm_ahdr`, e.g.:
+        'sSliceArray.ucMode                       = 0x4'
+
+    Returns
+    -------
+    params: dict of str to str
+        The parameter names and their values as they are in the ascconv,
+        e.g.: {'sSliceArray.ucMode': '0x4', 'alTR[0]': '2000000'}.
+    """
+    params = {}
+    for line in ascconv:
+        name, sep, value = line.partition('=')
+        if not sep or not name.strip() or name.strip().startswith('#'):
+            continue
+
+        value = value.strip()
+        if not value.startswith('"'):
+            value = value.split('#')[0].strip()
+        params[name.strip()] = value
+
+    return params
+
+
+def ascconv_params(dcm_file, cache_dir=None):
+    """ Return the ascconv parameters of the series of the Siemens `dcm_file`.
+
+    The parameters are parsed once per series: they are kept in memory and, if
+    `cache_dir` is set, in a JSON file named after the SeriesInstanceUID in `cache_dir`.
+    Once cached, only the SeriesInstanceUID of the other files of the series is read.
+
+    Parameters
+    ----------
+    dcm_file: str
+        Path to the DICOM file.
+
+    cache_dir: str
+        Path to the folder of the cached parameters.
+        If None, the `dicom_cache_dir` setting. If empty, they are cached only in memory.
+
+    Returns
+    -------
+    params: dict of str to str
+        See `parse_ascconv`.
+    """
+    if cache_dir is None:
+        cache_dir = get_config_setting('dicom_cache_dir', default='')
+
+    uid = str(getattr(read_dcm_header(dcm_file, tags=['SeriesInstanceUID']), 'SeriesInstanceUID', ''))
+    if uid in _ASCCONV_CACHE:
+        return _ASCCONV_CACHE[uid]
+
+    cache_file = op.join(op.expanduser(cache_dir), uid + '.json') if cache_dir and uid else ''
+    if cache_file and op.exists(cache_file):
+        with open(cache_file) as f:
+            params = json.load(f)
+    else:
+        _, ascconv = split_dcm_ahdr(dcm_ascii_hdr(dcm_file))
+        params = parse_ascconv(ascconv)
+
+        if cache_file:
+            os.makedirs(op.dirname(cache_file), exist_ok=True)
+            # the other processes see the file only once it is complete
+            tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(params, f)
+            os.replace(tmp_file, cache_file)
 
-    return meta, ascconv
\ No newline at end of file
+    if uid:
+        _ASCCONV_CACHE[uid] = params
+    return params
\ No newline at end of file
@@ -5,8 +5,15 @@ This file is refactored from C-PAC:
 https://github.com/FCP-INDI/C-PAC
 """
 
+import os.path as op
+import re
+import json
+
+import numpy as np
 import nipype.pipeline.engine as pe
 from   nipype.interfaces import Function, IdentityInterface
+from   nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                      TraitedSpec, File, traits, isdefined)
 
 from   ..config import setup_node
 
@@ -178,6 +185,12 @@ def motion_power_stats_wf(wf_name='gen_motion_stats'):
 
     Nipype inputs
     -------------
+    inputspec.subject_id : string
+        subject name or id
+
+    inputspec.scan_id : string
+        scan name or id
+
     inputspec.motion_correct : string (func/rest file or a list of func/rest nifti file)
         Path to motion corrected functional data
 
@@ -191,7 +204,10 @@ def motion_power_stats_wf(wf_name='gen_motion_stats'):
     inputspec.movement_parameters : string (Mat file)
         1D file containing six movement/motion parameters(3 Translation, 3 Rotations)
         in different columns (roll pitch yaw dS  dL  dP), obtained in functional preprocessing step
-        
+
+    inputspec.oned_matrix_save : string (Mat file)
+        1D file with one 3dvolreg affine matrix in each row
+
     scrubbing_input.threshold : a float
         scrubbing threshold
         
@@ -205,22 +221,18 @@ def motion_power_stats_wf(wf_name='gen_motion_stats'):
             
     Nipype outputs
     --------------
-    outputspec.FD_1D : 1D file
-        mean Framewise Displacement (FD)
+    outputspec.qc_file : JSON file
+        The power and motion parameters, the frames to exclude and
+        the frames to include after scrubbing.
 
-    outputspec.frames_ex_1D : 1D file
-        Number of frames that would be censored ("scrubbed")
-        also removing the offending time frames (i.e., those exceeding the threshold),
-        the preceeding frame, and the two subsequent frames
+    outputspec.qc_arrays : npz file
+        The FD, FD Jenkinson, DVARS and standardized DVARS traces and the
+        censoring mask for scrubbing.
 
-    outputspec.frames_in_1D : 1d file
-        Number of frames left after removing for scrubbing
-
-    outputspec.power_params : txt file
-        Text file various power parameters for scrubbing.
-
-    outputspec.motion_params : txt file
-       Text file containing various movement parameters
+    Notes
+    -----
+    All the measures are calculated in one `MotionQC` node, which reads
+    each input file only once.
 
     References
     ----------
@@ -238,174 +250,49 @@ def motion_power_stats_wf(wf_name='gen_motion_stats'):
     wf = pe.Workflow(name=wf_name)
 
     # specify input and output fields
-    in_fields  = ["in_files",
-                  "anat",
-                  "atlas_anat",
-                  "coreg_target",
-                  "tissues",
-                  "lowpass_freq",
-                  "highpass_freq",]
-
-    out_fields = ["motion_corrected",
-                  "motion_params",
-                  "tissues",
-                  "anat",
-                  "time_filtered",
-                  "smooth",
-                  "time_filtered_mni",
-                  "smooth_mni",
-                  "tsnr_file",
-                  "epi_brain_mask",
-                  "tissues_brain_mask",
-                  "motion_regressors",
-                  "compcor_regressors",
-                  "gsr_regressors",
-                  "nuis_corrected",
-                  "epi_mni",
-                  "epi_mni_warpfield",]
-
-    inputNode = setup_node(IdentityInterface(fields=['subject_id',
-                                                       'scan_id',
-                                                       'movement_parameters',
-                                                       'max_displacement',
-                                                       'motion_correct',
-                                                       'mask',
-                                                       'oned_matrix_save']),
-                        name='inputspec')
-
-    scrubbing_input = setup_node(IdentityInterface(fields=['threshold',
-                                                              'remove_frames_before',
-                                                              'remove_frames_after']),
-                             name='scrubbing_input')
-
-    outputNode = setup_node(IdentityInterface(fields=['FD_1D',
-                                                        'FDJ_1D',
-                                                        'frames_ex_1D',
-                                                        'frames_in_1D',
-                                                        'power_params',
-                                                        'motion_params']),
-                        name='outputspec')
-
-
-    # calculate mean DVARS
-    cal_DVARS = setup_node(Function(input_names=['in_file',
-                                                   'mask'],
-                                      output_names=['out_file'],
-                                      function=calculate_DVARS),
-                             name='cal_DVARS')
-    pm.connect(inputNode, 'motion_correct', cal_DVARS, 'rest')
-    pm.connect(inputNode, 'mask', cal_DVARS, 'mask')
-
-
-    # Calculating mean Framewise Displacement as per power et al., 2012
-    calculate_FD = setup_node(Function(input_names=['in_file'],
-                                         output_names=['out_file'],
-                                         function=calculate_FD_P),
-                           name='calculate_FD')
-    
-    pm.connect(inputNode, 'movement_parameters', 
-               calculate_FD, 'in_file' )
-    
-    pm.connect(calculate_FD, 'out_file', 
-               outputNode, 'FD_1D')
-    
-    # Calculating mean Framewise Displacement as per jenkinson et al., 2002
-    calculate_FDJ = setup_node(Function(input_names=['in_file'],
-                                         output_names=['out_file'],
-                                           function=calculate_FD_J),
-                             name='calculate_FDJ')
-    
-    pm.connect(inputNode, 'oned_matrix_save', 
-               calculate_FDJ, 'in_file' )
-    
-    pm.connect(calculate_FDJ, 'out_file', 
-               outputNode, 'FDJ_1D')
-
-    ##calculating frames to exclude and include after scrubbing
-    exclude_frames = setup_node(Function(input_names=['in_file', 
-                                                        'threshold',
-                                                        'frames_before',
-                                                        'frames_after'],
-                                           output_names=['out_file'],
-                                           function=set_frames_ex),
-                             name='exclude_frames')
-
-    pm.connect(calculate_FD, 'out_file', 
-               exclude_frames, 'in_file')
-    pm.connect(scrubbing_input, 'threshold', 
-               exclude_frames, 'threshold')
-    pm.connect(scrubbing_input, 'remove_frames_before',
-               exclude_frames, 'frames_before')
-    pm.connect(scrubbing_input, 'remove_frames_after',
-               exclude_frames, 'frames_after')
-    
-    pm.connect(exclude_frames, 'out_file', 
-               outputNode, 'frames_ex_1D')
-    
-    include_frames = setup_node(Function(input_names=['in_file',
-                                                        'threshold', 
-                                                        'exclude_list'],
-                                           output_names=['out_file'],
-                                           function=set_frames_in),
-                             name='include_frames')
-    pm.connect(calculate_FD, 'out_file', 
-               include_frames, 'in_file')
-    pm.connect(scrubbing_input, 'threshold', 
-               include_frames, 'threshold')
-    pm.connect(exclude_frames, 'out_file', 
-               include_frames, 'exclude_list')
-
-    pm.connect(include_frames, 'out_file', 
-               outputNode, 'frames_in_1D')
+    in_fields  = ["subject_id",
+                  "scan_id",
+                  "movement_parameters",
+                  "max_displacement",
+                  "motion_correct",
+                  "mask",
+                  "oned_matrix_save",]
 
-    
-    calc_motion_parameters = setup_node(Function(input_names=["subject_id", 
-                                                                "scan_id", 
-                                                                "movement_parameters",
-                                                                "max_displacement"],
-                                                   output_names=['out_file'],
-                                                   function=gen_motion_parameters),
-                                     name='calc_motion_parameters')
-    pm.connect(inputNode, 'subject_id',
-               calc_motion_parameters, 'subject_id')
-    pm.connect(inputNode, 'scan_id',
-               calc_motion_parameters, 'scan_id')
-    pm.connect(inputNode, 'movement_parameters',
-               calc_motion_parameters, 'movement_parameters')
-    pm.connect(inputNode, 'max_displacement',
-               calc_motion_parameters, 'max_displacement')
-    
-    pm.connect(calc_motion_parameters, 'out_file', 
-               outputNode, 'motion_params')
-
-
-    calc_power_parameters = setup_node(Function(input_names=["subject_id", 
-                                                                "scan_id", 
-                                                                "FD_1D",
-                                                                "FDJ_1D", 
-                                                                "threshold",
-                                                                "DVARS"],
-                                                   output_names=['out_file'],
-                                                   function=gen_power_parameters),
-                                     name='calc_power_parameters')
-    pm.connect(inputNode, 'subject_id',
-               calc_power_parameters, 'subject_id')
-    pm.connect(inputNode, 'scan_id',
-               calc_power_parameters, 'scan_id')
-    pm.connect(cal_DVARS, 'out_file',
-               calc_power_parameters, 'DVARS')
-    pm.connect(calculate_FD, 'out_file',
-               calc_power_parameters, 'FD_1D')
-    pm.connect(calculate_FDJ, 'out_file',
-               calc_power_parameters, 'FDJ_1D')
-    pm.connect(scrubbing_input, 'threshold',
-               calc_power_parameters, 'threshold')
-
-
-    pm.connect(calc_power_parameters, 'out_file', 
-               outputNode, 'power_params')
-
-    return pm
+    scrub_fields = ["threshold",
+                    "remove_frames_before",
+                    "remove_frames_after",]
+
+    out_fields = ["qc_file",
+                  "qc_arrays",]
+
+    inputNode = setup_node(IdentityInterface(fields=in_fields), name='inputspec')
+
+    scrubbing_input = setup_node(IdentityInterface(fields=scrub_fields), name='scrubbing_input')
+
+    motion_qc = setup_node(MotionQC(), name='motion_qc')
+
+    outputNode = setup_node(IdentityInterface(fields=out_fields), name='outputspec')
+
+    # Connect the nodes
+    wf.connect([
+                (inputNode,       motion_qc,  [("subject_id",          "subject_id"),
+                                               ("scan_id",             "scan_id"),
+                                               ("movement_parameters", "movement_parameters"),
+                                               ("max_displacement",    "max_displacement"),
+                                               ("motion_correct",      "motion_correct"),
+                                               ("mask",                "mask"),
+                                               ("oned_matrix_save",    "oned_matrix_save"),
+                                              ]),
+                (scrubbing_input, motion_qc,  [("threshold",            "threshold"),
+                                               ("remove_frames_before", "frames_before"),
+                                               ("remove_frames_after",  "frames_after"),
+                                              ]),
+                (motion_qc,       outputNode, [("qc_file",   "qc_file"),
+                                               ("qc_arrays", "qc_arrays"),
+                                              ]),
+              ])
+
+    return wf
 
 
 def set_frames_ex(in_file, threshold, 
@@ -515,6 +402,54 @@ def calculate_FD_P(in_file):
     return op.abspath(out_file)
     
 
+def jenkinson_fd(affines, rmax=80.0):
+    """ Return the Framewise Displacement (Jenkinson et al., 2002) for each row of `affines`.
+    All the relative transforms are computed in one vectorized pass.
+
+    Parameters
+    ----------
+    affines: np.ndarray
+        Array of shape (n_frames, 12) with one 3dvolreg affine matrix in each row,
+        in "row-by-row" order.
+
+    rmax: float
+        Radius in mm of the sphere that represents the brain, 80.0 as in FSL.
+
+    Returns
+    -------
+    fd: np.ndarray
+        Array of shape (n_frames,), the first value is 0.
+    """
+    import numpy as np
+
+    affines = np.atleast_2d(np.asarray(affines, dtype=float))
+    n_frames = affines.shape[0]
+
+    trans = np.zeros((n_frames, 4, 4))
+    trans[:, :3, :] = affines[:, :12].reshape(n_frames, 3, 4)
+    trans[:, 3, 3] = 1.0
+
+    fd = np.zeros(n_frames)
+    if n_frames < 2:
+        return fd
+
+    rel = np.matmul(trans[1:], np.linalg.inv(trans[:-1])) - np.eye(4)
+    A = rel[:, :3, :3]
+    b = rel[:, :3, 3]
+
+    # trace(A.T * A) is the sum of the squares of A
+    fd[1:] = np.sqrt((rmax * rmax / 5) * np.sum(A * A, axis=(1, 2)) + np.sum(b * b, axis=1))
+    return fd
+
+
+def _write_fd(fd, out_file):
+    """ Write the FD trace in `out_file`, one value per line with 8 decimals
+    and the first value as '0'."""
+    with open(out_file, 'w') as f:
+        f.write('0\n')
+        f.writelines('%.8f\n' % val for val in fd[1:])
+
+
 def calculate_FD_J(in_file):
     """
     Method to calculate Framewise Displacement (FD) calculations (Jenkinson et al., 2002).
@@ -533,47 +468,62 @@ def calculate_FD_J(in_file):
     `in_file` should have one 3dvolreg affine matrix in one row - NOT the motion parameters.
     """
     import os.path as op
-    import sys
-    import math
 
     import numpy as np
 
+    from pypes.preproc.motion_stats import jenkinson_fd, _write_fd
+
     out_file = 'FD_J.1D'
 
-    #print in_file
-    pm_ = np.genfromtxt(in_file)
+    _write_fd(jenkinson_fd(np.genfromtxt(in_file)), out_file)
 
-    pm = np.zeros((pm_.shape[0],pm_.shape[1]+4))
-    pm[:,:12]=pm_
-    pm[:,12:]=[0.0, 0.0, 0.0, 1.0]
+    return op.abspath(out_file)
 
-    flag = 0
 
-    #The default radius (as in FSL) of a sphere represents the brain
-    rmax = 80.0
+def calculate_FD_J_files(in_files, out_dir=''):
+    """ Calculate the Framewise Displacement (Jenkinson et al., 2002) of many
+    3dvolreg affine matrix files in one vectorized pass.
+    The output files have the same format as the one of `calculate_FD_J`.
 
-    with open(out_file, 'w') as f:
-        #rigid body transformation matrix
-        T_rb_prev = np.matrix(np.eye(4))
+    Parameters
+    ----------
+    in_files: list of str
+        Paths to the affine matrix files, one matrix in each row.
+
+    out_dir: str
+        Folder where to save the output files, named as '<in_file name>_FD_J.1D'.
+        If empty, the files will be saved next to the input files.
+
+    Returns
+    -------
+    out_files: list of str
+        Frame-wise displacement file paths, in the same order as `in_files`.
+    """
+    import os
+    import os.path as op
 
-        for i in range(0, pm.shape[0]):
-            T_rb = np.matrix(pm[i].reshape(4,4)) # making use of the fact that the order of aff12 matrix is "row-by-row"
+    import numpy as np
 
-            if flag == 0:
-                flag = 1
-                # first timepoint
-                print >> f, 0
-            else:
-                M = np.dot(T_rb, T_rb_prev.I) - np.eye(4)
-                A = M[0:3, 0:3]
-                b = M[0:3, 3]
+    from pypes.preproc.motion_stats import jenkinson_fd, _write_fd
 
-                FD_J = math.sqrt((rmax*rmax/5)*np.trace(np.dot(A.T, A)) + np.dot(b.T, b))
-                print >> f, '%.8f'%FD_J
+    affines = [np.atleast_2d(np.genfromtxt(f)) for f in in_files]
+    if not affines:
+        return []
 
-            T_rb_prev = T_rb
+    # the first frame of each file is not relative to the previous file
+    fd = jenkinson_fd(np.concatenate(affines))
+    bounds = np.cumsum([0] + [len(aff) for aff in affines])
 
-    return op.abspath(out_file)
+    out_files = []
+    for in_file, start, end in zip(in_files, bounds[:-1], bounds[1:]):
+        folder = out_dir if out_dir else op.dirname(op.abspath(in_file))
+        os.makedirs(folder, exist_ok=True)
+
+        out_file = op.join(folder, '{}_FD_J.1D'.format(op.splitext(op.basename(in_file))[0]))
+        _write_fd(fd[start:end], out_file)
+        out_files.append(op.abspath(out_file))
+
+    return out_files
 
 
 def set_frames_in(in_file, threshold, exclude_list):
@@ -824,7 +774,100 @@ def gen_power_parameters(subject_id, scan_id, FD_1D, FDJ_1D, DVARS, threshold =
     return op.abspath(out_file)
 
 
-def calculate_DVARS(rest, mask):
+def compute_dvars(rest, mask, chunk_size=16):
+    """ Return the DVARS and the standardized DVARS of `rest` within `mask`.
+
+    The volumes are read in memory-mapped chunks of `chunk_size` volumes and only
+    the voxels in the mask are kept, so the peak memory is bounded by the chunk size.
+    A compressed image is kept open between chunks, so it is decompressed only once.
+
+    The standardized DVARS is DVARS divided by its expected value under
+    stationarity, as in Nichols (2013): the mean across voxels of
+    sqrt(2 * (1 - AR1)) * std, where AR1 is the lag-1 autocorrelation of the voxel.
+    The voxel standard deviation is the sample standard deviation, not the robust
+    IQR-based one, because the latter needs the whole time series of each voxel.
+
+    Parameters
+    ----------
+    rest: str
+        Path to the 4D functional image.
+
+    mask: str
+        Path to the brain mask image.
+
+    chunk_size: int
+        Number of volumes to read at once.
+
+    Returns
+    -------
+    dvars: np.ndarray
+        Array of shape (n_volumes - 1,).
+
+    std_dvars: np.ndarray
+        Array of shape (n_volumes - 1,).
+    """
+    import numpy as np
+    import nibabel as nib
+
+    # each chunk of a .gz file opened again would be decompressed from the beginning
+    img = nib.load(rest, mmap=True, keep_file_open=str(rest).endswith('.gz'))
+    mask_data = np.asanyarray(nib.load(mask).dataobj).astype(bool)
+    n_vols = img.shape[3]
+    chunk_size = max(1, int(chunk_size))
+
+    n_vox = int(mask_data.sum())
+    dvars = np.zeros(max(n_vols - 1, 0), dtype=np.float32)
+
+    # per-voxel sums for the standard deviation and the lag-1 autocovariance
+    sum_x  = np.zeros(n_vox)
+    sum_x2 = np.zeros(n_vox)
+    sum_xy = np.zeros(n_vox)
+
+    first = None
+    prev = None
+    for start in range(0, n_vols, chunk_size):
+        stop = min(start + chunk_size, n_vols)
+        chunk = np.asarray(img.dataobj[..., start:stop])[mask_data].astype(np.float32)
+
+        if prev is not None:
+            chunk_ext = np.concatenate([prev[:, np.newaxis], chunk], axis=1)
+        else:
+            first = chunk[:, 0].astype(float)
+            chunk_ext = chunk
+
+        # square of the relative intensity of each voxel, mean across the mask
+        diffs = np.square(np.diff(chunk_ext, axis=1))
+        if diffs.size:
+            offset = start - 1 if prev is not None else start
+            dvars[offset:offset + diffs.shape[1]] = np.sqrt(np.mean(diffs, axis=0))
+
+        chunk64 = chunk_ext.astype(float)
+        sum_xy += np.sum(chunk64[:, 1:] * chunk64[:, :-1], axis=1)
+        sum_x  += np.sum(chunk64[:, -chunk.shape[1]:], axis=1)
+        sum_x2 += np.sum(np.square(chunk64[:, -chunk.shape[1]:]), axis=1)
+
+        prev = chunk[:, -1]
+
+    if n_vols < 2:
+        return dvars, dvars.copy()
+
+    last = prev.astype(float)
+    mean = sum_x / n_vols
+    var_sum = sum_x2 - n_vols * mean * mean
+    cov_sum = sum_xy - mean * (2 * sum_x - first - last) + (n_vols - 1) * mean * mean
+
+    valid = var_sum > 0
+    ar1 = np.zeros(n_vox)
+    ar1[valid] = cov_sum[valid] / var_sum[valid]
+    std = np.sqrt(np.maximum(var_sum, 0) / (n_vols - 1))
+
+    diff_sd_mean = np.mean((np.sqrt(np.maximum(2 * (1 - ar1), 0)) * std)[valid]) if valid.any() else 0
+    std_dvars = dvars / diff_sd_mean if diff_sd_mean > 0 else np.zeros_like(dvars)
+
+    return dvars, std_dvars.astype(np.float32)
+
+
+def calculate_DVARS(rest, mask, chunk_size=16):
     """
     Method to calculate DVARS as per power's method
     
@@ -835,6 +878,9 @@ def calculate_DVARS(rest, mask):
 
     mask : string (nifti file)
         path to brain only mask for functional data
+
+    chunk_size : int
+        number of volumes read at once, see `compute_dvars`
         
     Returns
     -------
@@ -845,25 +891,440 @@ def calculate_DVARS(rest, mask):
     import os.path as op
 
     import numpy as np
-    import nibabel as nib
+
+    from pypes.preproc.motion_stats import compute_dvars
 
     out_file = 'DVARS.npy'
+
+    DVARS, _ = compute_dvars(rest, mask, chunk_size=chunk_size)
+
+    np.save(out_file, DVARS)
     
-    rest_data = nib.load(rest).get_data().astype(np.float32)
-    mask_data = nib.load(mask).get_data().astype('bool')
-    
-    #square of relative intensity value for each voxel across
-    #every timepoint 
-    data = np.square(np.diff(rest_data, axis = 3))
+    return op.abspath(out_file)
+
+
+def calculate_std_DVARS(rest, mask, chunk_size=16):
+    """ Method to calculate DVARS and the standardized DVARS in one pass.
+    See `compute_dvars`.
+
+    Parameters
+    ----------
+    rest : string (nifti file)
+        path to motion correct functional data
 
-    #applying mask, getting the data in the brain only
-    data = data[mask_data]
+    mask : string (nifti file)
+        path to brain only mask for functional data
 
-    #square root and mean across all timepoints inside mask
-    DVARS = np.sqrt(np.mean(data, axis=0))
+    chunk_size : int
+        number of volumes read at once
+
+    Returns
+    -------
+    out_file : string (numpy mat file)
+        path to file containing the array of DVARS
+
+    std_file : string (numpy mat file)
+        path to file containing the array of standardized DVARS
+    """
+    import os.path as op
+
+    import numpy as np
+
+    from pypes.preproc.motion_stats import compute_dvars
+
+    out_file = 'DVARS.npy'
+    std_file = 'DVARS_std.npy'
+
+    DVARS, std_DVARS = compute_dvars(rest, mask, chunk_size=chunk_size)
 
     np.save(out_file, DVARS)
-    
+    np.save(std_file, std_DVARS)
+
+    return op.abspath(out_file), op.abspath(std_file)
+
+
+def power_fd(movement_parameters):
+    """ Return the Framewise Displacement (Power et al., 2012) of the motion
+    parameters array, the same as `calculate_FD_P`.
+
+    Parameters
+    ----------
+    movement_parameters: np.ndarray
+        Array of shape (n_frames, 6).
+
+    Returns
+    -------
+    fd: np.ndarray
+        Array of shape (n_frames,), the first value is 0.
+    """
+    cols = np.asarray(movement_parameters, dtype=float).T
+    translations = np.abs(np.diff(cols[0:3, :])).T
+    rotations = np.abs(np.diff(cols[3:6, :])).T
+
+    fd = np.sum(translations, axis=1) + (50*3.141/180)*np.sum(rotations, axis=1)
+    return np.insert(fd, 0, 0)
+
+
+def censor_masks(fd, thresholds, windows):
+    """ Return the censoring masks for scrubbing for all the combinations of
+    `thresholds` and `windows` at once.
+    A frame is censored if its FD is >= the threshold, or if it is within `frames_before`
+    frames before or `frames_after` frames after such a frame.
+    The first frame is never an offending frame, as in `set_frames_ex`.
+
+    Parameters
+    ----------
+    fd: np.ndarray
+        Framewise displacement trace of shape (n_frames,).
+
+    thresholds: sequence of float
+
+    windows: sequence of 2-tuples of int
+        The (frames_before, frames_after) values.
+
+    Returns
+    -------
+    masks: np.ndarray of bool
+        Array of shape (len(thresholds) * len(windows), n_frames), the
+        rows are ordered by threshold and then by window.
+
+    combinations: list of 3-tuples
+        The (threshold, frames_before, frames_after) of each row of `masks`.
+    """
+    fd = np.array(fd, dtype=float)
+    fd[0] = 0
+    thresholds = np.asarray(thresholds, dtype=float)
+    windows = np.asarray(windows, dtype=int).reshape(-1, 2)
+    n_frames = fd.shape[0]
+
+    # number of offending frames before each frame, for each threshold
+    offending = fd[np.newaxis, :] >= thresholds[:, np.newaxis]
+    counts = np.zeros((len(thresholds), n_frames + 1), dtype=np.int64)
+    np.cumsum(offending, axis=1, out=counts[:, 1:])
+
+    # frame t is censored if there is any offending frame in [t - after, t + before]
+    frames = np.arange(n_frames)
+    hi = np.clip(frames[np.newaxis, :] + windows[:, 0:1] + 1, 0, n_frames)
+    lo = np.clip(frames[np.newaxis, :] - windows[:, 1:2], 0, n_frames)
+
+    masks = (counts[:, hi] - counts[:, lo]) > 0
+
+    combinations = [(float(thr), int(before), int(after))
+                    for thr in thresholds for before, after in windows]
+    return masks.reshape(-1, n_frames), combinations
+
+
+def censor_mask(fd, threshold, frames_before=1, frames_after=2):
+    """ Return the boolean mask of the frames to exclude for scrubbing:
+    the frames with FD >= `threshold`, and `frames_before` and `frames_after` around them.
+    See `censor_masks`.
+
+    Parameters
+    ----------
+    fd: np.ndarray
+        Framewise displacement trace.
+
+    threshold: float
+
+    frames_before: int
+
+    frames_after: int
+
+    Returns
+    -------
+    mask: np.ndarray of bool
+    """
+    masks, _ = censor_masks(fd, [threshold], [(frames_before, frames_after)])
+    return masks[0]
+
+
+def save_censor_masks(out_file, masks, combinations):
+    """ Save the censoring `masks` bit-packed in the npz file `out_file`
+    and return its path, with the '.npz' extension that numpy adds if missing.
+    See `censor_masks` and `load_censor_masks`."""
+    if not out_file.endswith('.npz'):
+        out_file += '.npz'
+
+    masks = np.asarray(masks, dtype=bool)
+    np.savez_compressed(out_file,
+                        packed=np.packbits(masks, axis=1),
+                        n_frames=masks.shape[1],
+                        combinations=np.asarray(combinations, dtype=float).reshape(-1, 3))
+    return out_file
+
+
+def load_censor_masks(in_file):
+    """ Return the censoring masks and their (threshold, frames_before, frames_after)
+    combinations from a file saved with `save_censor_masks`."""
+    with np.load(in_file) as npz:
+        masks = np.unpackbits(npz['packed'], axis=1)[:, :int(npz['n_frames'])].astype(bool)
+        combinations = [(float(thr), int(before), int(after))
+                        for thr, before, after in npz['combinations']]
+    return masks, combinations
+
+
+def calculate_censor_masks(in_file, thresholds, windows):
+    """ Calculate the scrubbing censoring masks of the FD file `in_file` for all the
+    combinations of `thresholds` and (frames_before, frames_after) `windows`.
+
+    Parameters
+    ----------
+    in_file : string
+        framewise displacement(FD) file path
+
+    thresholds : list of float
+
+    windows : list of 2-tuples of int
+
+    Returns
+    -------
+    out_file : string
+        path to the npz file with the masks, see `load_censor_masks`
+    """
+    import os.path as op
+
+    import numpy as np
+
+    from pypes.preproc.motion_stats import censor_masks, save_censor_masks
+
+    out_file = 'censor_masks.npz'
+
+    masks, combinations = censor_masks(np.loadtxt(in_file), thresholds, windows)
+    save_censor_masks(out_file, masks, combinations)
+
     return op.abspath(out_file)
 
-    
+
+def _read_max_displacement(max_displacement):
+    """ Return the maximum displacement values in the file, ignoring the other
+    information AFNI adds to it."""
+    with open(max_displacement, 'r') as disp_f:
+        lines = disp_f.readlines()
+
+    return np.array([float(l.strip()) for l in lines if re.match(r"^\d+?\.\d+?$", l.strip())],
+                    dtype='float')
+
+
+def motion_parameters(movement_parameters, max_displacement=None):
+    """ Return the motion parameters of `gen_motion_parameters` as a dict.
+
+    Parameters
+    ----------
+    movement_parameters: np.ndarray
+        Array of shape (n_frames, 6), columns: roll pitch yaw dS dL dP.
+
+    max_displacement: np.ndarray or None
+        Maximum displacement for brain voxels in each volume.
+
+    Returns
+    -------
+    params: dict
+    """
+    arr = np.asarray(movement_parameters, dtype=float).T
+    names = ['Roll', 'Pitch', 'Yaw', 'dS-I', 'dL-R', 'dP-A']
+
+    rms = np.sqrt(arr[3]*arr[3] + arr[4]*arr[4] + arr[5]*arr[5])
+    diff = np.abs(np.diff(rms))
+    rel = np.diff(arr, axis=1)
+
+    params = {'Mean_Relative_RMS_Displacement': np.mean(diff),
+              'Max_Relative_RMS_Displacement':  np.max(diff),
+              'Movements_gt_threshold':         np.sum(diff > 0.1),
+              'Mean_Relative_Mean_Rotation':    np.mean(np.abs(np.diff((abs(arr[0]) + abs(arr[1]) +
+                                                                         abs(arr[2]))/3))),
+              }
+
+    if max_displacement is not None and len(max_displacement):
+        params['Mean_Relative_Maxdisp'] = np.mean(np.diff(max_displacement))
+        params['Max_Relative_Maxdisp']  = np.max(np.abs(np.diff(max_displacement)))
+        params['Max_Abs_Maxdisp']       = np.max(max_displacement)
+
+    for idx, name in enumerate(names):
+        params['Max_Relative_'  + name] = np.max(np.abs(rel[idx]))
+        params['Mean_Relative_' + name] = np.mean(rel[idx])
+        params['Max_Abs_'       + name] = np.max(np.abs(arr[idx]))
+        params['Mean_Abs_'      + name] = np.mean(np.abs(arr[idx]))
+
+    return {k: float(v) for k, v in params.items()}
+
+
+def power_parameters(fd, fdj, dvars, threshold=1.0, std_dvars=None):
+    """ Return the power parameters of `gen_power_parameters` as a dict.
+
+    Parameters
+    ----------
+    fd: np.ndarray
+        Power FD trace.
+
+    fdj: np.ndarray or None
+        Jenkinson FD trace.
+
+    dvars: np.ndarray or None
+
+    threshold: float
+
+    std_dvars: np.ndarray or None
+
+    Returns
+    -------
+    params: dict
+    """
+    params = {'MeanFD': np.mean(fd)}
+
+    if fdj is not None:
+        count = float(fdj[fdj > threshold].size)
+        quat = int(len(fdj)/4)
+        params.update({'MeanFD_Jenkinson': np.mean(fdj),
+                       'NumFD_greater_than_threshold': count,
+                       'rootMeanSquareFD': np.sqrt(np.mean(fdj)),
+                       'FDquartile(top1/4thFD)': np.mean(np.sort(fdj)[::-1][:quat]),
+                       'PercentFD_greater_than_threshold': count*100/(len(fdj) + 1),
+                       })
+
+    if dvars is not None:
+        params['MeanDVARS'] = np.mean(dvars)
+
+    if std_dvars is not None:
+        params['MeanStdDVARS'] = np.mean(std_dvars)
+
+    return {k: float(v) for k, v in params.items()}
+
+
+def motion_qc(movement_parameters, oned_matrix_save='', max_displacement='',
+              motion_correct='', mask='', threshold=1.0, frames_before=1, frames_after=2,
+              chunk_size=16):
+    """ Calculate all the FD, DVARS, scrubbing, power and motion parameters of one run,
+    reading each file only once.
+
+    Parameters
+    ----------
+    movement_parameters: str
+        Path to the 1D file with the six motion parameters.
+
+    oned_matrix_save: str
+        Path to the 1D file with one affine matrix in each row. Optional.
+
+    max_displacement: str
+        Path to the maximum displacement file. Optional.
+
+    motion_correct: str
+        Path to the motion corrected functional image. Optional.
+
+    mask: str
+        Path to the brain mask of `motion_correct`. Optional.
+
+    threshold: float
+        Scrubbing FD threshold.
+
+    frames_before: int
+
+    frames_after: int
+
+    chunk_size: int
+        Number of volumes to read at once for DVARS.
+
+    Returns
+    -------
+    measures: dict
+        The summary measures: 'power_params', 'motion_params', 'frames_ex' and 'frames_in'.
+
+    arrays: dict of np.ndarray
+        'FD', 'FD_J', 'DVARS', 'std_DVARS' and 'frames_ex_mask', if available.
+    """
+    movement = np.atleast_2d(np.genfromtxt(movement_parameters))
+    fd = power_fd(movement)
+    arrays = {'FD': fd}
+
+    fdj = None
+    if oned_matrix_save:
+        fdj = jenkinson_fd(np.genfromtxt(oned_matrix_save))
+        arrays['FD_J'] = fdj
+
+    dvars, std_dvars = None, None
+    if motion_correct and mask:
+        dvars, std_dvars = compute_dvars(motion_correct, mask, chunk_size=chunk_size)
+        arrays['DVARS'] = dvars
+        arrays['std_DVARS'] = std_dvars
+
+    maxdisp = _read_max_displacement(max_displacement) if max_displacement else None
+
+    ex_mask = censor_mask(fd, threshold, frames_before=frames_before, frames_after=frames_after)
+    arrays['frames_ex_mask'] = ex_mask
+
+    measures = {'threshold':     threshold,
+                'frames_before': frames_before,
+                'frames_after':  frames_after,
+                'power_params':  power_parameters(fd, fdj, dvars, threshold=threshold,
+                                                  std_dvars=std_dvars),
+                'motion_params': motion_parameters(movement, maxdisp),
+                'frames_ex':     np.flatnonzero(ex_mask).tolist(),
+                'frames_in':     np.flatnonzero(~ex_mask).tolist(),
+                }
+    return measures, arrays
+
+
+class MotionQCInputSpec(BaseInterfaceInputSpec):
+    movement_parameters = File(exists=True, mandatory=True,
+                               desc='1D file with the six motion parameters in columns: '
+                                    'roll pitch yaw dS dL dP.')
+    oned_matrix_save = File(exists=True, desc='1D file with one 3dvolreg affine matrix in each row.')
+    max_displacement = File(exists=True, desc='Maximum displacement for brain voxels in each volume.')
+    motion_correct   = File(exists=True, desc='Motion corrected functional image.')
+    mask             = File(exists=True, desc='Brain mask of the functional image.')
+    subject_id       = traits.Str(desc='Subject name or id.')
+    scan_id          = traits.Str(desc='Scan name or id.')
+    threshold        = traits.Float(1.0, usedefault=True, desc='Scrubbing FD threshold.')
+    frames_before    = traits.Int(1, usedefault=True,
+                                  desc='Number of frames to exclude before the offending ones.')
+    frames_after     = traits.Int(2, usedefault=True,
+                                  desc='Number of frames to exclude after the offending ones.')
+    chunk_size       = traits.Int(16, usedefault=True,
+                                  desc='Number of volumes to read at once for DVARS.')
+
+
+class MotionQCOutputSpec(TraitedSpec):
+    qc_file   = File(exists=True, desc='JSON file with the summary measures and scrubbing frames.')
+    qc_arrays = File(exists=True, desc='npz file with the FD, DVARS and scrubbing mask arrays.')
+
+
+class MotionQC(BaseInterface):
+    """ Calculate the Power and Jenkinson FD, DVARS, standardized DVARS, scrubbing
+    frames, power parameters and motion parameters of one run in one pass.
+    See `motion_qc`.
+
+    The summary measures are saved in 'motion_qc.json' and the traces
+    in 'motion_qc.npz'.
+    """
+    input_spec  = MotionQCInputSpec
+    output_spec = MotionQCOutputSpec
+
+    def _optional(self, name):
+        value = getattr(self.inputs, name)
+        return value if isdefined(value) else ''
+
+    def _run_interface(self, runtime):
+        measures, arrays = motion_qc(self.inputs.movement_parameters,
+                                     oned_matrix_save=self._optional('oned_matrix_save'),
+                                     max_displacement=self._optional('max_displacement'),
+                                     motion_correct=self._optional('motion_correct'),
+                                     mask=self._optional('mask'),
+                                     threshold=self.inputs.threshold,
+                                     frames_before=self.inputs.frames_before,
+                                     frames_after=self.inputs.frames_after,
+                                     chunk_size=self.inputs.chunk_size)
+
+        measures['subject_id'] = self._optional('subject_id')
+        measures['scan_id'] = self._optional('scan_id')
+
+        with open('motion_qc.json', 'w') as f:
+            json.dump(measures, f, indent=2, sort_keys=True)
+
+        np.savez_compressed('motion_qc.npz', **arrays)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['qc_file'] = op.abspath('motion_qc.json')
+        outputs['qc_arrays'] = op.abspath('motion_qc.npz')
+        return outputs
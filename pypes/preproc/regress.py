@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""
+Nuisance regression of fMRI timeseries with NumPy.
+
+The motion and artifact, CompCor and global signal filters are applied in one
+pass over the masked data: the image is read once, each filter is a projection
+on the orthogonal complement of its design matrix, computed from a QR
+factorization of the design, and the voxels are processed in chunks.
+"""
+import os
+import os.path as op
+
+import numpy as np
+import scipy.linalg
+import nibabel as nib
+from   nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                      TraitedSpec, File, InputMultiPath,
+                                      traits, isdefined)
+from   nipype.utils.filemanip import split_filename
+
+
+def design_basis(design, tol=1e-8):
+    """ Return an orthonormal basis of the column space of `design` plus an intercept.
+
+    The residuals of the projection on this basis are the same as the ones of
+    `fsl_glm --demean`. The rank-deficient columns are left out using a QR
+    factorization with column pivoting.
+
+    Parameters
+    ----------
+    design: np.ndarray
+        Array of shape (n_volumes, n_regressors) or (n_volumes,).
+
+    tol: float
+        Relative tolerance on the diagonal of R to decide the rank.
+
+    Returns
+    -------
+    basis: np.ndarray
+        Array of shape (n_volumes, rank).
+    """
+    design = np.asarray(design, dtype=float)
+    if design.ndim == 1:
+        design = design[:, np.newaxis]
+
+    design = np.hstack([np.ones((design.shape[0], 1)), design])
+    q, r, _ = scipy.linalg.qr(design, mode='economic', pivoting=True)
+
+    diag = np.abs(np.diag(r))
+    rank = int(np.sum(diag > tol * diag[0])) if diag.size else 0
+    return q[:, :rank]
+
+
+def project_out(basis, data, chunk_size=50000):
+    """ Remove from the columns of `data` their projection on `basis`, in place.
+
+    Parameters
+    ----------
+    basis: np.ndarray
+        Orthonormal basis of shape (n_volumes, rank), see `design_basis`.
+
+    data: np.ndarray
+        Array of shape (n_volumes, n_voxels).
+
+    chunk_size: int
+        Number of voxels to process at once.
+
+    Returns
+    -------
+    data: np.ndarray
+    """
+    chunk_size = max(1, int(chunk_size))
+    for start in range(0, data.shape[1], chunk_size):
+        chunk = data[:, start:start + chunk_size].astype(float)
+        chunk -= basis.dot(basis.T.dot(chunk))
+        data[:, start:start + chunk_size] = chunk
+    return data
+
+
+def noise_components(timeseries, num_components=5, columns=None, chunk_size=20000):
+    """ Return the first `num_components` principal components of the
+    standardized voxel `timeseries`, as in `extract_noise_components`.
+
+    The components are the leading eigenvectors of the (n_volumes, n_volumes)
+    Gram matrix of the standardized timeseries, which is accumulated in chunks
+    of voxels. They are the same as the left singular vectors of the
+    full SVD, up to the sign.
+
+    Parameters
+    ----------
+    timeseries: np.ndarray
+        Array of shape (n_volumes, n_voxels).
+
+    num_components: int
+
+    columns: np.ndarray
+        Indices or boolean mask of the voxels to use. All of them by default.
+
+    chunk_size: int
+        Number of voxels to standardize at once.
+
+    Returns
+    -------
+    components: np.ndarray
+        Array of shape (n_volumes, num_components).
+    """
+    if columns is None:
+        columns = np.arange(timeseries.shape[1])
+    elif np.asarray(columns).dtype == bool:
+        columns = np.flatnonzero(columns)
+
+    n_vols = timeseries.shape[0]
+    n_comps = min(num_components, n_vols, len(columns))
+    if n_comps <= 0:
+        return np.zeros((n_vols, 0))
+
+    gram = np.zeros((n_vols, n_vols))
+    chunk_size = max(1, int(chunk_size))
+    for start in range(0, len(columns), chunk_size):
+        X = timeseries[:, columns[start:start + chunk_size]].astype(float)
+        X[:, np.isnan(np.sum(X, axis=0))] = 0
+
+        stdX = np.std(X, axis=0)
+        stdX[stdX == 0] = 1.
+        stdX[~np.isfinite(stdX)] = 1.
+        X = (X - np.mean(X, axis=0)) / stdX
+        gram += X.dot(X.T)
+
+    _, eigvecs = scipy.linalg.eigh(gram, subset_by_index=[n_vols - n_comps, n_vols - 1])
+    return eigvecs[:, ::-1]
+
+
+def masked_timeseries(in_file, mask, chunk_size=16):
+    """ Return the timeseries of the voxels in the boolean array `mask` as a float32
+    array of shape (n_volumes, n_voxels), reading `chunk_size` volumes at once.
+    The gzip stream of a compressed `in_file` is kept open between the chunks, so
+    each chunk is decompressed from where the previous one ended."""
+    img = nib.load(in_file, mmap=True, keep_file_open=str(in_file).endswith('.gz'))
+    n_vols = img.shape[3]
+
+    data = np.empty((n_vols, int(mask.sum())), dtype=np.float32)
+    for start in range(0, n_vols, chunk_size):
+        stop = min(start + chunk_size, n_vols)
+        data[start:stop] = np.asarray(img.dataobj[..., start:stop])[mask].T
+    return data
+
+
+def write_masked_timeseries(data, mask, ref_img, out_file, dtype=np.float32):
+    """ Write the (n_volumes, n_voxels) `data` inside `mask` as a 4D image with
+    the affine and header of `ref_img` and the on-disk data type `dtype`.
+    If `dtype` is None, the data type of `ref_img` is kept."""
+    vol = np.zeros(mask.shape + (data.shape[0],), dtype=np.float32)
+    vol[mask] = data.T
+
+    header = ref_img.header.copy()
+    if dtype is not None:
+        header.set_data_dtype(dtype)
+    nib.Nifti1Image(vol, ref_img.affine, header).to_filename(out_file)
+    return out_file
+
+
+# stage -> (output name, file name) of the regressors of the stage
+_REGRESSORS_FILES = {'compcor_res': ('compcor_regressors', 'noise_components.txt'),
+                     'gsr_res':     ('gsr_regressors',     'gsr_components.txt'),
+                    }
+
+
+def read_design(design_file):
+    """ Return the regressors in the columns of the text or .npy file `design_file`
+    as an array of shape (n_volumes, n_regressors)."""
+    if design_file.endswith('.npy'):
+        design = np.load(design_file)
+    else:
+        design = np.genfromtxt(design_file)
+    if design.ndim == 1:
+        design = design[:, np.newaxis]
+    return design
+
+
+def read_nuisance_data(in_file, brain_mask, compcor_masks=None):
+    """ Read once the timeseries of the voxels in the brain mask and in the CompCor masks.
+
+    Parameters
+    ----------
+    in_file: str
+        Path to the 4D fMRI image.
+
+    brain_mask: str
+        Path to the brain mask image.
+
+    compcor_masks: list of str
+        Paths to the tissue masks for CompCor.
+
+    Returns
+    -------
+    data: np.ndarray
+        float32 array of shape (n_volumes, n_voxels) with the voxels in any of the masks.
+        The voxels with NaNs are set to 0.
+
+    brain: np.ndarray
+        The boolean brain mask volume.
+
+    in_brain: np.ndarray
+        Boolean array of shape (n_voxels,), True for the columns of `data` in `brain`.
+
+    in_tissues: list of np.ndarray
+        Boolean arrays of shape (n_voxels,), one for each non-empty CompCor mask.
+    """
+    brain = np.asanyarray(nib.load(brain_mask).dataobj) > 0
+    tissues = [np.asanyarray(nib.load(f).dataobj) > 0 for f in (compcor_masks or [])]
+    tissues = [m for m in tissues if m.any()]
+
+    union = brain.copy()
+    for tissue in tissues:
+        union |= tissue
+
+    data = masked_timeseries(in_file, union)
+    data[:, np.isnan(np.sum(data, axis=0))] = 0
+    return data, brain, brain[union], [tissue[union] for tissue in tissues]
+
+
+def nuisance_stages(data, design, in_brain, in_tissues=(), compcor_components=5,
+                    gsr_components=0, chunk_size=50000):
+    """ Apply in place to `data`, in sequence, the motion and artifact, CompCor and
+    global signal filters, yielding after each one.
+
+    The CompCor components are extracted from the motion residuals and regressed
+    together with the motion design. The global signal components are extracted
+    from the residuals of the previous stage in the brain voxels.
+
+    Parameters
+    ----------
+    data: np.ndarray
+        Array of shape (n_volumes, n_voxels), see `read_nuisance_data`.
+
+    design: np.ndarray
+        The motion and artifact regressors, array of shape (n_volumes, n_regressors).
+
+    in_brain: np.ndarray
+        Boolean array of shape (n_voxels,) with the brain voxels.
+
+    in_tissues: list of np.ndarray
+        Boolean arrays of shape (n_voxels,) with the voxels of each CompCor mask.
+        If empty, CompCor is not applied.
+
+    compcor_components: int
+        Number of CompCor components for each mask.
+
+    gsr_components: int
+        Number of global signal components. If 0, GSR is not applied.
+
+    chunk_size: int
+        Number of voxels to process at once.
+
+    Yields
+    ------
+    stage: str
+        'motion_res', 'compcor_res' or 'gsr_res'.
+
+    suffix: str
+        The file name suffix of the residuals of the stage.
+
+    regressors: np.ndarray or None
+        The regressors extracted in the stage.
+    """
+    # motion and artifact filter
+    project_out(design_basis(design), data, chunk_size=chunk_size)
+    suffix = '_filtermotart'
+    yield 'motion_res', suffix, None
+
+    # CompCor filter, with the components of the motion residuals
+    if len(in_tissues):
+        comps = np.hstack([noise_components(data, compcor_components, columns=tissue)
+                           for tissue in in_tissues])
+        regressors = np.hstack([comps, design])
+        project_out(design_basis(regressors), data, chunk_size=chunk_size)
+        suffix += '_cleaned'
+        yield 'compcor_res', suffix, regressors
+
+    # global signal filter, with the components of the previous residuals
+    if gsr_components:
+        regressors = noise_components(data, gsr_components, columns=in_brain)
+        project_out(design_basis(regressors), data, chunk_size=chunk_size)
+        suffix += '_gsr'
+        yield 'gsr_res', suffix, regressors
+
+
+def run_nuisance_stages(data, design, in_brain, in_tissues, write_stage, compcor_components=5,
+                        gsr_components=0, save_stages=False, chunk_size=50000, out_dir=''):
+    """ Run `nuisance_stages` on `data`, saving the regressors of each stage in `out_dir`
+    and, if `save_stages`, calling `write_stage(suffix)` after each stage but the last one.
+
+    Returns
+    -------
+    outputs: dict
+        With the paths of the written files, by output name.
+
+    suffix: str
+        The file name suffix of the last stage.
+    """
+    n_stages = 1 + bool(len(in_tissues)) + bool(gsr_components)
+
+    outputs = {}
+    stages = nuisance_stages(data, design, in_brain, in_tissues,
+                             compcor_components=compcor_components,
+                             gsr_components=gsr_components,
+                             chunk_size=chunk_size)
+    for idx, (stage, suffix, regressors) in enumerate(stages):
+        if regressors is not None:
+            output, file_name = _REGRESSORS_FILES[stage]
+            outputs[output] = op.join(out_dir, file_name)
+            np.savetxt(outputs[output], regressors, fmt='%.10f')
+
+        if save_stages and idx < n_stages - 1:
+            outputs[stage] = write_stage(suffix)
+
+    return outputs, suffix
+
+
+def nuisance_regression(in_file, brain_mask, motion_design, compcor_masks=None,
+                        compcor_components=5, gsr_components=0, save_stages=False,
+                        chunk_size=50000, out_dir=''):
+    """ Regress out of `in_file`, in sequence, the motion and artifact regressors,
+    the CompCor components and the global signal components. See `nuisance_stages`.
+
+    This is equivalent to the chain of `fsl_glm --demean` filters in the previous
+    `rest_noise_filter_wf`. The data in `brain_mask` are read once and the output
+    images are 0 outside of it.
+
+    Parameters
+    ----------
+    in_file: str
+        Path to the 4D fMRI image.
+
+    brain_mask: str
+        Path to the brain mask image.
+
+    motion_design: str
+        Path to the text file with the motion and artifact regressors in columns.
+
+    compcor_masks: list of str
+        Paths to the tissue masks for CompCor. If empty, CompCor is not applied.
+
+    compcor_components: int
+        Number of CompCor components for each mask.
+
+    gsr_components: int
+        Number of global signal components. If 0, GSR is not applied.
+
+    save_stages: bool
+        If True, also write the residual image of each stage before the last one.
+
+    chunk_size: int
+        Number of voxels to process at once.
+
+    out_dir: str
+        Output folder. The current working directory by default.
+
+    Returns
+    -------
+    outputs: dict
+        With the paths of 'out_file', 'motion_res', 'compcor_res',
+        'compcor_regressors' and 'gsr_regressors', if they were written.
+    """
+    out_dir = out_dir or os.getcwd()
+    _, name, ext = split_filename(in_file)
+    ref_img = nib.load(in_file, mmap=True)
+
+    data, brain, in_brain, in_tissues = read_nuisance_data(in_file, brain_mask, compcor_masks)
+
+    def _write(suffix):
+        out_file = op.join(out_dir, name + suffix + ext)
+        return write_masked_timeseries(data[:, in_brain], brain, ref_img, out_file)
+
+    outputs, suffix = run_nuisance_stages(data, read_design(motion_design), in_brain, in_tissues,
+                                          write_stage=_write,
+                                          compcor_components=compcor_components,
+                                          gsr_components=gsr_components,
+                                          save_stages=save_stages,
+                                          chunk_size=chunk_size,
+                                          out_dir=out_dir)
+    outputs['out_file'] = _write(suffix)
+    return outputs
+
+
+class NuisanceRegressionInputSpec(BaseInterfaceInputSpec):
+    in_file            = File(exists=True, mandatory=True, desc='4D fMRI image.')
+    brain_mask         = File(exists=True, mandatory=True, desc='Brain mask image.')
+    motion_design      = File(exists=True, mandatory=True,
+                              desc='Text file with the motion and artifact regressors in columns.')
+    compcor_masks      = InputMultiPath(File(exists=True),
+                                        desc='Tissue masks for CompCor. If not set, CompCor is not applied.')
+    compcor_components = traits.Int(5, usedefault=True, desc='Number of CompCor components for each mask.')
+    gsr_components     = traits.Int(0, usedefault=True,
+                                    desc='Number of global signal components. If 0, GSR is not applied.')
+    save_stages        = traits.Bool(False, usedefault=True,
+                                     desc='Write the residual image of each stage before the last one.')
+    chunk_size         = traits.Int(50000, usedefault=True, desc='Number of voxels to process at once.')
+
+
+class NuisanceRegressionOutputSpec(TraitedSpec):
+    out_file           = File(exists=True, desc='The nuisance corrected image.')
+    motion_res         = File(desc='The motion and artifact corrected image, if `save_stages`.')
+    compcor_res        = File(desc='The CompCor corrected image, if `save_stages` and GSR is applied.')
+    compcor_regressors = File(desc='CompCor components and motion regressors file.')
+    gsr_regressors     = File(desc='Global signal components file.')
+
+
+class NuisanceRegression(BaseInterface):
+    """ Remove the motion and artifact, CompCor and global signal regressors from
+    an fMRI image in one pass over the masked data. See `nuisance_regression`.
+
+    The output files have the suffixes of the previous FSL GLM filters:
+    '_filtermotart', '_cleaned' and '_gsr'.
+    """
+    input_spec  = NuisanceRegressionInputSpec
+    output_spec = NuisanceRegressionOutputSpec
+
+    def _run_interface(self, runtime):
+        masks = self.inputs.compcor_masks if isdefined(self.inputs.compcor_masks) else []
+        self._results = nuisance_regression(self.inputs.in_file,
+                                            brain_mask=self.inputs.brain_mask,
+                                            motion_design=self.inputs.motion_design,
+                                            compcor_masks=masks,
+                                            compcor_components=self.inputs.compcor_components,
+                                            gsr_components=self.inputs.gsr_components,
+                                            save_stages=self.inputs.save_stages,
+                                            chunk_size=self.inputs.chunk_size,
+                                            out_dir=os.getcwd())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for name in outputs:
+            if name in self._results:
+                outputs[name] = self._results[name]
+        return outputs
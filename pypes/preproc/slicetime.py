@@ -10,6 +10,7 @@ from   nipype.interfaces.utility import IdentityInterface
 from   nipype.algorithms.misc import Gunzip
 
 from   .slicetime_params import STCParametersInterface
+from   .slicetime_shift  import SliceTimeCorrection
 from   ..utils  import remove_ext
 from   ..config import setup_node
 
@@ -278,6 +279,9 @@ def auto_spm_slicetime(in_file=traits.Undefined,
 
     stc_input.slice_mode
 
+    stc_input.dcm_file: one DICOM file of the Siemens series of `in_file`, to read
+        the slice_mode and time_repetition that are not set.
+
     Nipype Outputs
     --------------
     stc_output.timecorrected_files
@@ -308,6 +312,7 @@ def auto_spm_slicetime(in_file=traits.Undefined,
                                                      "time_acquisition",
                                                      "ref_slice",
                                                      "slice_mode",
+                                                     "dcm_file",
                                                     ]),
                                              name="stc_input")
 
@@ -339,6 +344,7 @@ def auto_spm_slicetime(in_file=traits.Undefined,
                                      ("time_acquisition", "time_acquisition"),
                                      ("ref_slice",        "ref_slice"),
                                      ("slice_mode",       "slice_mode"),
+                                     ("dcm_file",         "dcm_file"),
                                     ]),
 
                 # processing nodes
@@ -359,6 +365,141 @@ def auto_spm_slicetime(in_file=traits.Undefined,
     return wf
 
 
+def auto_slicetime(in_file=traits.Undefined,
+                   out_prefix='stc',
+                   num_slices=traits.Undefined,
+                   time_repetition=traits.Undefined,
+                   time_acquisition=traits.Undefined,
+                   ref_slice=traits.Undefined,
+                   slice_order=traits.Undefined,
+                   method='fft',
+                   wf_name='auto_slicetime'):
+    """ A workflow that tries to automatically read the slice timing correction parameters
+    from the input file and passes them to a NumPy `SliceTimeCorrection` node.
+    It has the same inputs and outputs as `auto_spm_slicetime`, but needs neither
+    MATLAB nor uncompressed input files.
+
+    Parameters
+    ----------
+    in_file: str
+        Path to the input file.
+
+    out_prefix: str
+        Prefix to the output file.
+
+    num_slices: int
+        Number of slices of `in_file`.
+
+    time_repetition: int or str
+        The time repetition (TR) of the input dataset in seconds
+        If left to default will read the TR from the nifti image header.
+
+    time_acquisition: int
+        Time of volume acquisition. usually calculated as TR-(TR/num_slices)
+
+    ref_slice: int
+        Index of the reference slice
+
+    slice_order: list of int
+        List of integers with the order in which slices are acquired
+
+    method: str
+        'fft' or 'cubic', see `pypes.preproc.slicetime_shift.shift_timeseries`.
+
+    wf_name: str
+        Name of the workflow
+
+    Nipype Inputs
+    -------------
+    ## Mandatory:
+    stc_input.in_file:
+
+    ## Optional:
+    stc_input.num_slices
+
+    stc_input.slice_order
+
+    stc_input.time_repetition
+
+    stc_input.time_acquisition
+
+    stc_input.ref_slice
+
+    stc_input.slice_mode
+
+    stc_input.dcm_file
+
+    Nipype Outputs
+    --------------
+    stc_output.timecorrected_files
+
+    stc_output.time_repetition
+
+    Returns
+    -------
+    auto_stc: nipype Workflow
+        NumPy slice timing correction workflow with automatic
+        parameters detection.
+    """
+    # the input and output nodes
+    stc_input = setup_node(IdentityInterface(fields=["in_file",
+                                                     "num_slices",
+                                                     "slice_order",
+                                                     "time_repetition",
+                                                     "time_acquisition",
+                                                     "ref_slice",
+                                                     "slice_mode",
+                                                     "dcm_file",
+                                                    ]),
+                                             name="stc_input")
+
+    stc_output = setup_node(IdentityInterface(fields=["timecorrected_files",
+                                                      "time_repetition",
+                                                     ]),
+                                               name="stc_output")
+
+    # Declare the processing nodes
+    params = setup_node(STCParametersInterface(in_files         = in_file,
+                                               num_slices       = num_slices,
+                                               time_repetition  = time_repetition,
+                                               time_acquisition = time_acquisition,
+                                               ref_slice        = ref_slice,
+                                               slice_order      = slice_order), name='stc_params')
+    stc    = setup_node(SliceTimeCorrection(out_prefix=out_prefix, method=method), name='slice_timer')
+    stc.n_procs = max(stc.n_procs, stc.inputs.n_jobs)
+
+    # Create the workflow object
+    wf = pe.Workflow(name=wf_name)
+
+    # Connect the nodes
+    wf.connect([
+                # input node
+                (stc_input, params, [("in_file",          "in_files"),
+                                     ("num_slices",       "num_slices"),
+                                     ("slice_order",      "slice_order"),
+                                     ("time_repetition",  "time_repetition"),
+                                     ("time_acquisition", "time_acquisition"),
+                                     ("ref_slice",        "ref_slice"),
+                                     ("slice_mode",       "slice_mode"),
+                                     ("dcm_file",         "dcm_file"),
+                                    ]),
+
+                # processing nodes
+                (stc_input, stc,    [("in_file",          "in_file")]),
+                (params, stc,       [("slice_order",      "slice_order"),
+                                     ("ref_slice",        "ref_slice"),
+                                     ("time_acquisition", "time_acquisition"),
+                                     ("time_repetition",  "time_repetition"),
+                                    ]),
+
+                # output node
+                (params, stc_output,[("time_repetition",     "time_repetition")]),
+                (stc,    stc_output,[("timecorrected_files", "timecorrected_files")]),
+              ])
+
+    return wf
+
+
 def auto_nipy_slicetime(in_files=traits.Undefined,
                         time_repetition=traits.Undefined,
                         slice_order=traits.Undefined,
@@ -15,15 +15,17 @@ from nipype.interfaces.base import (BaseInterface,
                                     BaseInterfaceInputSpec,
                                     traits,)
 
-from .._utils        import check_equal, grep
+from .._utils        import check_equal
 from ..utils         import get_trait_value
-from ..preproc.dicom import split_dcm_ahdr, dcm_ascii_hdr
+from ..preproc.dicom import ascconv_params
 
 
 def slicing_mode(dcm_file):
     """ Return the slicing mode of the fMRI acquisition file given
     one of its DICOM files. Avoid giving the first DICOM file.
 
+    The protocol is read once per series, see `pypes.preproc.dicom.ascconv_params`.
+
     Parameters
     ----------
     dcm_file: str
@@ -62,9 +64,7 @@ def slicing_mode(dcm_file):
     modes   = [slicing_mode(dcm) for dcm in dcms]
     print(modes)
     """
-    _, ascconv = split_dcm_ahdr(dcm_ascii_hdr(dcm_file))
-
-    mode_code = grep(ascconv, 'sSliceArray.ucMode')[0].split('=')[1].strip()
+    mode_code = ascconv_params(dcm_file)['sSliceArray.ucMode']
 
     code_modes = {'0x1': 'ascending',
                   '0x2': 'descending',
@@ -73,6 +73,20 @@ def slicing_mode(dcm_file):
     return code_modes[mode_code]
 
 
+def _get_dcm_slice_mode(dcm_file, n_slices):
+    """ Return the `slice_mode` of `STCParameters` from the protocol of the Siemens `dcm_file`.
+    The Siemens interleaved acquisitions start from the second slice if `n_slices` is even."""
+    mode = slicing_mode(dcm_file)
+    if mode == 'interleaved':
+        return 'alt_inc2' if n_slices % 2 == 0 else 'alt_inc'
+    return {'ascending': 'seq_inc', 'descending': 'seq_dec'}[mode]
+
+
+def _get_dcm_time_repetition(dcm_file):
+    """ Return the TR in seconds from the protocol of the Siemens `dcm_file`."""
+    return float(ascconv_params(dcm_file)['alTR[0]']) / 1e6
+
+
 def _get_n_slices(in_file):
     img = nib.load(in_file)
 
@@ -139,7 +153,8 @@ def _get_slice_order(in_file, n_slices, slice_mode):
             return times
 
     def order_from_times(times):
-        return np.argsort(times) + 1
+        # 0-based like `calculate_slice_order`, `auto_spm_slicetime` adds 1 for SPM
+        return np.argsort(times, kind='stable').tolist()
 
     def calculate_slice_order(n_slices, slice_mode):
         """
@@ -241,6 +256,7 @@ class STCParameters(object):
         self.time_acquisition = None
         self.ref_slice        = None
         self.slice_mode       = 'unknown'
+        self.dcm_file         = None
 
     def fit(self, in_files,
                   num_slices       = 0,
@@ -248,7 +264,8 @@ class STCParameters(object):
                   slice_order      = None,
                   time_acquisition = None,
                   time_repetition  = None,
-                  slice_mode       = 'unknown'):
+                  slice_mode       = 'unknown',
+                  dcm_file         = None):
         """
 
         Parameters
@@ -288,6 +305,11 @@ class STCParameters(object):
             If left to default will try to detect the TR from the nifti image header, if it doesn't work
             an AttributeError exception will be raise.
 
+        dcm_file: str
+            Path to one DICOM file of the Siemens series of `in_files`.
+            If given, the `slice_mode` and `time_repetition` that are not set are
+            read from its protocol.
+
         Returns
         -------
         num_slices
@@ -307,6 +329,7 @@ class STCParameters(object):
         self.time_acquisition = time_acquisition
         self.ref_slice        = ref_slice
         self.slice_mode       = slice_mode
+        self.dcm_file         = dcm_file
 
         _ = self.set_num_slices()
         _ = self.set_slice_order()
@@ -370,6 +393,10 @@ class STCParameters(object):
         if self.time_repetition is not None:
             return self.time_repetition
 
+        if self.dcm_file:
+            self.time_repetition = _get_dcm_time_repetition(self.dcm_file)
+            return self.time_repetition
+
         error_msg = 'The TR calculated from all the `in_files` are not the same, got {}.'
         self.time_repetition = self._check_all_equal(_get_time_repetition, error_msg)
         return self.time_repetition
@@ -379,6 +406,8 @@ class STCParameters(object):
             return self.slice_order
 
         n_slices = self.set_num_slices()
+        if self.slice_mode == 'unknown' and self.dcm_file:
+            self.slice_mode = _get_dcm_slice_mode(self.dcm_file, n_slices)
 
         error_msg = 'The slice order for all `in_files` are not the same, got {}.'
         self.slice_order = self._check_all_equal(_get_slice_order,
@@ -426,6 +455,9 @@ class STCParametersInputSpec(BaseInterfaceInputSpec):
                                       "    'alt_dec2': Siemens interleaved descending with even number of slices kNIFTI_SLICE_ALT_DEC2 = 6; %3,1,4,2\n"
                                       "If left to default will try to detect the TR from the nifti image header, if it doesn't work"
                                       "an AttributeError exception will be raise.", default='unknown')
+    dcm_file         = traits.File   (desc="One DICOM file of the Siemens series of `in_files`. If set, the "
+                                           "slice_mode and time_repetition that are not set are read from its "
+                                           "protocol.", exists=True)
 
 
 class STCParametersOutputSpec(TraitedSpec):
@@ -457,6 +489,7 @@ class STCParametersInterface(BaseInterface):
         time_acquisition = get_trait_value(self.inputs, 'time_acquisition', default=None)
         time_repetition  = get_trait_value(self.inputs, 'time_repetition',  default=None)
         slice_mode       = get_trait_value(self.inputs, 'slice_mode',       default='unknown')
+        dcm_file         = get_trait_value(self.inputs, 'dcm_file',         default=None)
 
         self.stc_params = STCParameters()
 
@@ -471,6 +504,7 @@ class STCParametersInterface(BaseInterface):
                                                       time_acquisition = time_acquisition,
                                                       time_repetition  = time_repetition,
                                                       slice_mode       = slice_mode,
+                                                      dcm_file         = dcm_file,
                                                       )
         return runtime
 
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Slice timing correction of fMRI timeseries with NumPy.
+
+Each slice is shifted in time to the acquisition time of the reference slice,
+with the same parameters as the SPM SliceTiming, see `STCParameters`.
+All the voxels of a slice are shifted at once, either with a phase shift of their
+Fourier transform or with cubic spline interpolation, and the slices are processed
+in a thread pool.
+"""
+import os
+import os.path as op
+from   concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.fft
+import nibabel as nib
+from   scipy.interpolate import CubicSpline
+from   nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                      TraitedSpec, File, traits, isdefined)
+
+
+def _zero_based(num_slices, slice_order, ref_slice):
+    """ Return `slice_order` and `ref_slice` 0-based. They are 1-based, as in SPM,
+    if `slice_order` has the slices from 1 to `num_slices`."""
+    slice_order = [int(idx) for idx in slice_order]
+    if sorted(slice_order) == list(range(1, num_slices + 1)):
+        slice_order = [idx - 1 for idx in slice_order]
+        ref_slice = ref_slice - 1
+
+    if sorted(slice_order) != list(range(num_slices)):
+        raise ValueError('Expected `slice_order` to have each of the {} slices once, '
+                         'got {}.'.format(num_slices, slice_order))
+
+    if not 0 <= ref_slice < num_slices:
+        raise ValueError('Expected `ref_slice` to be one of the {} slices, '
+                         'got {}.'.format(num_slices, ref_slice))
+
+    return slice_order, ref_slice
+
+
+def slice_shifts(num_slices, slice_order, ref_slice, time_repetition, time_acquisition=None):
+    """ Return the acquisition time of each slice relative to `ref_slice`, in TR units.
+
+    Parameters
+    ----------
+    num_slices: int
+
+    slice_order: list of int
+        The slice indices in the order in which they are acquired.
+        They are 1-based, as in SPM, if they go from 1 to `num_slices`, else 0-based.
+
+    ref_slice: int
+        Index of the slice of reference, with the same base as `slice_order`.
+
+    time_repetition: float
+        The TR in seconds.
+
+    time_acquisition: float
+        Time of volume acquisition. If None, TR-(TR/num_slices).
+
+    Returns
+    -------
+    shifts: np.ndarray
+        Array of shape (num_slices,). Positive for the slices acquired after `ref_slice`.
+    """
+    if time_acquisition is None:
+        time_acquisition = time_repetition - time_repetition / num_slices
+
+    slice_order, ref_slice = _zero_based(num_slices, slice_order, ref_slice)
+
+    position = np.empty(num_slices)
+    position[slice_order] = np.arange(num_slices)
+
+    slice_time = time_acquisition / max(1, num_slices - 1)
+    return (position - position[ref_slice]) * slice_time / time_repetition
+
+
+def shift_timeseries(timeseries, shift, method='fft'):
+    """ Return `timeseries` delayed by `shift` samples along the last axis.
+
+    Parameters
+    ----------
+    timeseries: np.ndarray
+        Array of shape (n_voxels, n_volumes).
+
+    shift: float
+        The delay in samples.
+
+    method: str
+        'fft': phase shift of the Fourier transform of the timeseries padded with
+        its mirror image, so it has no jump at the edges.
+        'cubic': cubic spline interpolation, the edge values are repeated.
+
+    Returns
+    -------
+    shifted: np.ndarray
+    """
+    n_vols = timeseries.shape[-1]
+
+    if method == 'fft':
+        padded = np.concatenate([timeseries, timeseries[..., ::-1]], axis=-1)
+        spectrum = scipy.fft.rfft(padded, axis=-1)
+        spectrum *= np.exp(-2j * np.pi * scipy.fft.rfftfreq(2 * n_vols) * shift).astype(spectrum.dtype)
+        return scipy.fft.irfft(spectrum, n=2 * n_vols, axis=-1)[..., :n_vols].astype(timeseries.dtype)
+
+    if method == 'cubic':
+        times = np.arange(n_vols)
+        spline = CubicSpline(times, timeseries, axis=-1)
+        return spline(np.clip(times - shift, 0, n_vols - 1)).astype(timeseries.dtype)
+
+    raise ValueError("Expected `method` to be 'fft' or 'cubic', got {}.".format(method))
+
+
+def slice_time_correct(in_file, out_file, slice_order, ref_slice, time_repetition,
+                       time_acquisition=None, method='fft', n_jobs=1):
+    """ Shift each slice of the fMRI image `in_file` in time to the acquisition time of
+    `ref_slice` and save it in `out_file`. The slices are along the third axis.
+
+    Parameters
+    ----------
+    in_file: str
+        Path to the 4D fMRI image.
+
+    out_file: str
+
+    slice_order: list of int
+        The slice indices in the order in which they are acquired, see `slice_shifts`.
+
+    ref_slice: int
+        Index of the slice of reference, with the same base as `slice_order`.
+
+    time_repetition: float
+        The TR in seconds.
+
+    time_acquisition: float
+        Time of volume acquisition. If None, TR-(TR/num_slices).
+
+    method: str
+        'fft' or 'cubic', see `shift_timeseries`.
+
+    n_jobs: int
+        Number of threads to process the slices.
+
+    Returns
+    -------
+    out_file: str
+    """
+    img = nib.load(in_file)
+    data = img.get_fdata(dtype=np.float32)
+
+    shifts = slice_shifts(data.shape[2], slice_order, ref_slice, time_repetition, time_acquisition)
+
+    def _correct(slice_idx):
+        if shifts[slice_idx] == 0:
+            return
+        plane = data[:, :, slice_idx, :]
+        timeseries = plane.reshape(-1, plane.shape[-1])
+        data[:, :, slice_idx, :] = shift_timeseries(timeseries, shifts[slice_idx], method).reshape(plane.shape)
+
+    with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+        list(pool.map(_correct, range(data.shape[2])))
+
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    nib.Nifti1Image(data, img.affine, header).to_filename(out_file)
+    return out_file
+
+
+class SliceTimeCorrectionInputSpec(BaseInterfaceInputSpec):
+    in_file          = File(exists=True, mandatory=True, desc='The 4D fMRI image.')
+    slice_order      = traits.ListInt(mandatory=True,
+                                      desc='The slice indices in the order in which they are acquired. '
+                                           'They are 1-based, as in SPM, if they go from 1 to the number '
+                                           'of slices, else 0-based.')
+    ref_slice        = traits.Int(mandatory=True,
+                                  desc='Index of the slice of reference, with the same base as slice_order.')
+    time_repetition  = traits.Float(mandatory=True, desc='The TR in seconds.')
+    time_acquisition = traits.Float(desc='Time of volume acquisition. If not set, TR-(TR/num_slices).')
+    method           = traits.Enum('fft', 'cubic', usedefault=True,
+                                   desc="'fft' for a Fourier phase shift, 'cubic' for cubic spline interpolation.")
+    n_jobs           = traits.Int(1, usedefault=True, desc='Number of threads to process the slices.')
+    out_prefix       = traits.Str('stc', usedefault=True, desc='Prefix of the output file name.')
+
+
+class SliceTimeCorrectionOutputSpec(TraitedSpec):
+    timecorrected_files = File(exists=True, desc='The slice timing corrected image.')
+
+
+class SliceTimeCorrection(BaseInterface):
+    """ Slice timing correction with NumPy, with the parameters from `STCParametersInterface`.
+    See `slice_time_correct`.
+    """
+    input_spec  = SliceTimeCorrectionInputSpec
+    output_spec = SliceTimeCorrectionOutputSpec
+
+    def _run_interface(self, runtime):
+        time_acquisition = self.inputs.time_acquisition if isdefined(self.inputs.time_acquisition) else None
+        self._out_file = slice_time_correct(self.inputs.in_file,
+                                            op.join(os.getcwd(), self.inputs.out_prefix + op.basename(self.inputs.in_file)),
+                                            slice_order=self.inputs.slice_order,
+                                            ref_slice=self.inputs.ref_slice,
+                                            time_repetition=self.inputs.time_repetition,
+                                            time_acquisition=time_acquisition,
+                                            method=self.inputs.method,
+                                            n_jobs=self.inputs.n_jobs)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['timecorrected_files'] = self._out_file
+        return outputs
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+Execution profiling of nipype workflows.
+
+After a workflow has run, the runtime information nipype keeps in the result
+file of each node is stored in a sqlite database, keyed by workflow, node and
+subject. The peak memory and CPU usage are only available if the nipype
+resource monitor is enabled, which needs `psutil`.
+The I/O bytes are the total size of the existing input and output files of each node.
+"""
+import os
+import os.path as op
+import sqlite3
+import datetime
+import logging as log
+from   contextlib import closing
+
+import numpy as np
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS node_runs (
+    run_id      TEXT NOT NULL,
+    workflow    TEXT NOT NULL,
+    node        TEXT NOT NULL,
+    fullname    TEXT NOT NULL,
+    subject     TEXT NOT NULL,
+    interface   TEXT,
+    start_time  TEXT,
+    end_time    TEXT,
+    wall_time   REAL,
+    cpu_time    REAL,
+    peak_rss_gb REAL,
+    in_bytes    INTEGER,
+    out_bytes   INTEGER,
+    cached      INTEGER NOT NULL,
+    PRIMARY KEY (run_id, fullname, subject)
+);
+CREATE INDEX IF NOT EXISTS node_runs_node ON node_runs (node);
+"""
+
+_FIELDS = ('run_id', 'workflow', 'node', 'fullname', 'subject', 'interface',
+           'start_time', 'end_time', 'wall_time', 'cpu_time', 'peak_rss_gb',
+           'in_bytes', 'out_bytes', 'cached')
+
+
+def utc_now():
+    """ Return the current UTC time in ISO format, as nipype writes it in the node results."""
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def _parse_time(isotime):
+    """ Return the timezone-aware datetime of the ISO format `isotime`.
+    Times without timezone are taken as UTC."""
+    dtime = datetime.datetime.fromisoformat(isotime)
+    if dtime.tzinfo is None:
+        dtime = dtime.replace(tzinfo=datetime.timezone.utc)
+    return dtime
+
+
+def _files_size(values):
+    """ Return the total size in bytes of the existing files in the nested `values`."""
+    if isinstance(values, dict):
+        values = list(values.values())
+
+    if isinstance(values, (list, tuple)):
+        return sum(_files_size(val) for val in values)
+
+    if isinstance(values, str) and op.isfile(values):
+        return op.getsize(values)
+
+    return 0
+
+
+def _traits_values(spec):
+    """ Return a dict with the values in `spec`, a dict as the inputs of the
+    nipype node results, a nipype Bunch or a TraitedSpec."""
+    from nipype.interfaces.base import Bunch
+
+    if spec is None:
+        return {}
+
+    if isinstance(spec, dict):
+        return spec
+
+    if isinstance(spec, Bunch):
+        return spec.dictcopy()
+
+    return spec.get()
+
+
+def _cpu_time(runtime):
+    """ Return the CPU time in seconds from the resource monitor samples in `runtime`,
+    or None if they are not available."""
+    prof = getattr(runtime, 'prof_dict', None)
+    if not prof or len(prof.get('time', [])) < 2:
+        return None
+
+    times = np.asarray(prof['time'], dtype=float)
+    cpus = np.asarray(prof['cpus'], dtype=float) / 100.
+    return float(np.sum(np.diff(times) * (cpus[1:] + cpus[:-1]) / 2.))
+
+
+def node_subject(node):
+    """ Return a string that identifies the iterables parameterization of `node`,
+    e.g., '_subject_id_S001', or an empty string for the group-level nodes."""
+    return '/'.join(str(p) for p in node.parameterization)
+
+
+def node_record(node, run_id, workflow, run_start=''):
+    """ Return a dict with the runtime information of the executed `node`
+    or None if it does not have a result file.
+
+    Parameters
+    ----------
+    node: nipype Node
+        A node from the execution graph of a workflow.
+
+    run_id: str
+
+    workflow: str
+        Name of the top workflow.
+
+    run_start: str
+        UTC time in ISO format when the workflow started. The nodes that
+        finished before this time are marked as cached.
+
+    Returns
+    -------
+    record: dict
+    """
+    try:
+        result = node.result
+    except Exception as exc:
+        log.debug('Could not load the result of {}: {}.'.format(node.fullname, exc))
+        return None
+
+    runtime = getattr(result, 'runtime', None)
+    if isinstance(runtime, list):
+        # MapNode results have a list of runtimes
+        runtimes = [rt for rt in runtime if rt is not None]
+    else:
+        runtimes = [runtime] if runtime is not None else []
+
+    def _sum(values):
+        values = [v for v in values if v is not None]
+        return sum(values) if values else None
+
+    def _max(values):
+        values = [v for v in values if v is not None]
+        return max(values) if values else None
+
+    start_times = [rt.startTime for rt in runtimes if getattr(rt, 'startTime', None)]
+    end_times   = [rt.endTime   for rt in runtimes if getattr(rt, 'endTime',   None)]
+    end_time    = max(end_times, key=_parse_time) if end_times else None
+    cached      = bool(run_start and end_time and _parse_time(end_time) < _parse_time(run_start))
+
+    return {'run_id':      run_id,
+            'workflow':    workflow,
+            'node':        node.name,
+            'fullname':    node.fullname,
+            'subject':     node_subject(node),
+            'interface':   node.interface.__class__.__name__,
+            'start_time':  min(start_times, key=_parse_time) if start_times else None,
+            'end_time':    end_time,
+            'wall_time':   _sum([getattr(rt, 'duration', None)    for rt in runtimes]),
+            'cpu_time':    _sum([_cpu_time(rt)                    for rt in runtimes]),
+            'peak_rss_gb': _max([getattr(rt, 'mem_peak_gb', None) for rt in runtimes]),
+            'in_bytes':    _files_size(_traits_values(getattr(result, 'inputs',  None))),
+            'out_bytes':   _files_size(_traits_values(getattr(result, 'outputs', None))),
+            'cached':      int(cached),
+           }
+
+
+def critical_path(execgraph, records):
+    """ Return the longest path by wall time through `execgraph`.
+    The cached nodes count as 0 seconds.
+
+    Parameters
+    ----------
+    execgraph: networkx.DiGraph
+        The execution graph returned by `Workflow.run`.
+
+    records: dict
+        (fullname, subject) -> record, as returned by `node_record`.
+
+    Returns
+    -------
+    path: list of records
+
+    total_time: float
+    """
+    import networkx as nx
+
+    def _weight(node):
+        rec = records.get((node.fullname, node_subject(node)))
+        if rec is None or rec['cached']:
+            return 0.
+        return rec['wall_time'] or 0.
+
+    dist, prev = {}, {}
+    for node in nx.topological_sort(execgraph):
+        preds = list(execgraph.predecessors(node))
+        best = max(preds, key=lambda n: dist[n]) if preds else None
+        dist[node] = _weight(node) + (dist[best] if best is not None else 0.)
+        prev[node] = best
+
+    if not dist:
+        return [], 0.
+
+    node = max(dist, key=lambda n: dist[n])
+    total_time = dist[node]
+    path = []
+    while node is not None:
+        rec = records.get((node.fullname, node_subject(node)))
+        if rec is not None:
+            path.append(rec)
+        node = prev[node]
+
+    return path[::-1], total_time
+
+
+class RuntimeDB(object):
+    """ Database of the runtime information of the nodes of the executed workflows.
+
+    Parameters
+    ----------
+    db_file: str
+        Path to the sqlite database file. It will be created if it does not exist.
+
+    timeout: float
+        Seconds to wait for the database lock.
+    """
+    def __init__(self, db_file, timeout=60.0):
+        self.db_file = op.abspath(op.expanduser(db_file))
+        self.timeout = timeout
+
+        db_dir = op.dirname(self.db_file)
+        if not op.exists(db_dir):
+            os.makedirs(db_dir)
+
+        with closing(self._connect()) as conn:
+            with conn:
+                conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def add_records(self, records):
+        """ Insert the node `records` in the database. See `node_record`."""
+        query = 'INSERT OR REPLACE INTO node_runs ({}) VALUES ({})'.format(', '.join(_FIELDS),
+                                                                           ', '.join('?' * len(_FIELDS)))
+        with closing(self._connect()) as conn:
+            with conn:
+                conn.executemany(query, [tuple(rec[f] for f in _FIELDS) for rec in records])
+
+    def records(self, run_id=None, node=None, include_cached=False):
+        """ Return a list of dicts with the stored node records, optionally
+        filtered by `run_id` and `node` name."""
+        where, args = [], []
+        if run_id is not None:
+            where.append('run_id = ?')
+            args.append(run_id)
+        if node is not None:
+            where.append('node = ?')
+            args.append(node)
+        if not include_cached:
+            where.append('cached = 0')
+
+        query = 'SELECT * FROM node_runs'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+
+        with closing(self._connect()) as conn:
+            return [dict(row) for row in conn.execute(query, args)]
+
+    def node_maxima(self):
+        """ Return a dict from node name to a dict with the maximum 'peak_rss_gb' and the
+        maximum ratio of CPU time to wall time, 'threads', of its records that were not cached.
+        These are None if they were not recorded."""
+        query = ('SELECT node, MAX(peak_rss_gb) AS peak_rss_gb, MAX(cpu_time / wall_time) AS threads '
+                 'FROM node_runs WHERE cached = 0 GROUP BY node')
+        with closing(self._connect()) as conn:
+            return {row['node']: {'peak_rss_gb': row['peak_rss_gb'], 'threads': row['threads']}
+                    for row in conn.execute(query)}
+
+    def slowest_nodes(self, run_id=None, n_nodes=10):
+        """ Return the `n_nodes` records with the largest wall time."""
+        recs = [rec for rec in self.records(run_id=run_id) if rec['wall_time'] is not None]
+        return sorted(recs, key=lambda rec: rec['wall_time'], reverse=True)[:n_nodes]
+
+    def __repr__(self):
+        return '<profiling.RuntimeDB> ({})'.format(self.db_file)
+
+
+def _format_record(rec):
+    def _fmt(value, fmt):
+        return fmt.format(value) if value is not None else '-'
+
+    io_mb = (rec['in_bytes'] + rec['out_bytes']) / 2**20
+    return '{:>10} {:>10} {:>10} {:>10}  {} {}'.format(_fmt(rec['wall_time'],   '{:.1f}'),
+                                                       _fmt(rec['cpu_time'],    '{:.1f}'),
+                                                       _fmt(rec['peak_rss_gb'], '{:.2f}'),
+                                                       _fmt(io_mb,              '{:.1f}'),
+                                                       rec['fullname'],
+                                                       rec['subject'])
+
+
+def profile_summary(records, path, total_time, n_nodes=10):
+    """ Return a text summary with the slowest nodes and the critical path.
+
+    Parameters
+    ----------
+    records: list of dict
+        The node records of one run.
+
+    path: list of dict
+        The critical path, see `critical_path`.
+
+    total_time: float
+        The wall time of the critical path.
+
+    n_nodes: int
+        Number of slowest nodes to show.
+
+    Returns
+    -------
+    summary: str
+    """
+    header = '{:>10} {:>10} {:>10} {:>10}  {}'.format('wall (s)', 'cpu (s)', 'rss (GB)', 'i/o (MB)', 'node')
+    executed = [rec for rec in records if not rec['cached'] and rec['wall_time'] is not None]
+    slowest = sorted(executed, key=lambda rec: rec['wall_time'], reverse=True)[:n_nodes]
+
+    lines = ['Executed {} nodes, {} cached.'.format(len(executed), len(records) - len(executed)),
+             '',
+             'Slowest nodes:',
+             header]
+    lines.extend(_format_record(rec) for rec in slowest)
+    lines.extend(['',
+                  'Critical path ({:.1f}s):'.format(total_time),
+                  header])
+    lines.extend(_format_record(rec) for rec in path if not rec['cached'])
+    return '\n'.join(lines)
+
+
+def profile_execgraph(execgraph, workflow, db_file, run_id, run_start='', n_nodes=10):
+    """ Store the runtime information of the nodes in `execgraph` in the
+    database `db_file` and return the text summary of the run.
+
+    Parameters
+    ----------
+    execgraph: networkx.DiGraph
+        The execution graph returned by `Workflow.run`.
+
+    workflow: str
+        Name of the workflow.
+
+    db_file: str
+        Path to the sqlite database file.
+
+    run_id: str
+        Identifier of this run.
+
+    run_start: str
+        UTC time in ISO format when the workflow started.
+
+    n_nodes: int
+        Number of slowest nodes to show in the summary.
+
+    Returns
+    -------
+    summary: str
+    """
+    records = {}
+    for node in execgraph.nodes():
+        rec = node_record(node, run_id=run_id, workflow=workflow, run_start=run_start)
+        if rec is not None:
+            records[(rec['fullname'], rec['subject'])] = rec
+
+    RuntimeDB(db_file).add_records(list(records.values()))
+
+    path, total_time = critical_path(execgraph, records)
+    return profile_summary(list(records.values()), path, total_time, n_nodes=n_nodes)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Memory and threads estimates for the nodes, used by the MultiProc scheduler.
+
+The estimates for a node are taken, in this order of priority, from:
+- the '<node_name>.mem_gb' and '<node_name>.n_procs' configuration settings,
+- the runtime database of previous profiled runs, see `pypes.profiling`,
+- a heuristic based on the size of the input images of the workflow.
+"""
+import os
+import os.path as op
+import logging as log
+
+import numpy as np
+import nibabel as nib
+from   nipype.interfaces.io import IOBase
+from   nipype.interfaces.utility import IdentityInterface, Merge, Select, Split, Rename
+
+
+# names of the node configuration settings that are not node inputs
+RESOURCE_PARAMS = ('mem_gb', 'n_procs')
+
+# interfaces that do not load any image
+_LIGHT_INTERFACES = (IOBase, IdentityInterface, Merge, Select, Split, Rename)
+
+# margin over the peak memory recorded in the previous runs
+HISTORY_MEM_MARGIN = 1.25
+
+# the heuristic memory estimate is:
+# IMAGE_MEM_OVERHEAD + IMAGE_MEM_FACTOR * size of the input image data
+IMAGE_MEM_FACTOR = 3.
+IMAGE_MEM_OVERHEAD = 0.3
+
+# the size in GB of the largest input image and the number of subjects
+# of the workflow being built, see `set_reference_input`
+_REFERENCE_INPUT = {'image_gb': 0., 'n_subjects': 1}
+
+
+def image_data_gb(image_file):
+    """ Return the size in GB of the data of `image_file` once loaded as float64.
+    Only the header is read. Return 0 if it is not a readable image."""
+    try:
+        shape = nib.load(image_file).header.get_data_shape()
+    except Exception:
+        return 0.
+    return float(8 * np.prod(shape, dtype=float)) / 2**30
+
+
+def set_reference_input(image_files, n_subjects=1):
+    """ Set the input images of one subject and the number of subjects of the
+    workflow being built. They are used by `heuristic_estimate`.
+
+    Parameters
+    ----------
+    image_files: list of str
+
+    n_subjects: int
+    """
+    sizes = [image_data_gb(f) for f in image_files]
+    _REFERENCE_INPUT['image_gb'] = max(sizes) if sizes else 0.
+    _REFERENCE_INPUT['n_subjects'] = max(1, n_subjects)
+
+
+# the node maxima of each runtime database, see `history_estimate`
+_HISTORY_CACHE = {}
+
+
+def _history_maxima(db_file):
+    """ Return the node maxima of the runtime database `db_file`, see `RuntimeDB.node_maxima`.
+    They are read once, and again only if the file has been modified."""
+    from .profiling import RuntimeDB
+
+    mtime = os.stat(db_file).st_mtime_ns
+    cached = _HISTORY_CACHE.get(db_file)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    maxima = RuntimeDB(db_file).node_maxima()
+    _HISTORY_CACHE[db_file] = (mtime, maxima)
+    return maxima
+
+
+def history_estimate(node_name, db_file):
+    """ Return the resource estimates for the nodes with name `node_name`
+    from the records of the runtime database `db_file`.
+
+    Parameters
+    ----------
+    node_name: str
+
+    db_file: str
+        Path to the database, see `pypes.profiling.RuntimeDB`.
+
+    Returns
+    -------
+    resources: dict
+        With 'mem_gb' and 'n_procs' if they were recorded.
+    """
+    db_file = op.abspath(op.expanduser(db_file))
+    if not op.exists(db_file):
+        return {}
+
+    try:
+        maxima = _history_maxima(db_file).get(node_name, {})
+    except Exception as exc:
+        log.debug('Could not read the runtime database {}: {}.'.format(db_file, exc))
+        return {}
+
+    resources = {}
+    if maxima.get('peak_rss_gb') is not None:
+        resources['mem_gb'] = round(maxima['peak_rss_gb'] * HISTORY_MEM_MARGIN, 2)
+
+    if maxima.get('threads') is not None:
+        resources['n_procs'] = max(1, int(round(maxima['threads'])))
+
+    return resources
+
+
+def heuristic_estimate(interface, is_join=False):
+    """ Return the memory estimate for a node with `interface` from the size of
+    the reference input image. The JoinNodes are expected to load the images of
+    all the subjects.
+
+    Parameters
+    ----------
+    interface: nipype Interface
+
+    is_join: bool
+        True if the node is a JoinNode.
+
+    Returns
+    -------
+    resources: dict
+        With 'mem_gb', or empty if there is no reference input.
+    """
+    if isinstance(interface, _LIGHT_INTERFACES):
+        return {}
+
+    image_gb = _REFERENCE_INPUT['image_gb']
+    if not image_gb:
+        return {}
+
+    if is_join:
+        image_gb *= _REFERENCE_INPUT['n_subjects']
+
+    return {'mem_gb': round(IMAGE_MEM_OVERHEAD + IMAGE_MEM_FACTOR * image_gb, 2)}
+
+
+def node_resources(interface, name, params, is_join=False, db_file=''):
+    """ Return the resource estimates for the node `name` with `interface`.
+
+    Parameters
+    ----------
+    interface: nipype Interface
+
+    name: str
+        Name of the node.
+
+    params: dict
+        The configuration parameters of the node.
+
+    is_join: bool
+        True if the node is a JoinNode.
+
+    db_file: str
+        Path to the runtime database. If empty, the history is not used.
+
+    Returns
+    -------
+    resources: dict
+        With 'mem_gb' and/or 'n_procs', to be given to the Node constructor.
+    """
+    resources = heuristic_estimate(interface, is_join=is_join)
+    if db_file:
+        resources.update(history_estimate(name, db_file))
+    resources.update({k: params[k] for k in RESOURCE_PARAMS if k in params})
+    return resources
@@ -2,10 +2,18 @@
 """
 Helper functions to build base workflow and run them
 """
+import os
+import os.path as op
+import re
+import logging as log
+
+from pypes.config import (save_config_snapshot, use_config_snapshot, get_config_setting,
+                          SNAPSHOT_ENVVAR)
 from pypes.plot import plot_workflow
+from pypes.profiling import profile_execgraph, utc_now
 
 
-def run_wf(wf, plugin='MultiProc', n_cpus=2, **plugin_kwargs):
+def run_wf(wf, plugin='MultiProc', n_cpus=2, profile_db='', **plugin_kwargs):
     """ Execute `wf` with `plugin`.
 
     Parameters
@@ -19,20 +27,94 @@ def run_wf(wf, plugin='MultiProc', n_cpus=2, **plugin_kwargs):
     n_cpus: int
         Number of CPUs to use with the 'MultiProc' plugin.
 
+    profile_db: str
+        Path to a sqlite database file where to store the wall time, CPU time,
+        peak memory and I/O bytes of each node. A summary of the slowest nodes
+        and the critical path is printed at the end.
+        If empty, will use the `profile_db_file` configuration setting.
+        If that is also empty, the execution is not profiled.
+        See `pypes.profiling`.
+
     plugin_kwargs: keyword argumens
         Keyword arguments for the plugin if using something different
-        then 'MultiProc'.
+        then 'MultiProc'. With 'MultiProc', only `plugin_args` is used,
+        e.g., `plugin_args={'memory_gb': 32}`.
+
+    Returns
+    -------
+    execgraph: networkx.DiGraph
+        The execution graph of `wf`.
+
+    Notes
+    -----
+    A frozen snapshot of the current configuration is saved in the working
+    directory of `wf` and it is read by the worker processes, instead of the
+    configuration files. See `pypes.config.FrozenConfig`.
     """
-    # run the workflow according to `plugin`
-    if plugin == "MultiProc" or n_cpus > 1:
-        wf.run("MultiProc", plugin_args={"n_procs": n_cpus})
-    elif not plugin or plugin is None or n_cpus <= 1:
-        wf.run(plugin=None)
-    else:
-        wf.run(plugin=plugin, **plugin_kwargs)
+    if not profile_db:
+        profile_db = get_config_setting('profile_db_file', default='')
+
+    snapshot_file, snapshot = _save_wf_config_snapshot(wf)
+
+    # the forked workers inherit the snapshot, the spawned ones load it from the file
+    prev_snapshot = use_config_snapshot(snapshot)
+    prev_snapshot_file = os.environ.get(SNAPSHOT_ENVVAR)
+    os.environ[SNAPSHOT_ENVVAR] = snapshot_file
+
+    prev_monitor = _set_resource_monitor(True) if profile_db else None
+    run_start = utc_now()
+    try:
+        # run the workflow according to `plugin`
+        if plugin == "MultiProc" or n_cpus > 1:
+            # the node estimates larger than the available resources are clipped,
+            # see `pypes.resources`
+            plugin_args = dict(plugin_kwargs.get('plugin_args') or {})
+            plugin_args.setdefault('raise_insufficient', False)
+            plugin_args["n_procs"] = n_cpus
+            execgraph = wf.run("MultiProc", plugin_args=plugin_args)
+        elif not plugin or plugin is None or n_cpus <= 1:
+            execgraph = wf.run(plugin=None)
+        else:
+            execgraph = wf.run(plugin=plugin, **plugin_kwargs)
+    finally:
+        use_config_snapshot(prev_snapshot)
+        if prev_snapshot_file is None:
+            os.environ.pop(SNAPSHOT_ENVVAR, None)
+        else:
+            os.environ[SNAPSHOT_ENVVAR] = prev_snapshot_file
+
+        if prev_monitor is not None:
+            _set_resource_monitor(prev_monitor)
+
+    if profile_db:
+        run_id = '{}_{}'.format(wf.name, run_start)
+        print(profile_execgraph(execgraph, workflow=wf.name, db_file=profile_db,
+                                run_id=run_id, run_start=run_start))
+
+    return execgraph
+
+
+def _set_resource_monitor(enabled):
+    """ Switch the nipype resource monitor and return its previous state.
+    It will stay disabled if `psutil` is not installed."""
+    from nipype import config
+
+    prev = config.resource_monitor
+    config.resource_monitor = enabled
+    return prev
 
 
-def run_debug(workflow, plugin="MultiProc", n_cpus=4, **plugin_kwargs):
+def _save_wf_config_snapshot(wf):
+    """ Save a snapshot of the global configuration in the working directory of `wf`
+    and return the file path and the snapshot."""
+    wf_dir = op.join(wf.base_dir or os.getcwd(), wf.name)
+    os.makedirs(wf_dir, exist_ok=True)
+
+    snapshot_file = op.join(wf_dir, 'pypes_config.pkl')
+    return snapshot_file, save_config_snapshot(snapshot_file)
+
+
+def run_debug(workflow, plugin="MultiProc", n_cpus=4, profile_db='', **plugin_kwargs):
     """ Execute `wf` with `plugin`.
 
     Parameters
@@ -46,6 +128,10 @@ def run_debug(workflow, plugin="MultiProc", n_cpus=4, **plugin_kwargs):
     n_cpus: int
         Number of CPUs to use with the 'MultiProc' plugin.
 
+    profile_db: str
+        Path to a sqlite database file to profile the execution.
+        See `run_wf`.
+
     plugin_kwargs: keyword argumens
         Keyword arguments for the plugin if using something different
         then 'MultiProc'.
@@ -56,7 +142,7 @@ def run_debug(workflow, plugin="MultiProc", n_cpus=4, **plugin_kwargs):
         plot_workflow(workflow)
 
         # run it
-        run_wf(workflow, plugin=plugin, n_cpus=n_cpus,
+        run_wf(workflow, plugin=plugin, n_cpus=n_cpus, profile_db=profile_db,
                **plugin_kwargs)
     except:
         import sys
@@ -68,3 +154,124 @@ def run_debug(workflow, plugin="MultiProc", n_cpus=4, **plugin_kwargs):
         raise
     else:
         print('Workflow successfully finished.')
+
+
+def _is_node_dir(dirpath):
+    """ Return True if `dirpath` is the working folder of a nipype node,
+    which have the pickled node, inputs and result files."""
+    return any(f.endswith('.pklz') for f in os.listdir(dirpath))
+
+
+def _is_parameterization_dir(dirpath):
+    """ Return True if `dirpath` looks like a folder created by nipype for
+    an iterables parameterization, e.g., '_subject_id_S001'."""
+    name = op.basename(dirpath)
+    return name.startswith('_') or re.match(r'^[0-9a-f]{40}$', name) is not None
+
+
+def link_shard_work_dirs(shard_wf, reduce_wf):
+    """ Create symbolic links in the working directory of `reduce_wf` to the
+    subject-level folders of the working directory of `shard_wf`.
+    This way the nodes already run in the shard are found cached by the reduce workflow.
+
+    Parameters
+    ----------
+    shard_wf: nipype Workflow
+
+    reduce_wf: nipype Workflow
+
+    Returns
+    -------
+    links: list of str
+        The paths to the new links.
+    """
+    src_root = op.join(shard_wf.base_dir, shard_wf.name)
+    dst_root = op.join(reduce_wf.base_dir, reduce_wf.name)
+    if not op.exists(src_root):
+        return []
+
+    links = []
+    for dirpath, dirnames, _ in os.walk(src_root):
+        reldir = op.relpath(dirpath, src_root)
+        for dirname in list(dirnames):
+            src = op.join(dirpath, dirname)
+            if _is_node_dir(src):
+                dirnames.remove(dirname)
+                continue
+
+            if not _is_parameterization_dir(src):
+                continue
+
+            # do not go into the subject folders
+            dirnames.remove(dirname)
+
+            dst = op.normpath(op.join(dst_root, reldir, dirname))
+            if op.lexists(dst):
+                continue
+
+            os.makedirs(op.dirname(dst), exist_ok=True)
+            os.symlink(src, dst)
+            links.append(dst)
+
+    return links
+
+
+def run_shards(shard_wfs, reduce_wf=None, shard_ids=None, plugin='MultiProc', n_cpus=2,
+               **plugin_kwargs):
+    """ Execute the shard workflows and then, if all of them finished, the `reduce_wf`.
+    See `pypes.io.build_crumb_shard_workflows`.
+
+    A failure in one shard does not stop the other shards.
+    To run the shards in different machines, call this function in each one with
+    different `shard_ids` and `reduce_wf` as None. Then, call it once with
+    all the `shard_wfs`, `shard_ids` as an empty list and the `reduce_wf`.
+
+    Parameters
+    ----------
+    shard_wfs: list of nipype Workflow
+
+    reduce_wf: nipype Workflow or None
+        The workflow with the group steps.
+
+    shard_ids: list of int
+        The indices of the shards in `shard_wfs` to run.
+        If None, will run all of them.
+
+    plugin: str
+        The pipeline execution plugin.
+        See wf.run docstring for choices.
+
+    n_cpus: int
+        Number of CPUs to use with the 'MultiProc' plugin.
+
+    plugin_kwargs: keyword argumens
+        Keyword arguments for the plugin if using something different
+        then 'MultiProc'.
+
+    Returns
+    -------
+    failed: list of int
+        The indices of the shards that failed.
+    """
+    if shard_ids is None:
+        shard_ids = list(range(len(shard_wfs)))
+
+    failed = []
+    for idx in shard_ids:
+        log.info('Running shard {} of {}.'.format(idx + 1, len(shard_wfs)))
+        try:
+            run_wf(shard_wfs[idx], plugin=plugin, n_cpus=n_cpus, **plugin_kwargs)
+        except Exception as exc:
+            log.exception('Shard {} failed: {}.'.format(idx, exc))
+            failed.append(idx)
+
+    if failed:
+        log.error('Shards {} failed, the group steps will not be run.'.format(failed))
+        return failed
+
+    if reduce_wf is not None:
+        for shard_wf in shard_wfs:
+            link_shard_work_dirs(shard_wf, reduce_wf)
+        run_wf(reduce_wf, plugin=plugin, n_cpus=n_cpus, **plugin_kwargs)
+
+    return failed
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import nibabel as nib
+import pytest
+
+import pypes.config
+from   pypes.config import PYPES_CFG
+
+
+@pytest.fixture(autouse=True)
+def pypes_cfg():
+    """ Restore the global configuration and snapshot after each test."""
+    from kaptan import Kaptan
+
+    settings = dict(PYPES_CFG.items())
+    snapshot = pypes.config._SNAPSHOT
+    read_node_names = set(pypes.config._READ_NODE_NAMES)
+
+    yield PYPES_CFG
+
+    PYPES_CFG._cpt = Kaptan()
+    PYPES_CFG.update(settings)
+    PYPES_CFG._update_node_index()
+    pypes.config.use_config_snapshot(snapshot)
+    pypes.config._READ_NODE_NAMES.clear()
+    pypes.config._READ_NODE_NAMES.update(read_node_names)
+
+
+@pytest.fixture
+def rest_files(tmpdir):
+    """ A 4D image with its brain and CSF masks and a motion design file."""
+    rng = np.random.RandomState(0)
+    n_vols = 60
+    motion = rng.randn(n_vols, 6)
+    data = (rng.randn(6, 6, 5, n_vols) * 10 + 100 +
+            np.tensordot(rng.randn(6, 6, 5, 6), motion.T, axes=1)).astype(np.float32)
+
+    brain = np.zeros(data.shape[:3], dtype=np.uint8)
+    brain[1:5, 1:5, 1:4] = 1
+    csf = np.zeros_like(brain)
+    csf[2:4, 2:4, :] = 1
+
+    files = {}
+    for name, vol in [('rest', data), ('brain', brain), ('csf', csf)]:
+        files[name] = str(tmpdir.join(name + '.nii.gz'))
+        nib.Nifti1Image(vol, np.eye(4)).to_filename(files[name])
+    files['motion'] = str(tmpdir.join('motion.txt'))
+    np.savetxt(files['motion'], motion)
+    return files
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from pypes.config import PYPES_CFG, update_config, _get_params_for, node_settings
+
+
+def test_node_params_index():
+
+    update_config({'anat_warp.bias_regularization': 0.1,
+                   'anat_warp.write_interp': 3,
+                   'anat_warp_extra.plot': True,
+                   'spm_dir': '~/spm12',
+                   })
+
+    assert(_get_params_for('anat_warp') == {'bias_regularization': 0.1,
+                                            'write_interp': 3})
+    assert(_get_params_for('anat_warp_extra') == {'plot': True})
+    assert(_get_params_for('anat') == {})
+
+    assert(dict(node_settings('anat_warp')) == {'anat_warp.bias_regularization': 0.1,
+                                                'anat_warp.write_interp': 3})
+
+    PYPES_CFG['anat_warp.write_interp'] = 4
+    assert(_get_params_for('anat_warp')['write_interp'] == 4)
+
+
+def test_setup_node_resources():
+    from nipype.interfaces.utility import IdentityInterface
+    from pypes.config import setup_node
+
+    update_config({'res_node.mem_gb': 2.5,
+                   'res_node.n_procs': 3,
+                   'res_node.a': 1,
+                   })
+
+    node = setup_node(IdentityInterface(fields=['a']), name='res_node')
+    assert(node.mem_gb == 2.5)
+    assert(node.n_procs == 3)
+    assert(node.inputs.a == 1)
+
+    node = setup_node(IdentityInterface(fields=['a']), name='res_node', mem_gb=1)
+    assert(node.mem_gb == 1)
+
+
+def test_unmatched_node_settings():
+    from pypes.config import unmatched_node_settings, get_config_setting
+
+    update_config({'anat_warp.write_interp': 3,
+                   'anat_warp_extra.plot': True,
+                   'anat_extra.plot': True,
+                   'rest_filter.tr': 2,
+                   })
+
+    # 'anat_warp_extra' was applied to 'anat_warp' with the prefix matching
+    assert(unmatched_node_settings(['anat_warp']) == ['anat_warp_extra.plot'])
+
+    # the settings read by name are not reported
+    assert(get_config_setting('anat_warp_extra.plot') is True)
+    assert(unmatched_node_settings(['anat_warp']) == [])
+    assert(unmatched_node_settings(['anat']) == ['anat_extra.plot', 'anat_warp.write_interp'])
+
+
+def test_config_is_restored():
+    assert('anat_extra.plot' not in PYPES_CFG.keys())
+    assert(_get_params_for('anat_warp') == {})
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import os
+import os.path as op
+
+import pytest
+
+try:
+    from pypes.convert.batch import convert_dicom_series, plan_conversions
+except ImportError:
+    pytest.skip('the pypes.convert dependencies are not available', allow_module_level=True)
+
+
+class FakeIndex(object):
+    """ A `DicomIndex` with the given files of each series."""
+    def __init__(self, series_files):
+        self._series_files = series_files
+
+    def series(self):
+        return [{'series_uid': uid, 'n_files': len(files)} for uid, files in self._series_files.items()]
+
+    def series_files(self, series_uid):
+        return sorted(self._series_files[series_uid])
+
+
+def _files(folder, n_files):
+    return [op.join(folder, '{}.dcm'.format(idx)) for idx in range(n_files)]
+
+
+@pytest.fixture
+def index():
+    """ The series 1.1 is in 'rest' and 3 of its files are copied in 'mixed'."""
+    rest = op.join('/data', 'subj01', 'session_0', 'rest')
+    mixed = op.join('/data', 'subj01', 'session_0', 'mixed')
+    return FakeIndex({'1.1': _files(rest, 10) + _files(mixed, 3),
+                      '1.2': [op.join(mixed, 'anat{}.dcm'.format(idx)) for idx in range(20)],
+                      '1.3': _files(op.join('/data_other', 'subj01', 'rest'), 30) + _files('/data', 2)})
+
+
+def test_plan_conversions(index):
+    tasks = plan_conversions(index, '/data', '/out')
+
+    # the largest folder first, each series from the folder where it has the most files,
+    # and only the folders under the input folder
+    assert([(task['folder'], task['n_files'], task['series']) for task in tasks] ==
+           [('/data/subj01/session_0/mixed', 23, [('1.2', 20)]),
+            ('/data/subj01/session_0/rest', 10, [('1.1', 10)])])
+    assert(tasks[1]['out_dir'] == op.join('/out', 'subj01', 'session_0'))
+    assert(tasks[1]['out_name'] == 'rest')
+
+    assert(plan_conversions(index, '/data', '/out', converted={('1.1', 10): []})[0]['series'] ==
+           [('1.2', 20)])
+    assert(len(plan_conversions(index, '/data', '/out', converted={('1.1', 10): [],
+                                                                    ('1.2', 20): []})) == 0)
+
+
+def test_convert_dicom_series_resumes(tmpdir, index):
+    calls = []
+
+    def converter(folder, out_dir, out_name):
+        calls.append(folder)
+        if out_name == 'rest' and len(calls) <= 2:
+            raise RuntimeError('conversion failed')
+
+        out_file = op.join(out_dir, out_name + '.nii.gz')
+        open(out_file, 'w').close()
+        return [out_file]
+
+    output_dir = str(tmpdir.join('out'))
+    converted, failed = convert_dicom_series(index, '/data', output_dir, n_jobs=1, converter=converter)
+    assert(converted == ['/data/subj01/session_0/mixed'])
+    assert([folder for folder, _ in failed] == ['/data/subj01/session_0/rest'])
+
+    # only the failed folder is converted again, and then nothing
+    converted, failed = convert_dicom_series(index, '/data', output_dir, n_jobs=1, converter=converter)
+    assert((converted, failed) == (['/data/subj01/session_0/rest'], []))
+    assert(convert_dicom_series(index, '/data', output_dir, n_jobs=1, converter=converter) == ([], []))
+    assert(len(calls) == 3)
+
+    # a series is converted again if its output is removed
+    os.remove(op.join(output_dir, 'subj01', 'session_0', 'rest.nii.gz'))
+    assert(convert_dicom_series(index, '/data', output_dir, n_jobs=1,
+                                converter=converter)[0] == ['/data/subj01/session_0/rest'])
+
+
+def _fake_is_compressed(dcm_file):
+    with open(dcm_file) as f:
+        content = f.read()
+    if content == 'unreadable':
+        raise IOError('not a DICOM file')
+    return content != 'raw'
+
+
+def _fake_decompress_dicom(dcm_file):
+    with open(dcm_file) as f:
+        if f.read() == 'broken':
+            raise ValueError('could not decode the pixel data')
+    with open(dcm_file, 'w') as f:
+        f.write('raw')
+    return dcm_file
+
+
+def test_decompress_dicoms(tmpdir, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    import pypes.convert.decompress as decompress
+
+    monkeypatch.setattr(decompress, 'is_compressed', _fake_is_compressed)
+    monkeypatch.setattr(decompress, 'decompress_dicom', _fake_decompress_dicom)
+    # the monkeypatched functions are not seen by the child processes
+    monkeypatch.setattr(decompress, 'ProcessPoolExecutor', ThreadPoolExecutor)
+
+    dcm_files = []
+    for name, content in [('a', 'jpeg2000'), ('b', 'raw'), ('c', 'unreadable'), ('d', 'broken')]:
+        dcm_file = tmpdir.join(name + '.dcm')
+        dcm_file.write(content)
+        dcm_files.append(str(dcm_file))
+
+    decompressed, failed = decompress.decompress_dicoms(dcm_files, n_jobs=2)
+    assert(decompressed == [dcm_files[0]])
+    assert([path for path, _ in failed] == [dcm_files[2], dcm_files[3]])
+    assert(failed[1][1] == 'ValueError: could not decode the pixel data')
+    assert(tmpdir.join('a.dcm').read() == 'raw')
+
+
+def test_decompress_dicom_gdcmconv(tmpdir, monkeypatch):
+    pytest.importorskip('pydicom')
+    import pypes.convert.decompress as decompress
+
+    def gdcmconv_raw(dcm_file, out_file):
+        with open(out_file, 'w') as f:
+            f.write('partial')
+        if 'broken' in dcm_file:
+            raise IOError('gdcmconv failed')
+        with open(out_file, 'w') as f:
+            f.write('raw')
+
+    monkeypatch.setattr(decompress, '_gdcmconv_raw', gdcmconv_raw)
+
+    # the files that pydicom can not read are decompressed with gdcmconv
+    dcm_file = tmpdir.join('a.dcm')
+    dcm_file.write('jpeg2000')
+    assert(decompress.decompress_dicom(str(dcm_file)) == str(dcm_file))
+    assert(dcm_file.read() == 'raw')
+
+    # a failed decompression leaves the file as it was
+    dcm_file = tmpdir.join('broken.dcm')
+    dcm_file.write('jpeg2000')
+    with pytest.raises(IOError):
+        decompress.decompress_dicom(str(dcm_file))
+    assert(dcm_file.read() == 'jpeg2000')
+    assert(sorted(path.basename for path in tmpdir.listdir()) == ['a.dcm', 'broken.dcm'])
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+import os.path as op
+import sqlite3
+from   contextlib import closing
+
+import pytest
+
+try:
+    import hansel
+except ImportError:
+    pytest.skip('hansel is not available', allow_module_level=True)
+
+from pypes.crumb_index import CrumbIndex
+
+
+def _touch(path):
+    os.makedirs(op.dirname(path), exist_ok=True)
+    open(path, 'w').close()
+
+
+@pytest.fixture
+def data_tree(tmpdir):
+    base = str(tmpdir.join('data'))
+    _touch(op.join(base, 'subj01', 'session_0', 'anat.nii'))
+    _touch(op.join(base, 'subj01', 'session_1', 'anat.nii'))
+    _touch(op.join(base, 'subj02', 'session_0', 'anat.nii'))
+    os.makedirs(op.join(base, 'subj03', 'session_0'))
+    return base
+
+
+def test_values_map_and_unfold(tmpdir, data_tree):
+    crumb = hansel.Crumb(op.join(data_tree, '{subj}', '{session}', 'anat.nii'))
+    index = CrumbIndex(str(tmpdir.join('index', 'crumbs.sqlite')))
+
+    values = index.values_map(crumb, 'subj')
+    assert(values == [[('subj', 'subj01')], [('subj', 'subj02')], [('subj', 'subj03')]])
+
+    paths = [cr.path for cr in index.unfold(crumb)]
+    assert(paths == [op.join(data_tree, 'subj01', 'session_0', 'anat.nii'),
+                     op.join(data_tree, 'subj01', 'session_1', 'anat.nii'),
+                     op.join(data_tree, 'subj02', 'session_0', 'anat.nii')])
+
+    assert(index.exists(crumb))
+    assert(not index.exists(hansel.Crumb(op.join(data_tree, 'subj04', '{session}'))))
+
+
+def test_joint_value_map_needs_complete_paths(tmpdir, data_tree):
+    crumb = hansel.Crumb(op.join(data_tree, '{subj}', '{session}', '{image}'))
+    index = CrumbIndex(str(tmpdir.join('crumbs.sqlite')))
+
+    # subj03 has a session folder but no image
+    assert(index.joint_value_map(crumb, ['subj']) == [(('subj', 'subj01'),),
+                                                     (('subj', 'subj02'),)])
+    assert(index.joint_value_map(crumb, ['subj', 'session']) ==
+           [(('subj', 'subj01'), ('session', 'session_0')),
+            (('subj', 'subj01'), ('session', 'session_1')),
+            (('subj', 'subj02'), ('session', 'session_0'))])
+
+
+def test_index_is_updated_with_modified_folders(tmpdir, data_tree):
+    crumb = hansel.Crumb(op.join(data_tree, '{subj}', '{session}', 'anat.nii'))
+    index = CrumbIndex(str(tmpdir.join('crumbs.sqlite')))
+    assert(len(index.unfold(crumb)) == 3)
+
+    _touch(op.join(data_tree, 'subj04', 'session_0', 'anat.nii'))
+    os.utime(data_tree, ns=(0, os.stat(data_tree).st_mtime_ns + 10 ** 9))
+    assert(len(index.unfold(crumb)) == 4)
+
+    index.clear(crumb)
+    assert(len(index.unfold(crumb)) == 4)
+
+
+def test_clear_keeps_other_trees(tmpdir):
+    for base in ('data_1', 'dataX1'):
+        _touch(str(tmpdir.join(base, 'subj01', 'session_0', 'anat.nii')))
+
+    index = CrumbIndex(str(tmpdir.join('crumbs.sqlite')))
+    for base in ('data_1', 'dataX1'):
+        index.unfold(hansel.Crumb(str(tmpdir.join(base, '{subj}', '{session}', 'anat.nii'))))
+    index.clear(hansel.Crumb(str(tmpdir.join('data_1', '{subj}', '{session}', 'anat.nii'))))
+
+    with closing(sqlite3.connect(index.index_file)) as conn:
+        dir_paths = sorted(row[0] for row in conn.execute('SELECT dir_path FROM listings'))
+    assert(dir_paths == [str(tmpdir.join('dataX1')), str(tmpdir.join('dataX1', 'subj01'))])
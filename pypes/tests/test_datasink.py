@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import os
+import os.path as op
+
+import pytest
+
+from pypes.datasink import link_or_copy, LinkDataSink
+
+
+@pytest.fixture
+def src_file(tmpdir):
+    src = tmpdir.mkdir('work').join('anat.nii')
+    src.write('image data')
+    return str(src)
+
+
+def test_link_or_copy_copy(tmpdir, src_file):
+    dst = str(tmpdir.mkdir('out').join('anat.nii'))
+    assert(link_or_copy(src_file, dst, link_mode='copy') == 'copy')
+    assert(open(dst).read() == 'image data')
+    assert(not op.samefile(src_file, dst))
+
+
+def test_link_or_copy_hardlink(tmpdir, src_file):
+    dst = tmpdir.mkdir('out').join('anat.nii')
+    dst.write('old output')
+    dst = str(dst)
+    assert(link_or_copy(src_file, dst, link_mode='hardlink') == 'hardlink')
+    assert(op.samefile(src_file, dst))
+
+
+def test_link_or_copy_move(tmpdir, src_file):
+    dst = str(tmpdir.mkdir('out').join('anat.nii'))
+    assert(link_or_copy(src_file, dst, link_mode='move') == 'move')
+    assert(op.islink(src_file))
+    assert(os.readlink(src_file) == dst)
+    assert(open(dst).read() == 'image data')
+
+
+def test_link_or_copy_bad_mode(tmpdir, src_file):
+    with pytest.raises(ValueError):
+        link_or_copy(src_file, str(tmpdir.join('anat.nii')), link_mode='symlink')
+
+
+def test_link_datasink(tmpdir, src_file):
+    sink = LinkDataSink(base_directory=str(tmpdir.join('out')), link_mode='hardlink',
+                        parameterization=False)
+    sink.inputs.container = 'subj01'
+    sink.inputs.substitutions = [('anat.nii', 'anat_hc.nii')]
+    setattr(sink.inputs, 'anat.@image', src_file)
+
+    out_files = sink._list_outputs()['out_file']
+    dst = str(tmpdir.join('out', 'subj01', 'anat', 'anat_hc.nii'))
+    assert(out_files == [dst])
+    assert(op.samefile(src_file, dst))
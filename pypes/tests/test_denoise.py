@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+try:
+    from dipy.denoise.nlmeans import nlmeans
+    from pypes.preproc.denoise import parallel_nlmeans
+except ImportError:
+    pytest.skip('dipy or the pypes.preproc dependencies are not available', allow_module_level=True)
+
+
+@pytest.fixture
+def noisy_data():
+    rng = np.random.RandomState(0)
+    return np.abs(rng.rand(20, 20, 40) * 100 + rng.randn(20, 20, 40) * 10)
+
+
+@pytest.mark.parametrize('n_jobs', [2, 3, 6])
+@pytest.mark.parametrize('radii', [{}, {'patch_radius': 1, 'block_radius': 2}])
+def test_parallel_nlmeans_3d(noisy_data, n_jobs, radii):
+    mask = np.ones(noisy_data.shape, dtype=bool)
+    expected = nlmeans(noisy_data, sigma=10., mask=mask, **radii)
+    denoised = parallel_nlmeans(noisy_data, sigma=10., mask=mask, n_jobs=n_jobs, **radii)
+    assert(np.allclose(denoised, expected))
+
+
+def test_parallel_nlmeans_4d(noisy_data):
+    data = np.stack([noisy_data[..., :10], noisy_data[..., 10:20]], axis=-1)
+    mask = np.ones(data.shape[:3], dtype=bool)
+    sigma = np.array([10., 12.])
+    expected = nlmeans(data, sigma=sigma, mask=mask)
+    assert(np.allclose(parallel_nlmeans(data, sigma=sigma, mask=mask, n_jobs=2), expected))
+
+
+@pytest.fixture
+def aniso_img():
+    import nibabel as nib
+
+    rng = np.random.RandomState(0)
+    data = rng.rand(12, 10, 6, 3).astype(np.float32) * 100
+    img = nib.Nifti1Image(data, np.diag([2., 2., 3., 1.]))
+    img.header.set_zooms((2., 2., 3., 2.5))
+    return img
+
+
+def test_reslice_img(aniso_img):
+    from dipy.align.reslice import reslice
+    from pypes.preproc.denoise import reslice_img
+
+    expected, affine = reslice(np.asarray(aniso_img.dataobj), aniso_img.affine,
+                               (2., 2., 3.), (2., 2., 2.), order=3)
+
+    for n_jobs in (1, 2):
+        nu_img = reslice_img(aniso_img, n_jobs=n_jobs)
+        assert(nu_img.header.get_zooms() == (2., 2., 2., 2.5))
+        assert(np.allclose(nu_img.affine, affine))
+        assert(np.allclose(np.asarray(nu_img.dataobj), expected, atol=1e-3))
+
+
+def test_reslice_img_int(aniso_img):
+    import nibabel as nib
+    from pypes.preproc.denoise import reslice_img
+
+    int_img = nib.Nifti1Image(np.asarray(aniso_img.dataobj).astype(np.int16), aniso_img.affine,
+                              aniso_img.header)
+    int_img.set_data_dtype(np.int16)
+
+    float_img = nib.Nifti1Image(np.asarray(int_img.dataobj).astype(np.float32), int_img.affine,
+                                int_img.header)
+    float_img.set_data_dtype(np.float32)
+
+    float_data = np.asarray(reslice_img(float_img).dataobj)
+    int_data = np.asarray(reslice_img(int_img).dataobj)
+    assert(int_data.dtype == np.int16)
+    assert(np.array_equal(int_data, np.rint(float_data)))
+
+
+def test_reslice_img_isotropic(aniso_img):
+    import nibabel as nib
+    from pypes.preproc.denoise import reslice_img
+
+    iso_img = nib.Nifti1Image(np.asarray(aniso_img.dataobj), np.eye(4))
+    nu_img = reslice_img(iso_img)
+    assert(np.array_equal(np.asarray(nu_img.dataobj), np.asarray(iso_img.dataobj)))
+
+
+def test_reslice_img_int_range(aniso_img):
+    import nibabel as nib
+    from pypes.preproc.denoise import reslice_img
+
+    # a sharp edge, the cubic spline undershoots 0 next to it
+    data = np.zeros(aniso_img.shape, dtype=np.uint16)
+    data[:, :, 3:] = 60000
+    header = aniso_img.header.copy()
+    header.set_data_dtype(np.uint16)
+    int_img = nib.Nifti1Image(data, aniso_img.affine, header)
+    float_img = nib.Nifti1Image(data.astype(np.float32), aniso_img.affine, aniso_img.header)
+
+    float_data = np.asarray(reslice_img(float_img).dataobj)
+    int_data = np.asarray(reslice_img(int_img).dataobj)
+    assert(float_data.min() < 0)
+    assert(int_data.dtype == np.uint16)
+    assert(np.array_equal(int_data, np.clip(np.rint(float_data), 0, 65535)))
+
+
+@pytest.mark.parametrize('in_ext', ['.nii', '.nii.gz'])
+@pytest.mark.parametrize('ext', ['.nii', '.nii.gz'])
+def test_reslice_file(tmpdir, aniso_img, in_ext, ext):
+    import nibabel as nib
+    from pypes.preproc.denoise import reslice_file, reslice_img
+
+    in_file = str(tmpdir.join('dwi' + in_ext))
+    aniso_img.to_filename(in_file)
+
+    out_file = reslice_file(in_file, str(tmpdir.join('dwi_iso' + ext)), n_jobs=2)
+    out_img = nib.load(out_file)
+    expected = reslice_img(aniso_img)
+    assert(out_img.shape == expected.shape)
+    assert(np.allclose(out_img.affine, expected.affine))
+    assert(np.allclose(out_img.get_fdata(), np.asarray(expected.dataobj)))
+
+
+def test_reslice_file_extensions(tmpdir, aniso_img):
+    import nibabel as nib
+    from pypes.preproc.denoise import reslice_file, reslice_img
+
+    aniso_img.header.extensions.append(nib.nifti1.Nifti1Extension('comment', b'x' * 30))
+    in_file = str(tmpdir.join('dwi.nii'))
+    aniso_img.to_filename(in_file)
+
+    out_img = nib.load(reslice_file(in_file, str(tmpdir.join('dwi_iso.nii'))))
+    assert(out_img.header.extensions[0].get_content() == b'x' * 30)
+    assert(np.allclose(out_img.get_fdata(), np.asarray(reslice_img(aniso_img).dataobj)))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import os.path as op
+from collections import namedtuple
+
+import pytest
+
+try:
+    import pypes.preproc.dicom as dicom
+    import pypes.preproc.slicetime_params as slicetime_params
+except ImportError:
+    pytest.skip('the pypes.preproc dependencies are not available', allow_module_level=True)
+
+
+AHDR = '\n'.join(['ulVersion = 51130001',
+                  '### ASCCONV BEGIN object=MrProtDataImpl@MrProtocolData version=51130001 ###',
+                  'sSliceArray.ucMode                       = 0x4',
+                  'alTR[0]                                  = 2000000',
+                  'tProtocolName                            = "rest # 1"',
+                  'sKSpace.ucDimension                      = 0x2  # 2D',
+                  '# a comment = 1',
+                  '### ASCCONV END ###',
+                  'trailing = 1'])
+
+FakeHeader = namedtuple('FakeHeader', ('SeriesInstanceUID',))
+
+
+@pytest.fixture
+def fake_dicoms(monkeypatch):
+    """ Three files of two series, the header reads are counted by file."""
+    uids = {'a1.dcm': '1.2.3', 'a2.dcm': '1.2.3', 'b1.dcm': '1.2.4'}
+    reads = []
+
+    monkeypatch.setattr(dicom, '_ASCCONV_CACHE', {})
+    monkeypatch.setattr(dicom, 'read_dcm_header', lambda dcm_file, tags=None: FakeHeader(uids[dcm_file]))
+    monkeypatch.setattr(dicom, 'dcm_ascii_hdr', lambda dcm_file: reads.append(dcm_file) or AHDR)
+    return reads
+
+
+def test_split_dcm_ahdr():
+    meta, ascconv = dicom.split_dcm_ahdr(AHDR)
+    assert(meta == ['ulVersion = 51130001', ''])
+    assert(ascconv[1] == 'sSliceArray.ucMode                       = 0x4')
+    assert(not any('trailing' in line for line in ascconv))
+
+
+def test_parse_ascconv():
+    params = dicom.parse_ascconv(dicom.split_dcm_ahdr(AHDR)[1])
+    assert(params == {'sSliceArray.ucMode': '0x4',
+                      'alTR[0]': '2000000',
+                      'tProtocolName': '"rest # 1"',
+                      'sKSpace.ucDimension': '0x2'})
+
+
+def test_ascconv_params_memory_cache(fake_dicoms):
+    params = dicom.ascconv_params('a1.dcm', cache_dir='')
+    assert(dicom.ascconv_params('a2.dcm', cache_dir='') is params)
+    assert(fake_dicoms == ['a1.dcm'])
+
+    dicom.ascconv_params('b1.dcm', cache_dir='')
+    assert(fake_dicoms == ['a1.dcm', 'b1.dcm'])
+
+
+def test_ascconv_params_file_cache(tmpdir, fake_dicoms):
+    cache_dir = str(tmpdir.join('cache'))
+    params = dicom.ascconv_params('a1.dcm', cache_dir=cache_dir)
+    assert(op.exists(op.join(cache_dir, '1.2.3.json')))
+
+    # another process finds the series in the cache folder
+    dicom._ASCCONV_CACHE.clear()
+    assert(dicom.ascconv_params('a2.dcm', cache_dir=cache_dir) == params)
+    assert(fake_dicoms == ['a1.dcm'])
+
+
+@pytest.mark.parametrize('mode, n_slices, slice_mode', [('0x1', 30, 'seq_inc'),
+                                                        ('0x2', 30, 'seq_dec'),
+                                                        ('0x4', 31, 'alt_inc'),
+                                                        ('0x4', 30, 'alt_inc2')])
+def test_get_dcm_slice_mode(monkeypatch, mode, n_slices, slice_mode):
+    monkeypatch.setattr(slicetime_params, 'ascconv_params',
+                        lambda dcm_file: {'sSliceArray.ucMode': mode, 'alTR[0]': '2500000'})
+    assert(slicetime_params._get_dcm_slice_mode('a1.dcm', n_slices) == slice_mode)
+    assert(slicetime_params._get_dcm_time_repetition('a1.dcm') == 2.5)
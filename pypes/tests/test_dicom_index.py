@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import os
+import os.path as op
+
+import pytest
+
+try:
+    from hansel import Crumb
+except ImportError:
+    pytest.skip('hansel is not available', allow_module_level=True)
+
+import pypes.dicom_index
+from   pypes.dicom_index import DicomIndex
+
+
+def _write_dicom(path, series_uid):
+    os.makedirs(op.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(series_uid)
+
+
+@pytest.fixture
+def read_files(monkeypatch):
+    """ The fake DICOM files have their SeriesInstanceUID as content.
+    Returns the list of the files read."""
+    read = []
+
+    def read_dicom_tags(dcm_file, tags):
+        read.append(dcm_file)
+        with open(dcm_file) as f:
+            return f.read(), {'Modality': 'MR'}
+
+    monkeypatch.setattr(pypes.dicom_index, 'read_dicom_tags', read_dicom_tags)
+    return read
+
+
+def _scan(index, crumb_path):
+    return index.scan(Crumb(crumb_path), n_jobs=2, crumb_index_file='')
+
+
+def test_scan(tmpdir, read_files):
+    base = str(tmpdir.join('data'))
+    for subj_id, series_uid in [('subj01', '1.1'), ('subj02', '1.2')]:
+        for idx in range(3):
+            _write_dicom(op.join(base, subj_id, 'rest', '{}.dcm'.format(idx)), series_uid)
+
+    index = DicomIndex(str(tmpdir.join('dicom_index.sqlite')))
+    crumb_path = op.join(base, '{subj_id}', 'rest', '{dcm_file}')
+    assert(_scan(index, crumb_path) == 6)
+
+    series = index.series()
+    assert([(rec['series_uid'], rec['subj_id'], rec['n_files']) for rec in series] ==
+           [('1.1', 'subj01', 3), ('1.2', 'subj02', 3)])
+    assert(index.series(subj_id='subj02', Modality='MR')[0]['series_uid'] == '1.2')
+    assert(index.series_files('1.1') == [op.join(base, 'subj01', 'rest', '{}.dcm'.format(idx))
+                                         for idx in range(3)])
+
+    # only the modified files are read again, and the missing ones are removed
+    dcm_file = op.join(base, 'subj01', 'rest', '0.dcm')
+    stat = os.stat(dcm_file)
+    os.utime(dcm_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    os.remove(op.join(base, 'subj02', 'rest', '0.dcm'))
+    del read_files[:]
+    assert(_scan(index, crumb_path) == 1)
+    assert(read_files == [dcm_file])
+    assert([rec['n_files'] for rec in index.series()] == [3, 2])
+
+
+def test_scan_keeps_other_trees(tmpdir, read_files):
+    """ The '_' of a base directory does not match other characters, and the scans of
+    different crumb patterns under the same base directory do not remove each other's files."""
+    for base, series_uid in [('dataX1', '1.1'), ('data_1', '1.2')]:
+        _write_dicom(str(tmpdir.join(base, 'subj01', 'rest', '0.dcm')), series_uid)
+    _write_dicom(str(tmpdir.join('data_1', 'subj01', 'anat', '0.dcm')), '1.3')
+
+    index = DicomIndex(str(tmpdir.join('dicom_index.sqlite')))
+    _scan(index, str(tmpdir.join('dataX1', '{subj_id}', 'rest', '{dcm_file}')))
+    _scan(index, str(tmpdir.join('data_1', '{subj_id}', 'rest', '{dcm_file}')))
+    _scan(index, str(tmpdir.join('data_1', '{subj_id}', 'anat', '{dcm_file}')))
+    assert(sorted(rec['series_uid'] for rec in index.series()) == ['1.1', '1.2', '1.3'])
+
+    del read_files[:]
+    assert(_scan(index, str(tmpdir.join('data_1', '{subj_id}', 'rest', '{dcm_file}'))) == 0)
+    assert(sorted(rec['series_uid'] for rec in index.series()) == ['1.1', '1.2', '1.3'])
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import os.path as op
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+try:
+    from pypes.fmri.filter import bandpass_bins, bandpass_img, bandpass_timeseries, signal_clean
+    from pypes.preproc.regress import nuisance_regression
+except ImportError:
+    pytest.skip('the pypes.fmri dependencies are not available', allow_module_level=True)
+
+
+def test_bandpass_timeseries():
+    rng = np.random.RandomState(0)
+    data = rng.randn(100, 50)
+    bins = bandpass_bins(100, lowpass_freq=0.1, highpass_freq=0.01, tr=2)
+    assert(np.flatnonzero(bins).tolist() == list(range(2, 20)))
+
+    spectrum = np.fft.rfft(data, axis=0)
+    spectrum[~bins] = 0
+    expected = np.fft.irfft(spectrum, n=100, axis=0)
+
+    filtered = bandpass_timeseries(data.copy(), bins, chunk_size=7)
+    assert(np.allclose(filtered, expected))
+
+    # only the given columns are filtered, in the precision of the data
+    data32 = data.astype(np.float32)
+    filtered = bandpass_timeseries(data32.copy(), bins, columns=np.arange(10))
+    assert(filtered.dtype == np.float32)
+    assert(np.allclose(filtered[:, :10], expected[:, :10], atol=1e-5))
+    assert(np.array_equal(filtered[:, 10:], data32[:, 10:]))
+
+
+def _nuisance_kwargs(rest_files):
+    return dict(brain_mask=rest_files['brain'], compcor_masks=[rest_files['csf']],
+                compcor_components=2, gsr_components=1)
+
+
+def test_signal_clean_as_regress_then_bandpass(tmpdir, rest_files):
+    """ The same result as the nuisance regression followed by the bandpass filter."""
+    regressed = nuisance_regression(rest_files['rest'], motion_design=rest_files['motion'],
+                                    save_stages=True, out_dir=str(tmpdir.mkdir('regress')),
+                                    **_nuisance_kwargs(rest_files))
+    expected = bandpass_img(regressed['out_file'], str(tmpdir.join('expected.nii.gz')),
+                            lowpass_freq=0.1, highpass_freq=0.01, tr=2,
+                            mask_file=rest_files['brain'])
+
+    outputs = signal_clean(rest_files['rest'], confounds=rest_files['motion'],
+                           lowpass_freq=0.1, highpass_freq=0.01, tr=2, save_stages=True,
+                           out_dir=str(tmpdir.mkdir('clean')), **_nuisance_kwargs(rest_files))
+
+    assert(op.basename(outputs['out_file']) == 'rest_filtermotart_cleaned_gsr_bandpassed.nii.gz')
+    assert(np.allclose(nib.load(outputs['out_file']).get_fdata(),
+                       nib.load(expected).get_fdata(), atol=1e-3))
+
+    # the stages before the bandpass filter
+    assert(op.basename(outputs['nuis_corrected']) == 'rest_filtermotart_cleaned_gsr.nii.gz')
+    assert(np.allclose(nib.load(outputs['nuis_corrected']).get_fdata(),
+                       nib.load(regressed['out_file']).get_fdata(), atol=1e-3))
+    for stage in ('motion_res', 'compcor_res', 'compcor_regressors', 'gsr_regressors'):
+        assert(op.basename(outputs[stage]) == op.basename(regressed[stage]))
+
+
+@pytest.mark.parametrize('save_stages', [False, True])
+def test_signal_clean_without_bandpass(tmpdir, rest_files, save_stages):
+    regressed = nuisance_regression(rest_files['rest'], motion_design=rest_files['motion'],
+                                    out_dir=str(tmpdir.mkdir('regress')), **_nuisance_kwargs(rest_files))
+
+    outputs = signal_clean(rest_files['rest'], confounds=rest_files['motion'], save_stages=save_stages,
+                           out_dir=str(tmpdir.mkdir('clean')), **_nuisance_kwargs(rest_files))
+
+    assert(op.basename(outputs['out_file']) == 'rest_filtermotart_cleaned_gsr.nii.gz')
+    assert(np.allclose(nib.load(outputs['out_file']).get_fdata(),
+                       nib.load(regressed['out_file']).get_fdata(), atol=1e-3))
+    if save_stages:
+        assert(outputs['nuis_corrected'] == outputs['out_file'])
+    else:
+        assert('nuis_corrected' not in outputs)
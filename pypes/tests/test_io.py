@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import os.path as op
+
+import pytest
+
+try:
+    import hansel
+except ImportError:
+    pytest.skip('hansel is not available', allow_module_level=True)
+
+import nipype.pipeline.engine as pe
+from   nipype.interfaces.io import DataSink
+from   nipype.interfaces.utility import IdentityInterface
+
+import pypes.io
+from   pypes.io import build_crumb_workflow
+
+
+def attach_subject_step(main_wf, wf_name):
+    infosrc = main_wf.get_node('infosrc')
+    node = pe.Node(IdentityInterface(fields=['subject_id']), name=wf_name)
+    datasink = pe.Node(DataSink(), name='{}_datasink'.format(wf_name))
+    main_wf.connect([(infosrc, node, [('subject_id', 'subject_id')]),
+                     (node, datasink, [('subject_id', 'container')]),
+                    ])
+    return main_wf
+
+
+def attach_group_step(main_wf, wf_name):
+    main_wf = attach_subject_step(main_wf, wf_name)
+    join = pe.JoinNode(IdentityInterface(fields=['subject_id']), joinsource='infosrc',
+                       joinfield='subject_id', name='{}_group'.format(wf_name))
+    main_wf.connect([(main_wf.get_node(wf_name), join, [('subject_id', 'subject_id')])])
+    return main_wf
+
+
+@pytest.fixture
+def data_crumb(tmpdir, monkeypatch):
+    base = tmpdir.join('raw')
+    for subj in ('subj01', 'subj02', 'subj03'):
+        base.join(subj).ensure('anat.nii')
+
+    # subj01 is up to date
+    monkeypatch.setattr(pypes.io, 'uptodate_subjects',
+                        lambda data_crumb, values_map, *args, **kwargs: values_map[:1])
+    return hansel.Crumb(op.join(str(base), '{subject_id}', '{image}'))
+
+
+def _build(attacher, data_crumb, tmpdir):
+    return build_crumb_workflow({'subject_step': attacher},
+                                data_crumb=data_crumb,
+                                in_out_kwargs={'anat': [('image', 'anat.nii')]},
+                                output_dir=str(tmpdir.join('out')),
+                                cache_dir=str(tmpdir.join('wd')),
+                                skip_uptodate=True)
+
+
+def test_skip_uptodate_subjects(tmpdir, data_crumb):
+    n_calls = []
+
+    def attacher(main_wf, wf_name):
+        n_calls.append(1)
+        return attach_subject_step(main_wf, wf_name)
+
+    wf = _build(attacher, data_crumb, tmpdir)
+    assert(dict(wf.get_node('infosrc').iterables)['subject_id'] == ['subj02', 'subj03'])
+    assert(len(n_calls) == 1)
+
+    # the manifest is written after all the datasinks
+    merge_outputs = wf.get_node('manifest_outputs')
+    assert(set(node.name for node in wf._graph.predecessors(merge_outputs)) ==
+           {'datasink', 'subject_step_datasink'})
+    assert(wf.get_node('manifest') in wf._graph.successors(merge_outputs))
+
+
+def test_skip_uptodate_keeps_subjects_of_group_steps(tmpdir, data_crumb):
+    wf = _build(attach_group_step, data_crumb, tmpdir)
+    assert(dict(wf.get_node('infosrc').iterables)['subject_id'] == ['subj01', 'subj02', 'subj03'])
+    assert(wf.get_node('manifest') is not None)
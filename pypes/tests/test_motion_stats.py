@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import os.path as op
+
+import numpy as np
+import pytest
+
+try:
+    from pypes.preproc.motion_stats import censor_masks, save_censor_masks, load_censor_masks
+except ImportError:
+    pytest.skip('the pypes.preproc dependencies are not available', allow_module_level=True)
+
+
+def test_save_censor_masks(tmpdir):
+    fd = [0., 0.1, 0.6, 0.1, 0.1, 0.9, 0.1, 0.1, 0.1]
+    masks, combinations = censor_masks(fd, thresholds=[0.5], windows=[(1, 2)])
+
+    out_file = save_censor_masks(str(tmpdir.join('censor_masks')), masks, combinations)
+    assert(out_file == str(tmpdir.join('censor_masks.npz')))
+    assert(op.exists(out_file))
+
+    loaded, loaded_combinations = load_censor_masks(out_file)
+    assert(np.array_equal(loaded, masks))
+    assert(loaded_combinations == [(0.5, 1, 2)])
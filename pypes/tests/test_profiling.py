@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+
+import networkx as nx
+import nipype.pipeline.engine as pe
+from   nipype.interfaces.utility import Function
+
+from pypes.profiling import (RuntimeDB, critical_path, profile_execgraph, profile_summary,
+                             _cpu_time, _files_size)
+
+
+FakeNode = namedtuple('FakeNode', ('fullname', 'parameterization'))
+
+
+def _record(fullname, wall_time, cached=0, run_id='run1'):
+    return {'run_id': run_id, 'workflow': 'wf', 'node': fullname.split('.')[-1],
+            'fullname': fullname, 'subject': '', 'interface': 'Function',
+            'start_time': None, 'end_time': None, 'wall_time': wall_time,
+            'cpu_time': None, 'peak_rss_gb': None, 'in_bytes': 0, 'out_bytes': 0,
+            'cached': cached}
+
+
+def test_files_size(tmpdir):
+    in_file = tmpdir.join('in.txt')
+    in_file.write('x' * 10)
+    assert(_files_size({'in_file': str(in_file),
+                        'in_files': [str(in_file), [str(in_file)]],
+                        'value': 3,
+                        'missing': str(tmpdir.join('missing.txt'))}) == 30)
+
+
+def test_cpu_time():
+    class Runtime(object):
+        prof_dict = {'time': [0., 1., 3.], 'cpus': [100., 100., 200.]}
+
+    assert(_cpu_time(Runtime()) == 1. + 2. * 1.5)
+    assert(_cpu_time(object()) is None)
+
+
+def test_critical_path():
+    a, b, c, d = [FakeNode('wf.{}'.format(name), ()) for name in 'abcd']
+    graph = nx.DiGraph([(a, b), (a, c), (b, d), (c, d)])
+    records = {(n.fullname, ''): rec for n, rec in zip((a, b, c, d),
+                                                       [_record('wf.a', 1.),
+                                                        _record('wf.b', 5.),
+                                                        _record('wf.c', 10., cached=1),
+                                                        _record('wf.d', 2.)])}
+
+    path, total_time = critical_path(graph, records)
+    assert([rec['fullname'] for rec in path] == ['wf.a', 'wf.b', 'wf.d'])
+    assert(total_time == 8.)
+
+    summary = profile_summary(list(records.values()), path, total_time)
+    assert('Executed 3 nodes, 1 cached.' in summary)
+    assert('Critical path (8.0s):' in summary)
+
+
+def test_runtime_db(tmpdir):
+    db = RuntimeDB(str(tmpdir.join('db', 'runtime.sqlite')))
+    db.add_records([_record('wf.a', 1.), _record('wf.b', 5.), _record('wf.c', 10., cached=1),
+                    _record('wf.a', 3., run_id='run2')])
+
+    assert(len(db.records()) == 3)
+    assert(len(db.records(include_cached=True)) == 4)
+    assert([rec['wall_time'] for rec in db.records(node='a')] == [1., 3.])
+    assert([rec['fullname'] for rec in db.slowest_nodes(run_id='run1')] == ['wf.b', 'wf.a'])
+
+
+def add_one(value):
+    return value + 1
+
+
+def copy_file(in_file):
+    import os.path as op
+    import shutil
+
+    out_file = op.abspath('copy.txt')
+    shutil.copy(in_file, out_file)
+    return out_file
+
+
+def test_profile_execgraph(tmpdir):
+    wf = pe.Workflow(name='profiled', base_dir=str(tmpdir))
+    first = pe.Node(Function(function=add_one, input_names=['value'], output_names=['value']),
+                    name='first')
+    first.inputs.value = 1
+    second = pe.Node(Function(function=add_one, input_names=['value'], output_names=['value']),
+                     name='second')
+    wf.connect([(first, second, [('value', 'value')])])
+    execgraph = wf.run(plugin='Linear')
+
+    db_file = str(tmpdir.join('runtime.sqlite'))
+    summary = profile_execgraph(execgraph, workflow='profiled', db_file=db_file, run_id='run1')
+
+    records = RuntimeDB(db_file).records(run_id='run1')
+    assert(sorted(rec['node'] for rec in records) == ['first', 'second'])
+    assert(all(rec['wall_time'] is not None for rec in records))
+    assert('Executed 2 nodes, 0 cached.' in summary)
+
+
+def test_profile_execgraph_io_bytes(tmpdir):
+    in_file = tmpdir.join('in.txt')
+    in_file.write('x' * 100)
+
+    wf = pe.Workflow(name='profiled', base_dir=str(tmpdir))
+    copy = pe.Node(Function(function=copy_file, input_names=['in_file'], output_names=['out_file']),
+                   name='copy')
+    copy.inputs.in_file = str(in_file)
+    wf.add_nodes([copy])
+    execgraph = wf.run(plugin='Linear')
+
+    db_file = str(tmpdir.join('runtime.sqlite'))
+    profile_execgraph(execgraph, workflow='profiled', db_file=db_file, run_id='run1')
+
+    record = RuntimeDB(db_file).records(run_id='run1')[0]
+    assert((record['in_bytes'], record['out_bytes']) == (100, 100))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import os.path as op
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+try:
+    from pypes.preproc.regress import (design_basis, masked_timeseries, noise_components,
+                                       nuisance_regression, project_out)
+except ImportError:
+    pytest.skip('the pypes.preproc dependencies are not available', allow_module_level=True)
+
+
+@pytest.mark.parametrize('ext', ['.nii', '.nii.gz'])
+def test_masked_timeseries(tmpdir, ext):
+    rng = np.random.RandomState(0)
+    data = (rng.rand(6, 5, 4, 40) * 1000).astype(np.int16)
+    mask = rng.rand(6, 5, 4) > 0.5
+
+    in_file = str(tmpdir.join('rest' + ext))
+    nib.Nifti1Image(data, np.eye(4)).to_filename(in_file)
+
+    timeseries = masked_timeseries(in_file, mask, chunk_size=16)
+    assert(timeseries.dtype == np.float32)
+    assert(np.array_equal(timeseries, data[mask].T))
+
+
+def test_design_basis_project_out():
+    rng = np.random.RandomState(0)
+    design = rng.randn(50, 3)
+    # a column that is a combination of the others and the intercept
+    design = np.hstack([design, design[:, :1] * 2 + 1])
+    data = rng.randn(50, 30) + 10
+
+    basis = design_basis(design)
+    assert(basis.shape == (50, 4))
+    assert(np.allclose(basis.T.dot(basis), np.eye(4)))
+
+    # the same residuals as a least squares fit with an intercept
+    full = np.hstack([np.ones((50, 1)), design])
+    expected = data - full.dot(np.linalg.lstsq(full, data, rcond=None)[0])
+    assert(np.allclose(project_out(basis, data.copy(), chunk_size=7), expected))
+
+
+def test_noise_components():
+    rng = np.random.RandomState(0)
+    timeseries = rng.randn(40, 200) * rng.rand(200) * 10 + rng.rand(200)
+
+    components = noise_components(timeseries, num_components=3, chunk_size=64)
+
+    # the left singular vectors of the standardized timeseries, up to the sign
+    X = (timeseries - timeseries.mean(axis=0)) / timeseries.std(axis=0)
+    u, _, _ = np.linalg.svd(X, full_matrices=False)
+    assert(np.allclose(np.abs(components), np.abs(u[:, :3])))
+
+
+def test_nuisance_regression(tmpdir, rest_files):
+    outputs = nuisance_regression(rest_files['rest'], rest_files['brain'], rest_files['motion'],
+                                  compcor_masks=[rest_files['csf']], compcor_components=2,
+                                  gsr_components=1, save_stages=True, out_dir=str(tmpdir))
+
+    assert(op.basename(outputs['out_file']) == 'rest_filtermotart_cleaned_gsr.nii.gz')
+    assert(op.basename(outputs['motion_res']) == 'rest_filtermotart.nii.gz')
+    assert(op.basename(outputs['compcor_res']) == 'rest_filtermotart_cleaned.nii.gz')
+    assert(np.loadtxt(outputs['compcor_regressors']).shape == (60, 2 + 6))
+    assert(np.loadtxt(outputs['gsr_regressors']).shape == (60,))
+
+    # the motion residuals of the brain voxels, as fsl_glm --demean
+    brain = np.asanyarray(nib.load(rest_files['brain']).dataobj) > 0
+    data = nib.load(rest_files['rest']).get_fdata()[brain].T
+    design = np.hstack([np.ones((60, 1)), np.loadtxt(rest_files['motion'])])
+    expected = data - design.dot(np.linalg.lstsq(design, data, rcond=None)[0])
+    motion_res = nib.load(outputs['motion_res']).get_fdata()
+    assert(np.allclose(motion_res[brain].T, expected, atol=1e-3))
+    assert(np.all(motion_res[~brain] == 0))
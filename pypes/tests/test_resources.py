@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import os
+
+from pypes.profiling import RuntimeDB
+from pypes.resources import history_estimate
+
+
+def _record(node, wall_time, cpu_time, peak_rss_gb, run_id='run1', cached=0):
+    return {'run_id': run_id, 'workflow': 'wf', 'node': node,
+            'fullname': 'wf.{}'.format(node), 'subject': '', 'interface': 'Function',
+            'start_time': None, 'end_time': None, 'wall_time': wall_time,
+            'cpu_time': cpu_time, 'peak_rss_gb': peak_rss_gb, 'in_bytes': 0, 'out_bytes': 0,
+            'cached': cached}
+
+
+def test_history_estimate(tmpdir, monkeypatch):
+    db_file = str(tmpdir.join('runtime.sqlite'))
+    db = RuntimeDB(db_file)
+    db.add_records([_record('realign', 10., 38., 1.2),
+                    _record('realign', 10., 20., 2., run_id='run2'),
+                    _record('realign', 10., 80., 9., run_id='run3', cached=1),
+                    _record('smooth', 0., None, None)])
+
+    n_reads = []
+    node_maxima = RuntimeDB.node_maxima
+    monkeypatch.setattr(RuntimeDB, 'node_maxima',
+                        lambda self: n_reads.append(1) or node_maxima(self))
+
+    assert(history_estimate('realign', db_file) == {'mem_gb': 2.5, 'n_procs': 4})
+    assert(history_estimate('smooth', db_file) == {})
+    assert(history_estimate('coregister', db_file) == {})
+    assert(len(n_reads) == 1)
+
+    # the database is read again once it is modified
+    db.add_records([_record('smooth', 10., 10., 0.8)])
+    stat = os.stat(db_file)
+    os.utime(db_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert(history_estimate('smooth', db_file) == {'mem_gb': 1., 'n_procs': 1})
+    assert(len(n_reads) == 2)
+
+    assert(history_estimate('realign', str(tmpdir.join('missing.sqlite'))) == {})
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+try:
+    from pypes.run import run_wf
+except ImportError:
+    pytest.skip('the pypes.run dependencies are not available', allow_module_level=True)
+
+import nipype.pipeline.engine as pe
+from   nipype.interfaces.utility import Function
+
+import pypes.config
+from   pypes.config import update_config
+
+
+def read_setting():
+    from pypes.config import PYPES_CFG, get_config_setting
+
+    # a change in the configuration while the workflow runs does not reach the nodes
+    PYPES_CFG['test_run.value'] = 'changed'
+    return get_config_setting('test_run.value')
+
+
+@pytest.mark.parametrize('plugin, n_cpus', [('Linear', 1), ('MultiProc', 2)])
+def test_run_wf_nodes_read_the_snapshot(tmpdir, plugin, n_cpus):
+    update_config({'test_run.value': 'frozen'})
+
+    wf = pe.Workflow(name='test_run', base_dir=str(tmpdir))
+    wf.add_nodes([pe.Node(Function(function=read_setting, input_names=[], output_names=['value']),
+                          name='read_setting')])
+
+    execgraph = run_wf(wf, plugin=plugin, n_cpus=n_cpus)
+
+    node = list(execgraph.nodes())[0]
+    assert(node.result.outputs.value == 'frozen')
+    assert(pypes.config._SNAPSHOT is None)
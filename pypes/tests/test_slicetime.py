@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import nibabel as nib
+import pytest
+
+try:
+    from pypes.preproc.slicetime_params import STCParameters
+    from pypes.preproc.slicetime_shift import slice_shifts, slice_time_correct
+except ImportError:
+    pytest.skip('the pypes.preproc dependencies are not available', allow_module_level=True)
+
+
+def _signal(times):
+    return 100 + 10 * np.sin(2 * np.pi * times / 16.)
+
+
+@pytest.fixture
+def stc_file(tmpdir):
+    """ 4 slices acquired in ascending order, each a quarter of TR after the previous one,
+    with the slice times in the header."""
+    n_vols = 64
+    data = np.empty((2, 2, 4, n_vols), dtype=np.float32)
+    for slice_idx in range(4):
+        data[:, :, slice_idx, :] = _signal(np.arange(n_vols) + slice_idx / 4.)
+
+    img = nib.Nifti1Image(data, np.eye(4))
+    img.header.set_dim_info(slice=2)
+    img.header.set_xyzt_units('mm', 'sec')
+    img.header['pixdim'][4] = 2.
+    img.header.set_slice_duration(0.5)
+    img.header.set_slice_times([0., 0.5, 1., 1.5])
+
+    in_file = str(tmpdir.join('rest.nii'))
+    img.to_filename(in_file)
+    return in_file
+
+
+def test_slice_shifts_base():
+    shifts = slice_shifts(4, [0, 2, 1, 3], 0, time_repetition=2.)
+    assert(np.allclose(shifts, [0., 0.5, 0.25, 0.75]))
+    assert(np.allclose(slice_shifts(4, [1, 3, 2, 4], 1, time_repetition=2.), shifts))
+
+    with pytest.raises(ValueError):
+        slice_shifts(4, [0, 1, 2], 0, time_repetition=2.)
+    with pytest.raises(ValueError):
+        slice_shifts(4, [0, 1, 2, 3], 4, time_repetition=2.)
+
+
+def test_stc_parameters_from_header(stc_file):
+    num_slices, ref_slice, slice_order, _, _ = STCParameters().fit(stc_file, time_repetition=2.)
+    assert(num_slices == 4)
+    assert(slice_order == [0, 1, 2, 3])
+    assert(ref_slice == 0)
+
+
+@pytest.mark.parametrize('method', ['fft', 'cubic'])
+@pytest.mark.parametrize('slice_order, ref_slice', [([0, 1, 2, 3], 0), ([1, 2, 3, 4], 1)])
+def test_slice_time_correct(tmpdir, stc_file, method, slice_order, ref_slice):
+    out_file = slice_time_correct(stc_file, str(tmpdir.join('stc.nii')), slice_order, ref_slice,
+                                  time_repetition=2., method=method)
+
+    corrected = nib.load(out_file).get_fdata()
+    expected = _signal(np.arange(corrected.shape[-1]))
+    # all the slices are shifted to the acquisition times of the first one
+    for slice_idx in range(4):
+        assert(np.allclose(corrected[0, 0, slice_idx, 4:-4], expected[4:-4], atol=0.05))
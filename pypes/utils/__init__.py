@@ -18,6 +18,8 @@ from .piping  import  (extend_trait_list,
                        get_node,
                        joinstrings,
                        find_wf_node,
+                       has_join_on,
+                       remove_join_dependents,
                        get_datasink,
                        get_input_node,
                        get_interface_node,
@@ -3,6 +3,8 @@
 Helper functions for joining, merging, managing the workflow nodes.
 """
 
+import networkx as nx
+import nipype.pipeline.engine as pe
 from nipype.interfaces.utility import Function, IdentityInterface
 from nipype.interfaces.io import SelectFiles, DataSink, DataGrabber
 from nipype.interfaces.base import traits, isdefined
@@ -141,6 +143,53 @@ def find_wf_node(wf, iface_type, name=''):
     return None
 
 
+def _is_join_on(node, joinsource):
+    """ Return True if `node` is a JoinNode over the node with name `joinsource`."""
+    if not isinstance(node, pe.JoinNode):
+        return False
+    return str(node.joinsource).split('.')[-1] == joinsource
+
+
+def has_join_on(wf, joinsource='infosrc'):
+    """ Return True if any node of `wf`, or of its sub-workflows, joins over `joinsource`."""
+    return any(_is_join_on(node, joinsource) for node in wf._get_all_nodes())
+
+
+def remove_join_dependents(wf, joinsource='infosrc'):
+    """ Remove from `wf` the nodes that join over `joinsource` and all the nodes
+    and sub-workflows that depend on them.
+    If a JoinNode is inside a sub-workflow, the whole sub-workflow is removed.
+
+    Parameters
+    ----------
+    wf: nipype Workflow
+
+    joinsource: str
+        Name of the iterables node of the join steps.
+
+    Returns
+    -------
+    removed: list of str
+        The names of the removed nodes and sub-workflows.
+    """
+    joins = []
+    for item in wf._graph.nodes():
+        if isinstance(item, pe.Workflow):
+            nodes = item._get_all_nodes()
+        else:
+            nodes = [item]
+
+        if any(_is_join_on(node, joinsource) for node in nodes):
+            joins.append(item)
+
+    to_remove = set(joins)
+    for item in joins:
+        to_remove.update(nx.descendants(wf._graph, item))
+
+    wf.remove_nodes(list(to_remove))
+    return sorted([item.name for item in to_remove])
+
+
 def extend_trait_list(trait_list, extension):
     """ Extend or initialize `trait_list` with `extension`.
 